@@ -7,11 +7,116 @@ biodegradation in groundwater plumes. Journal of Contaminant Hydrology, 107, 1-9
 @author: Wei Mao <wm23a@fsu.edu>
 """
 import math
+import os
+from collections import OrderedDict
 import numpy as np
+from scipy import special
 
 
-vertorized_erf = np.vectorize(math.erf)
-vertorized_erfc = np.vectorize(math.erfc)
+vertorized_erf = np.vectorize(math.erf, otypes=[float])
+vertorized_erfc = np.vectorize(math.erfc, otypes=[float])
+
+# coefficients of the Chebyshev fit of erfc of Numerical Recipes (erfcc), fractional error below 1.2e-7 for all x
+_ERFC_COEFFICIENTS = (-1.26551223, 1.00002368, 0.37409196, 0.09678418, -0.18628806, 0.27886807, -1.13520398,
+                      1.48851587, -0.82215223, 0.17087277)
+# elements evaluated at once by the rational backend, the temporaries of a block stay in the CPU cache
+_RATIONAL_BLOCK = 8192
+
+
+def _erfc_rational(x):
+    """erfc(x) from the Chebyshev fit, evaluated in single precision in place, one block of elements at a time"""
+    x = np.asarray(x)
+    result = np.empty(x.shape, dtype=np.float32)
+    values = x.reshape(-1)
+    flat = result.reshape(-1)
+    t = np.empty(_RATIONAL_BLOCK, dtype=np.float32)
+    z = np.empty(_RATIONAL_BLOCK, dtype=np.float32)
+    coefficients = [np.float32(c) for c in _ERFC_COEFFICIENTS]
+    with np.errstate(over="ignore"):
+        for start in range(0, flat.size, _RATIONAL_BLOCK):
+            stop = min(start + _RATIONAL_BLOCK, flat.size)
+            block, t_block, z_block = flat[start:stop], t[:stop - start], z[:stop - start]
+            np.abs(values[start:stop], out=z_block, casting="same_kind")
+            # t = 1 / (1 + z / 2), erfc(z) = t * exp(-z^2 + P(t))
+            np.multiply(z_block, np.float32(0.5), out=t_block)
+            t_block += 1
+            np.reciprocal(t_block, out=t_block)
+            block.fill(coefficients[-1])
+            for coefficient in coefficients[-2::-1]:
+                block *= t_block
+                block += coefficient
+            z_block *= z_block
+            block -= z_block
+            np.exp(block, out=block)
+            block *= t_block
+    negative = x < 0
+    result[negative] = 2 - result[negative]
+    return result
+
+
+def _erf_rational(x):
+    result = _erfc_rational(x)
+    np.subtract(1, result, out=result)
+    return result
+
+
+# special function backends, name: (erf, erfc)
+# The lateral erf difference is evaluated from erfc (see DomenicoRobbins._erf_diff), so the errors in the tails
+# of the plume near the threshold are relative errors of erfc.
+#   math     - math.erf applied elementwise, double precision (reference, slowest)
+#   scipy    - scipy.special ufuncs, double precision (default)
+#   rational - Chebyshev fit of erfc computed in single precision in place. Measured by benchmark_erf_backends
+#              on a 2 km NO3-N plume with concinit = 40 mg/l: 1.2 to 1.6 x faster than scipy for float64 plumes
+#              and 1.8 x for float32 plumes. The largest error is 2.8e-6 mg/l in the plume core, the cells above
+#              the 1e-6 mg/l threshold are within 1.8e-6 of their value, so a cell at the threshold is off by
+#              about 2e-12 mg/l and no cell crosses the threshold. In float32 plumes the rounding of the plume
+#              itself (5.3e-6 relative) dominates.
+ERF_BACKENDS = {
+    "math": (vertorized_erf, vertorized_erfc),
+    "scipy": (special.erf, special.erfc),
+    "rational": (_erf_rational, _erfc_rational),
+}
+erf_function, erfc_function = ERF_BACKENDS["scipy"]
+erf_backend = "scipy"
+# floating point type of the grids, the lateral kernels and the plumes, see set_plume_dtype
+plume_dtype = np.float64
+# tabulated lateral kernels shared by all sources, see set_kernel_cache
+kernel_cache = None
+
+
+def set_erf_backend(name):
+    """Select the special function backend used by all solutions, see ERF_BACKENDS"""
+    global erf_function, erfc_function, erf_backend
+    if name.lower() not in ERF_BACKENDS:
+        raise ValueError("Invalid special function backend: {}".format(name))
+    erf_function, erfc_function = ERF_BACKENDS[name.lower()]
+    erf_backend = name.lower()
+
+
+def set_plume_dtype(dtype):
+    """Select the floating point type of the plume computation, np.float64 (default) or np.float32
+
+    The output rasters are 32_BIT_FLOAT, so float32 plumes skip the final cast and halve the memory
+    traffic of the dense tiles. The source parameters stay in double precision.
+    """
+    global plume_dtype
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("Invalid plume data type: {}".format(dtype))
+    plume_dtype = dtype.type
+
+
+def set_kernel_cache(cache):
+    """Use a LateralKernelCache for the lateral kernels of the 2D solutions, None to compute them directly"""
+    global kernel_cache
+    kernel_cache = cache
+
+# steady-state 2D solutions that factor into an x-only scale times the lateral erf difference
+SEPARABLE_SOLUTIONS = ("DomenicoRobbinsSS2D", "DomenicoRobbinsSSDecay2D")
+# number of cells evaluated at once when a separable plume is scanned column block by column block
+CHUNK_CELLS = 2 ** 22
+# precision [m] of the half widths that size the reference plumes and their multi-resolution grids
+HALF_WIDTH_TOLERANCE = 1e-6
 
 
 class DomenicoRobbins:
@@ -36,6 +141,9 @@ class DomenicoRobbins:
         self.k = k
         self.v = v
         self.t = t
+        # the 2D solutions drop dz and Z, the depth slices of their 3D counterparts still need them
+        self.vertical_dz = dz
+        self.vertical_Z = Z
 
         if self.name == "DomenicoRobbins":
             self.k = 0
@@ -68,7 +176,7 @@ class DomenicoRobbins:
         else:
             raise ValueError("Invalid model name")
 
-        self.s = concinit / 8
+        self.s = float(concinit) / 8
         if t >= 0:
             self.vt = v * t
             self.xden = 2 * math.sqrt(dx * v * t)
@@ -79,98 +187,973 @@ class DomenicoRobbins:
         self.zover2 = Z  # without the /2
 
     def eval(self, x, y, z):
-        try:
-            nx = len(x)
-            ny = len(y)
-            x = np.tile(x, ny).reshape(ny, nx)
-            y = np.tile(y, nx).reshape(nx, ny).transpose()
-        except TypeError:
-            if isinstance(x, int) or isinstance(x, float):
-                pass
-            else:
-                raise TypeError("x must be a number or a numpy array")
+        """Evaluate the solution on the grid spanned by x (columns) and y (rows).
+
+        x and y are broadcast against each other (x as a row, y as a column) instead of being
+        tiled, so the x-only factors (erfc term, decay exponential, yden) are computed once per
+        column and the full ny x nx array is only formed by the final product.
+        """
+        x, y = self._broadcast(x, y)
+
         if self.name == "DomenicoRobbins":
             yden = 2 * np.sqrt(self.dy * x)
             zden = 2 * np.sqrt(self.dz * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
-            erfz_p1 = (z + self.zover2) / zden
-            erfz_p2 = (z - self.zover2) / zden
-
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
-            erfz_p1_withinf = np.where(np.isnan(erfz_p1),  np.inf, erfz_p1)
-            erfz_p2_withinf = np.where(np.isnan(erfz_p2), -np.inf, erfz_p2)
-
-            return self.s * vertorized_erfc((x - self.vt) / self.xden)\
-                * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))\
-                * (vertorized_erf(erfz_p1_withinf) - vertorized_erf(erfz_p2_withinf))
+            return self.s * erfc_function((x - self.vt) / self.xden)\
+                * self._erf_diff(y, self.yover2, yden) * self._erf_diff(z, self.zover2, zden)
 
         elif self.name == "DomenicoRobbins2D":
-            yden = 2 * np.sqrt(self.dy * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
-
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
-
-            return self.s * 2 * vertorized_erfc((x - self.vt) / self.xden)\
-                * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))
+            return self.s * 2 * erfc_function((x - self.vt) / self.xden) * lateral_kernel(y, x, self.yover2, self.dy)
 
         elif self.name == "DomenicoRobbinsSS":
             yden = 2 * np.sqrt(self.dy * x)
             zden = 2 * np.sqrt(self.dz * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
-            erfz_p1 = (z + self.zover2) / zden
-            erfz_p2 = (z - self.zover2) / zden
+            return self.s * 2 * self._erf_diff(y, self.yover2, yden) * self._erf_diff(z, self.zover2, zden)
 
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
-            erfz_p1_withinf = np.where(np.isnan(erfz_p1),  np.inf, erfz_p1)
-            erfz_p2_withinf = np.where(np.isnan(erfz_p2), -np.inf, erfz_p2)
+        elif self.name == "DomenicoRobbinsSS2D":
+            return self.s * 4 * lateral_kernel(y, x, self.yover2, self.dy)
 
-            return self.s * 2 * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))\
-                * (vertorized_erf(erfz_p1_withinf) - vertorized_erf(erfz_p2_withinf))
+        elif self.name == "DomenicoRobbinsSSDecay2D":
+            xover2 = x / (2 * self.dx)
+            decay = np.exp(xover2 - xover2 * self.decay_sqrt)
+            return self.s * 4 * lateral_kernel(y, x, self.yover2, self.dy) * decay
 
-        elif self.name == "DomenicoRobbinsSS2D":
+        elif self.name == "DomenicoRobbins2DModified":
             yden = 2 * np.sqrt(self.dy * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
 
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
+            correction_exp = np.exp(x / self.dx)
+            correction_erfc = erfc_function((x + self.vt) / self.xden)
+            condition = (correction_erfc <= 0) | np.isinf(correction_exp)
+            correction = np.where(condition, 0, correction_exp * correction_erfc)
 
-            return self.s * 4 * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))
+            return self.s * 2 * (erfc_function(x - self.vt + correction) / self.xden)\
+                * self._erf_diff(y, self.yover2, yden)
 
+    def column_factors(self, x):
+        """x-only factors of the 2D solutions, c(x, y) = scale(x) * erf_diff(y, Y / 2, yden(x))
+
+        DomenicoRobbins2D is taken at self.t, or at the steady state if t < 0. The 3D solutions give the
+        factors of the vertically mixed plume, see depth_factors.
+        """
+        x = np.asarray(x, dtype=plume_dtype)
+        yden = 2 * np.sqrt(self.dy * x)
+        if self.name in ("DomenicoRobbinsSS2D", "DomenicoRobbinsSS") or \
+                (self.name in ("DomenicoRobbins2D", "DomenicoRobbins") and self.t < 0):
+            scale = np.full_like(yden, self.s * 4)
+        elif self.name in ("DomenicoRobbins2D", "DomenicoRobbins"):
+            scale = self.s * 2 * erfc_function((x - self.vt) / self.xden)
         elif self.name == "DomenicoRobbinsSSDecay2D":
             xover2 = x / (2 * self.dx)
-            yden = 2 * np.sqrt(self.dy * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
+            scale = self.s * 4 * np.exp(xover2 - xover2 * self.decay_sqrt)
+        else:
+            raise ValueError("{} is not a separable solution".format(self.name))
+        return scale.astype(plume_dtype, copy=False), yden.astype(plume_dtype, copy=False)
 
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
+    def time_factors(self, x, times):
+        """ntimes x nx x-only factors of the transient 2D solutions at the output times
 
-            return self.s * 4 * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))\
-                * np.exp(xover2 - xover2 * self.decay_sqrt)
+        The lateral erf difference does not depend on time, so c(t, x, y) = scale(t, x) * erf_diff(y, Y / 2, yden(x)).
+        The steady-state solutions use their transient counterparts, i.e. DomenicoRobbins2D without and
+        with first-order decay, which approach the steady-state scale for large t.
+        """
+        x = np.asarray(x, dtype=plume_dtype)[np.newaxis, :]
+        times = np.atleast_1d(np.asarray(times, dtype=float))[:, np.newaxis]
+        if (times <= 0).any():
+            raise ValueError("Output times must be greater than 0")
+        xden = 2 * np.sqrt(self.dx * self.v * times)
+        if self.name in ("DomenicoRobbins2D", "DomenicoRobbinsSS2D"):
+            scale = self.s * 2 * erfc_function((x - self.v * times) / xden)
+        elif self.name == "DomenicoRobbinsSSDecay2D":
+            xover2 = x / (2 * self.dx)
+            scale = self.s * 2 * np.exp(xover2 - xover2 * self.decay_sqrt)\
+                * erfc_function((x - self.v * times * self.decay_sqrt) / xden)
+        else:
+            raise ValueError("{} has no transient 2D form".format(self.name))
+        return scale.astype(plume_dtype, copy=False)
 
-        elif self.name == "DomenicoRobbins2DModified":
-            yden = 2 * np.sqrt(self.dy * x)
-            erfy_p1 = (y + self.yover2) / yden
-            erfy_p2 = (y - self.yover2) / yden
+    def eval_times(self, x, y, times):
+        """Evaluate a 2D solution at several times, return a ntimes x ny x nx array
 
-            correction_exp = np.exp(x / self.dx)
-            correction_erfc = vertorized_erfc((x + self.vt) / self.xden)
-            condition = (correction_erfc <= 0) | np.isinf(correction_exp)
-            correction = np.where(condition, 0, correction_exp * correction_erfc)
+        The lateral erf kernel is evaluated once, only the longitudinal factor is recomputed per time.
+        """
+        return self.separable(x).eval_times(y, times)
+
+    def vertical_factors(self, x, depths):
+        """ndepths x nx vertical erf difference erf_diff(z, Z, 2 * sqrt(dz * x)) of the 3D solutions
+
+        The depth z is measured down from the water table, the source spans 0 <= z <= Z (Z is mirrored
+        at the water table, which is why zover2 is Z). The factor is 2 inside the source at x = 0.
+        """
+        x = np.asarray(x, dtype=plume_dtype)[np.newaxis, :]
+        depths = np.atleast_1d(np.asarray(depths, dtype=plume_dtype))[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._erf_diff(depths, self.vertical_Z, 2 * np.sqrt(self.vertical_dz * x))
+
+    def vertical_average(self, x, top, bottom):
+        """nx mean of the vertical erf difference over top <= z <= bottom, integrated analytically
+
+        The antiderivative of erf(u) is u * erf(u) + exp(-u^2) / sqrt(pi), at x = 0 (no vertical spreading)
+        the mean is 2 times the fraction of [top, bottom] inside the source.
+        """
+        if bottom <= top:
+            raise ValueError("The bottom of the depth interval must be below its top")
+        x = np.asarray(x, dtype=float)
+        den = 2 * np.sqrt(self.vertical_dz * x)
+        Z = self.vertical_Z
+
+        def integral(u):
+            return u * special.erf(u) + np.exp(-u * u) / math.sqrt(math.pi)
+
+        spread = den > 0
+        den = np.where(spread, den, 1.0)
+        total = den * (integral((bottom + Z) / den) - integral((top + Z) / den)
+                       - integral((bottom - Z) / den) + integral((top - Z) / den))
+        total = np.where(spread, total, abs(bottom + Z) - abs(top + Z) - abs(bottom - Z) + abs(top - Z))
+        return (total / (bottom - top)).astype(plume_dtype, copy=False)
+
+    def depth_factors(self, x, depths):
+        """ndepths x nx x-only factors of the 3D counterpart of the solution at the depths
+
+        c(z, x, y) = scale(x) * vertical_factors(z, x) / 2 * erf_diff(y, Y / 2, yden(x)), where scale is the
+        factor of the vertically mixed plume (column_factors), so the depth integral of the 3D plume equals the
+        2D plume times Z. The lateral erf kernel does not depend on z.
+        """
+        scale, _ = self.column_factors(x)
+        return scale[np.newaxis, :] * self.vertical_factors(x, depths) / 2
+
+    def depth_average_factors(self, x, top, bottom):
+        """1 x nx x-only factor of the 3D counterpart averaged over top <= z <= bottom, see depth_factors"""
+        scale, _ = self.column_factors(x)
+        return (scale * self.vertical_average(x, top, bottom) / 2)[np.newaxis, :]
+
+    def eval_depths(self, x, y, depths):
+        """Evaluate the 3D counterpart of the solution at several depths, return a ndepths x ny x nx array"""
+        return self.separable(x).eval_depths(y, depths)
+
+    def eval_depth_average(self, x, y, top, bottom):
+        """ny x nx concentration of the 3D counterpart averaged over top <= z <= bottom"""
+        return self.separable(x).eval_depth_average(y, top, bottom)
+
+    def half_width(self, x, threshold, tolerance=1e-3):
+        """Distance from the center line at which the steady-state 2D plume drops to the threshold
+
+        The lateral erf difference decreases away from the center line, so the distance is solved per
+        column by bisection. Columns that are below the threshold everywhere get 0.
+        """
+        scale, yden = self.column_factors(x)
+        return lateral_half_width([(scale, yden, self.yover2)], threshold, tolerance)
+
+    def separable(self, x):
+        """Factored plume over the columns x, see SeparablePlume"""
+        return SeparablePlume(x, [(1.0, self)])
+
+    @staticmethod
+    def _broadcast(x, y):
+        """Turn 1-D x and y vectors into a row and a column that broadcast to a ny x nx grid"""
+        if not isinstance(x, (int, float, np.ndarray, list, tuple)):
+            raise TypeError("x must be a number or a numpy array")
+        x = np.asarray(x, dtype=plume_dtype)
+        y = np.asarray(y, dtype=plume_dtype)
+        if x.ndim == 1 and y.ndim == 1:
+            x = x[np.newaxis, :]
+            y = y[:, np.newaxis]
+        return x, y
+
+    @staticmethod
+    def _erf_diff(y, half_width, den):
+        """erf((y + half_width) / den) - erf((y - half_width) / den)
+
+        The difference is symmetric in y and evaluated as
+        erfc((|y| - half_width) / den) - erfc((|y| + half_width) / den), which avoids the cancellation of two erf
+        values close to 1 in the tails of the plume. Inside of the source plane the first erfc is between 1 and 2,
+        so there is no cancellation either.
+        At x = 0 the denominator is zero and the 0 / 0 cells are replaced by +/- inf, so the
+        source column is 2 inside the source plane and 0 outside of it.
+        """
+        y = np.abs(y)
+        erf_p1 = _replace_nan(np.asarray((y + half_width) / den, dtype=plume_dtype), np.inf)
+        erf_p2 = _replace_nan(np.asarray((y - half_width) / den, dtype=plume_dtype), -np.inf)
+        result = np.asarray(erfc_function(erf_p2), dtype=plume_dtype)
+        result -= erfc_function(erf_p1)
+        return result
+
+
+class SeparablePlume:
+    """Factored form of the steady-state 2D Domenico plumes
+
+    DomenicoRobbinsSS2D and DomenicoRobbinsSSDecay2D are the product of an x-only factor and the lateral
+    erf difference, so a plume only keeps one scale and one yden value per column. A plume may hold
+    several weighted terms (e.g. NO3-N minus the nitrified NH4-N); ny x nx arrays are only formed on demand.
+    The terms sharing a lateral kernel are kept in groups, so the plume can also be evaluated at output times.
+    """
+    def __init__(self, x, terms):
+        """
+        x, column coordinates of the plume
+        terms, list of (weight, DomenicoRobbins) pairs that are summed
+        """
+        self.x = np.asarray(x, dtype=plume_dtype)
+        self.terms = list(terms)
+        self.factors = []
+        self.groups = []
+        for weight, model in self.terms:
+            scale, yden = model.column_factors(self.x)
+            # terms with the same lateral kernel (same dispersivity and Y) share one erf difference
+            for index, (shared_scale, shared_yden, yover2) in enumerate(self.factors):
+                if yover2 == model.yover2 and np.array_equal(shared_yden, yden):
+                    self.factors[index] = (shared_scale + weight * scale, shared_yden, yover2)
+                    self.groups[index].append((weight, model))
+                    break
+            else:
+                self.factors.append((weight * scale, yden, model.yover2))
+                self.groups.append([(weight, model)])
+
+    def combine(self, other, weight=1.0):
+        """Return the plume self + weight * other evaluated over the same columns"""
+        if len(other.x) != len(self.x) or not np.array_equal(other.x, self.x):
+            raise ValueError("Plumes must share the same columns")
+        return SeparablePlume(self.x, self.terms + [(weight * w, model) for w, model in other.terms])
+
+    def eval(self, y, cols=slice(None)):
+        """Dense len(y) x ncols tile of the plume for the rows y and the columns cols"""
+        y = np.asarray(y, dtype=plume_dtype)[:, np.newaxis]
+        result = None
+        for (scale, yden, yover2), group in zip(self.factors, self.groups):
+            term = lateral_kernel(y, self.x[cols], yover2, group[0][1].dy, yden[cols])
+            term *= scale[cols]
+            if result is None:
+                result = term
+            else:
+                result += term
+        return result
+
+    def eval_times(self, y, times, cols=slice(None)):
+        """Dense ntimes x len(y) x ncols tiles of the transient plume at the output times
+
+        Every lateral kernel is evaluated once for all times, see DomenicoRobbins.time_factors.
+        """
+        return self._eval_bands(y, cols, lambda model, x: model.time_factors(x, times))
+
+    def eval_depths(self, y, depths, cols=slice(None)):
+        """Dense ndepths x len(y) x ncols tiles of the 3D plume at the depths, see DomenicoRobbins.depth_factors"""
+        return self._eval_bands(y, cols, lambda model, x: model.depth_factors(x, depths))
+
+    def eval_depth_average(self, y, top, bottom, cols=slice(None)):
+        """Dense len(y) x ncols tile of the 3D plume averaged over top <= z <= bottom"""
+        return self._eval_bands(y, cols, lambda model, x: model.depth_average_factors(x, top, bottom))[0]
+
+    def _eval_bands(self, y, cols, band_factors):
+        """Sum of the lateral kernels scaled by band_factors(model, x), a nbands x ncols array per model"""
+        y = np.asarray(y, dtype=plume_dtype)[:, np.newaxis]
+        x = self.x[cols]
+        result = None
+        for (_, yden, yover2), group in zip(self.factors, self.groups):
+            kernel = lateral_kernel(y, x, yover2, group[0][1].dy, yden[cols])
+            scale = sum(weight * band_factors(model, x) for weight, model in group)
+            if result is None:
+                result = np.zeros((len(scale), len(y), len(x)), dtype=plume_dtype)
+            for index in range(len(scale)):
+                result[index] += kernel * scale[index]
+        return result
+
+    def value(self, x, y):
+        """Concentration at arbitrary points (x, y)"""
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        result = np.zeros(x.shape)
+        for weight, model in self.terms:
+            scale, yden = model.column_factors(x)
+            result += weight * scale * DomenicoRobbins._erf_diff(y, model.yover2, yden)
+        return result
+
+    def column_blocks(self, ny):
+        """Column slices that keep a ny-row dense tile below CHUNK_CELLS"""
+        step = max(1, CHUNK_CELLS // max(ny, 1))
+        return [slice(start, min(start + step, len(self.x))) for start in range(0, len(self.x), step)]
+
+    def half_widths(self, threshold, tolerance=1e-3):
+        """Per-column distance from the center line beyond which the plume is below the threshold
+
+        Terms with a negative weight are left out, which gives an upper bound for coupled plumes
+        and the exact distance for a single term.
+        """
+        factors = [factor for factor in self.factors if np.all(factor[0] >= 0)]
+        if not factors:
+            return np.zeros(len(self.x))
+        return lateral_half_width(factors, threshold, tolerance)
+
+    def extent(self, y, threshold, tolerance=1e-3, half_widths=None):
+        """Rows and columns of the grid (y, self.x) that may contain a cell above the threshold
+
+        Return two boolean masks derived from the analytic half widths, without evaluating the grid.
+        half_widths, the half widths at the threshold if they are already known, e.g. from DomenicoRobbinsBatch
+        """
+        if half_widths is None:
+            half_widths = self.half_widths(threshold, tolerance)
+        rows = np.abs(np.asarray(y, dtype=float)) <= half_widths.max(initial=0) + tolerance
+        cols = half_widths > 0
+        return rows, cols
+
+    def select(self, cols):
+        """Return the plume over the columns self.x[cols]"""
+        return SeparablePlume(self.x[cols], self.terms)
+
+    def adaptive_columns(self, threshold, tolerance, times=(), depths=(), max_stride=64, half_widths=None):
+        """Columns of a multi-resolution grid of the plume, fine near the source and the plume margins
+
+        The x-only factors of the plume (the scale and the log of yden of every lateral kernel, the half widths at
+        the threshold and the factors of the output times and depths) are interpolated linearly between the
+        returned columns with an error below tolerance times their peak. Where the plume changes slowly along x
+        the columns are up to max_stride apart, see dyadic_columns. Return the indices into self.x up to the last
+        column above the threshold. half_widths, the half widths at the threshold solved to HALF_WIDTH_TOLERANCE if
+        they are already known.
+        """
+        # solved to 1e-6, the rounding of the default tolerance would show up as curvature
+        if half_widths is None:
+            half_widths = self.half_widths(threshold, HALF_WIDTH_TOLERANCE)
+        stop = np.flatnonzero(half_widths)
+        stop = stop[-1] + 1 if len(stop) else 0
+        if stop == 0:
+            return np.arange(0)
+        x = self.x[:stop]
+        profiles = [half_widths[:stop]]
+        for (scale, yden, _), group in zip(self.factors, self.groups):
+            profiles.append(scale[:stop])
+            if len(times):
+                profiles.extend(sum(weight * model.time_factors(x, times) for weight, model in group))
+            if len(depths):
+                profiles.extend(sum(weight * model.depth_factors(x, depths) for weight, model in group))
+        profiles = [profile / max(np.abs(profile).max(initial=0), 1e-300) for profile in profiles]
+        # the lateral kernel changes by at most its relative change of yden, which is the change of log(yden)
+        profiles.extend(np.log(yden[:stop].astype(float)) for _, yden, _ in self.factors)
+        return dyadic_columns(profiles, tolerance, max_stride)
+
+    def column_sums(self, y):
+        """Sum of every column over the rows y, e.g. for the mass removal rate"""
+        sums = np.zeros(len(self.x))
+        for block in self.column_blocks(len(y)):
+            sums[block] = self.eval(y, block).sum(axis=0)
+        return sums
+
+
+class DomenicoRobbinsBatch:
+    """Separable plumes of many sources stacked over the columns of one uniform grid
+
+    The plumes keep the column factors of their own solutions (see SeparablePlume), their columns are prefixes of the
+    same grid x = j * cell size, j = 1, 2, ... The batch stacks the factors of the sources into nsource x nx arrays,
+    padded with zero scales past the end of the shorter plumes, so the per-column work of all sources runs in a few
+    vectorized passes instead of one small pass per source. The sources are sorted by their number of columns and
+    processed in blocks of at most max_cells stacked cells, which bounds the temporaries and the padding.
+    """
+    def __init__(self, plumes, max_cells=CHUNK_CELLS):
+        """
+        plumes, list of SeparablePlume, None for the sources without plume
+        max_cells, largest number of stacked cells (sources x factors x columns) of a block
+        """
+        self.plumes = list(plumes)
+        self.max_cells = max_cells
+
+    def __len__(self):
+        return len(self.plumes)
+
+    def blocks(self, nfactor):
+        """Indices of the plumes of every block, in the order of their number of columns"""
+        order = sorted((index for index, plume in enumerate(self.plumes) if plume is not None),
+                       key=lambda index: len(self.plumes[index].x))
+        block = []
+        for index in order:
+            # the plumes are sorted, the last one of a block is the longest
+            if block and (len(block) + 1) * nfactor * len(self.plumes[index].x) > self.max_cells:
+                yield block
+                block = []
+            block.append(index)
+        if block:
+            yield block
+
+    def half_widths(self, threshold, tolerance=1e-3):
+        """Half widths of every plume (see SeparablePlume.half_widths), None for the sources without plume
+
+        The bisection of lateral_half_width runs once per block for all of its sources, every column is bisected as
+        in the single plume, so the half widths are the same.
+        """
+        factors = [None if plume is None else [factor for factor in plume.factors if np.all(factor[0] >= 0)]
+                   for plume in self.plumes]
+        nfactor = max([len(plume_factors) for plume_factors in factors if plume_factors is not None], default=0)
+        half_widths = [None if plume is None else np.zeros(len(plume.x)) for plume in self.plumes]
+        if nfactor == 0:
+            return half_widths
+        for block in self.blocks(nfactor):
+            nx = len(self.plumes[block[-1]].x)
+            # the padded columns have a zero scale and a zero half width
+            scale = np.zeros((nfactor, len(block), nx), dtype=plume_dtype)
+            yden = np.ones((nfactor, len(block), nx), dtype=plume_dtype)
+            yover2 = np.ones((nfactor, len(block), 1))
+            for row, index in enumerate(block):
+                ncol = len(self.plumes[index].x)
+                for factor, (plume_scale, plume_yden, plume_yover2) in enumerate(factors[index]):
+                    scale[factor, row, :ncol] = plume_scale
+                    yden[factor, row, :ncol] = plume_yden
+                    yover2[factor, row] = plume_yover2
+            solved = lateral_half_width(list(zip(scale, yden, yover2)), threshold, tolerance)
+            for row, index in enumerate(block):
+                half_widths[index] = solved[row, :len(self.plumes[index].x)]
+        return half_widths
+
+
+def eval_shared(plumes, y, boxes):
+    """Evaluate several separable plumes over the same columns, sharing their lateral kernels
+
+    plumes, list of SeparablePlume with the same x
+    boxes, list of (rows, cols) slices into (y, x), one per plume
+    The erf difference of every distinct (yden, Y / 2) is evaluated once over the union of the boxes and
+    scaled per plume, e.g. NH4-N and the coupled NO3-N plume with the same dispersivities.
+    Return the dense tiles, one per plume.
+    """
+    y = np.asarray(y, dtype=plume_dtype)
+    boxes = [(range(len(y))[rows], range(len(plume.x))[cols]) for plume, (rows, cols) in zip(plumes, boxes)]
+    filled = [(rows, cols) for rows, cols in boxes if len(rows) and len(cols)]
+    if filled:
+        row_start = min(rows.start for rows, _ in filled)
+        row_stop = max(rows.stop for rows, _ in filled)
+        col_start = min(cols.start for _, cols in filled)
+        col_stop = max(cols.stop for _, cols in filled)
+    kernels = []
+    tiles = []
+    for plume, (rows, cols) in zip(plumes, boxes):
+        tile = np.zeros((len(rows), len(cols)), dtype=plume_dtype)
+        if len(rows) and len(cols):
+            for (scale, yden, yover2), group in zip(plume.factors, plume.groups):
+                for shared_yden, shared_yover2, kernel in kernels:
+                    if shared_yover2 == yover2 and np.array_equal(shared_yden, yden):
+                        break
+                else:
+                    kernel = lateral_kernel(y[row_start:row_stop], plume.x[col_start:col_stop], yover2,
+                                            group[0][1].dy, yden[col_start:col_stop])
+                    kernels.append((yden, yover2, kernel))
+                tile += kernel[rows.start - row_start:rows.stop - row_start,
+                               cols.start - col_start:cols.stop - col_start] * scale[cols.start:cols.stop]
+        tiles.append(tile)
+    return tiles
+
+
+def lateral_kernel(y, x, yover2, dy, yden=None):
+    """erf_diff(y, Y / 2, 2 * sqrt(dy * x)) on the grid spanned by the column y and the row x
+
+    The tabulated kernel of the kernel cache is used when the grid is uniform, see LateralKernelCache.
+    yden, 2 * sqrt(dy * x) if it is already known
+    """
+    y = np.asarray(y, dtype=plume_dtype)
+    x = np.asarray(x, dtype=plume_dtype)
+    grid = (y.ndim == 1 or (y.ndim == 2 and y.shape[1] == 1)) and (x.ndim == 1 or (x.ndim == 2 and x.shape[0] == 1))
+    if grid:
+        y = y.reshape(-1, 1)
+        x = x.reshape(1, -1)
+        if kernel_cache is not None:
+            kernel = kernel_cache.lookup(y.ravel(), x.ravel(), yover2, dy)
+            if kernel is not None:
+                return kernel
+    if yden is None:
+        yden = 2 * np.sqrt(dy * x)
+    return DomenicoRobbins._erf_diff(y, yover2, np.reshape(yden, x.shape))
+
+
+class LateralKernelCache:
+    """In-memory and on-disk tables of the lateral kernel of the 2D solutions on uniform grids
+
+    On the plume grid y = i * h, x = j * h the lateral kernel erf_diff(y, Y / 2, 2 * sqrt(dy * x)) equals
+    erf_diff(i * p, 1, 2 * p * sqrt(q * j)) with the dimensionless groups p = h / (Y / 2) and q = dy / h, so one
+    table K[i, j] per (p, q) serves every source with the same Y, transverse dispersivity and cell size.
+    The tables are built with DomenicoRobbins._erf_diff itself, so grid lookups agree with the direct evaluation
+    up to rounding (there is no interpolation error) and only grids that are not uniform fall back to computing
+    the erfs. Tables grow on demand. The tables in memory are limited to max_bytes, the least recently used tables
+    are evicted first and written to the cache directory before, if they changed.
+    """
+    def __init__(self, directory=None, max_cells=2 ** 23, max_bytes=2 ** 28):
+        """
+        directory, folder of the .npy files that keep the tables across runs, None for in-memory tables only
+        max_cells, largest table kept, larger kernels are computed directly
+        max_bytes, largest total size of the tables in memory, the table in use is always kept
+        """
+        self.directory = directory
+        self.max_cells = max_cells
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()  # key: table, least recently used first
+        self.nbytes = 0
+        self.modified = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(p, q):
+        """Table key, the groups rounded to 12 significant digits plus the floating point type and the erf backend"""
+        return "{:.12g}_{:.12g}_{}_{}".format(p, q, np.dtype(plume_dtype).name, erf_backend)
+
+    def lookup(self, y, x, yover2, dy):
+        """len(y) x len(x) kernel for 1-D y and x on a uniform grid, or None if the grid is not uniform
+
+        x may skip columns of the grid, e.g. the columns of SeparablePlume.adaptive_columns.
+        """
+        if len(x) < 2 or yover2 <= 0:
+            return None
+        # the columns of multi-resolution plumes skip cells of the grid, its step is the smallest spacing
+        step = float(np.diff(x).min())
+        if step <= 0:
+            return None
+        cols = np.rint(x / step).astype(np.int64)
+        rows = np.rint(np.abs(y) / step).astype(np.int64)
+        tolerance = 1e-3 * step
+        if cols[0] < 0 or np.abs(x - cols * step).max() > tolerance or np.abs(np.abs(y) - rows * step).max(
+                initial=0) > tolerance:
+            return None
+        shape = (int(rows.max(initial=0)) + 1, int(cols[-1]) + 1)
+        if shape[0] * shape[1] > self.max_cells:
+            return None
+
+        p, q = step / yover2, dy / step
+        table = self.table(p, q, shape)
+        self.hits += 1
+        return table[rows[:, np.newaxis], cols[np.newaxis, :]]
+
+    def table(self, p, q, shape):
+        """Table of (p, q) with at least shape rows and columns, loaded from disk or extended if needed"""
+        key = self.key(p, q)
+        table = self.tables.get(key)
+        if table is None and self.directory is not None:
+            filename = os.path.join(self.directory, "kernel_{}.npy".format(key))
+            if os.path.exists(filename):
+                table = np.load(filename)
+        if table is None:
+            table = np.empty((0, 0), dtype=plume_dtype)
+        if table.shape[0] < shape[0] or table.shape[1] < shape[1]:
+            self.misses += 1
+            # grow by at least half of the current size, so plumes of increasing length are not rebuilt each time
+            new_shape = (max(shape[0], table.shape[0] + table.shape[0] // 2),
+                         max(shape[1], table.shape[1] + table.shape[1] // 2))
+            grown = np.empty(new_shape, dtype=plume_dtype)
+            grown[:table.shape[0], :table.shape[1]] = table
+            if table.shape[1] < new_shape[1]:
+                grown[:table.shape[0], table.shape[1]:] = self._kernel(p, q, 0, table.shape[0],
+                                                                       table.shape[1], new_shape[1])
+            grown[table.shape[0]:, :] = self._kernel(p, q, table.shape[0], new_shape[0], 0, new_shape[1])
+            table = grown
+            self.modified.add(key)
+        if key in self.tables:
+            self.nbytes -= self.tables[key].nbytes
+        self.tables[key] = table
+        self.tables.move_to_end(key)
+        self.nbytes += table.nbytes
+        self.evict()
+        return table
+
+    def evict(self):
+        """Drop the least recently used tables until the tables fit into max_bytes, the last table is kept"""
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            key, table = self.tables.popitem(last=False)
+            self.nbytes -= table.nbytes
+            if key in self.modified:
+                self.write(key, table)
+
+    @staticmethod
+    def _kernel(p, q, row_start, row_stop, col_start, col_stop):
+        """Block [row_start:row_stop, col_start:col_stop] of the table of (p, q)"""
+        i = np.arange(row_start, row_stop, dtype=float)[:, np.newaxis] * p
+        den = 2 * p * np.sqrt(q * np.arange(col_start, col_stop, dtype=float))
+        with np.errstate(divide="ignore", invalid="ignore"):  # column 0 is the source plane, x = 0
+            return DomenicoRobbins._erf_diff(i, 1.0, den[np.newaxis, :])
+
+    def save(self):
+        """Write the tables that were created or extended since the last save to the cache directory"""
+        if self.directory is None:
+            return
+        for key in list(self.modified):
+            self.write(key, self.tables[key])
+
+    def write(self, key, table):
+        """Write a table to the cache directory, tables are only kept in memory without a directory"""
+        self.modified.discard(key)
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(os.path.join(self.directory, "kernel_{}.npy".format(key)), table)
+
+    def clear(self):
+        """Drop the in-memory tables, the files in the cache directory are kept"""
+        self.tables.clear()
+        self.nbytes = 0
+        self.modified.clear()
+
+
+def lateral_half_width(factors, threshold, tolerance=1e-3):
+    """Solve sum(scale * erf_diff(y, Y / 2, yden)) = threshold for y >= 0 in every column
+
+    factors, list of (scale, yden, Y / 2) with one scale and yden value per column, all scales >= 0. The arrays
+             broadcast to the shape of the result, e.g. nsource x nx for DomenicoRobbinsBatch.
+    Return the half widths, rounded up to the tolerance, and 0 for columns below the threshold. Every column is
+    bisected until its own bracket is within the tolerance, the columns that are done drop out of the profile.
+    """
+    shape = np.broadcast(*[np.asarray(scale) for scale, _, _ in factors]).shape
+    factors = [tuple(np.broadcast_to(value, shape).ravel() for value in factor) for factor in factors]
+
+    def profile(y, columns):
+        total = np.zeros(len(columns))
+        for scale, yden, yover2 in factors:
+            total += scale[columns] * DomenicoRobbins._erf_diff(y, yover2[columns], yden[columns])
+        return total
+
+    columns = np.flatnonzero(profile(np.zeros(len(factors[0][0])), np.arange(len(factors[0][0]))) > threshold)
+    lower = np.zeros(len(columns))
+    upper = np.max([yover2[columns] + yden[columns] for _, yden, yover2 in factors], axis=0) + tolerance
+    growing = np.arange(len(columns))
+    for _ in range(64):
+        growing = growing[profile(upper[growing], columns[growing]) > threshold]
+        if not len(growing):
+            break
+        lower[growing] = upper[growing]
+        upper[growing] *= 2
+    bisected = np.flatnonzero(upper - lower > tolerance)
+    while len(bisected):
+        middle = (lower[bisected] + upper[bisected]) / 2
+        above = profile(middle, columns[bisected]) > threshold
+        lower[bisected] = np.where(above, middle, lower[bisected])
+        upper[bisected] = np.where(above, upper[bisected], middle)
+        bisected = bisected[upper[bisected] - lower[bisected] > tolerance]
+    half_widths = np.zeros(shape)
+    half_widths.flat[columns] = upper
+    return half_widths
+
+
+def dyadic_columns(profiles, tolerance, max_stride=64):
+    """Columns at which the profiles are kept so that linear interpolation in between stays within tolerance
+
+    profiles, arrays with one value per column, scaled so that tolerance is the admissible error
+    The columns are the ends of aligned blocks of 2^n columns. The interpolation error over a block of h columns is
+    bounded by h^2 / 8 times the largest second difference of the profiles in the block, every block is as large
+    as this bound allows, at most max_stride. The first and the last column are always kept.
+    """
+    ncol = len(profiles[0])
+    if ncol < 3 or tolerance <= 0:
+        return np.arange(ncol)
+    curvature = np.zeros(ncol)
+    for profile in profiles:
+        second = np.abs(np.diff(np.asarray(profile, dtype=float), 2))
+        curvature[1:-1] = np.maximum(curvature[1:-1], second)
+        curvature[:-2] = np.maximum(curvature[:-2], second)
+        curvature[2:] = np.maximum(curvature[2:], second)
+    with np.errstate(divide="ignore"):
+        allowed = np.sqrt(8 * tolerance / curvature)
+
+    # level of every interval [i, i + 1], the largest block around it that keeps the bound
+    intervals = np.arange(ncol - 1)
+    levels = np.zeros(ncol - 1, dtype=np.int64)
+    for level in range(1, int(math.log2(max(max_stride, 1))) + 1):
+        size = 2 ** level
+        nblock = -(-(ncol - 1) // size)
+        padded = np.full(nblock * size + 1, np.inf)
+        padded[:ncol] = allowed
+        block_min = np.minimum(padded[:-1].reshape(nblock, size).min(axis=1), padded[size::size])
+        fits = (block_min >= size)[intervals // size]
+        if not fits.any():
+            break
+        levels[fits] = level
+    starts = (intervals >> levels) << levels
+    ends = np.minimum(starts + (1 << levels), ncol - 1)
+    return np.union1d(starts, ends)
+
+
+def _replace_nan(array, value):
+    """Replace NaN values in place"""
+    np.copyto(array, value, where=np.isnan(array))
+    return array
+
+
+def benchmark_eval_memory(length=10000.0, width=2000.0, cell_size=2.0, name="DomenicoRobbinsSSDecay2D"):
+    """Report the peak allocation of DomenicoRobbins.eval for a length x width plume.
+
+    The peak is reported as a multiple of the size of the ny x nx float64 result, e.g. for a
+    10 km x 2 km plume.
+    """
+    import time
+    import tracemalloc
+
+    dr = DomenicoRobbins(name, 40, 2.113, 0.234, 0.234, 12, 1.5, 0.008, 0.1, -1)
+    xlist = np.arange(1, int(length / cell_size) + 1) * cell_size
+    ylist = np.arange(-int(width / cell_size / 2), int(width / cell_size / 2)) * cell_size
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = dr.eval(xlist, ylist, 0)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{}: {} x {} cells, {:.2f} s, peak {:.1f} MB ({:.1f} x result)".format(
+        name, len(ylist), len(xlist), elapsed, peak / 2 ** 20, peak / result.nbytes))
+    return peak
+
+
+def check_eval_broadcast(length=200.0, width=60.0, cell_size=0.8, rtol=1e-10, atol=1e-12):
+    """Compare DomenicoRobbins.eval with the per-cell evaluation on tiled grids it replaced
+
+    The reference tiles x and y to full ny x nx arrays and applies math.erf to every cell. The broadcast
+    evaluation takes the tails from erfc instead of the difference of two erf values close to 1, so the
+    results agree within round-off (np.allclose with rtol and atol [mg/l]), not bit for bit.
+    """
+    xlist = np.arange(0, int(length / cell_size) + 1) * cell_size
+    ylist = np.arange(-int(width / cell_size / 2), int(width / cell_size / 2)) * cell_size
+    x = np.tile(xlist, len(ylist)).reshape(len(ylist), len(xlist))
+    y = np.tile(ylist, len(xlist)).reshape(len(xlist), len(ylist)).transpose()
+
+    def erf_diff(value, half_width, den):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p1 = np.where(np.isnan((value + half_width) / den), np.inf, (value + half_width) / den)
+            p2 = np.where(np.isnan((value - half_width) / den), -np.inf, (value - half_width) / den)
+        return vertorized_erf(p1) - vertorized_erf(p2)
+
+    errors = {}
+    for name in ("DomenicoRobbinsSS", "DomenicoRobbinsSS2D", "DomenicoRobbinsSSDecay2D", "DomenicoRobbins2D"):
+        t = 1000 if name == "DomenicoRobbins2D" else -1
+        dr = DomenicoRobbins(name, 40, 2.113, 0.234, 0.234, 12, 1.5, 0.008, 0.1, t)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = dr.eval(xlist, ylist, 0)
+            lateral = erf_diff(y, dr.yover2, 2 * np.sqrt(dr.dy * x))
+            if name == "DomenicoRobbinsSS":
+                reference = dr.s * 2 * lateral * erf_diff(0, dr.zover2, 2 * np.sqrt(dr.dz * x))
+            elif name == "DomenicoRobbinsSS2D":
+                reference = dr.s * 4 * lateral
+            elif name == "DomenicoRobbinsSSDecay2D":
+                xover2 = x / (2 * dr.dx)
+                reference = dr.s * 4 * lateral * np.exp(xover2 - xover2 * dr.decay_sqrt)
+            else:
+                reference = dr.s * 2 * vertorized_erfc((x - dr.vt) / dr.xden) * lateral
+        errors[name] = np.nanmax(np.abs(result - reference))
+        print("{:26s} max difference {:.1e}".format(name, errors[name]))
+        if not np.allclose(result, reference, rtol=rtol, atol=atol, equal_nan=True):
+            raise AssertionError("{} differs from the per-cell evaluation".format(name))
+    return errors
+
+
+def benchmark_erf_backends(length=2000.0, width=400.0, cell_size=0.8, threshold=1e-6, repeat=3,
+                           name="DomenicoRobbinsSSDecay2D"):
+    """Time every special function backend on a representative plume grid, in both plume precisions
+
+    Report the best time of repeat runs, the maximum absolute difference to the math backend in double precision,
+    the largest relative difference of the cells above the threshold and the number of cells whose comparison with
+    the threshold changes.
+    """
+    import time
+
+    dr = DomenicoRobbins(name, 40, 2.113, 0.234, 0.234, 12, 1.5, 0.008, 0.1, -1)
+    xlist = np.arange(1, int(length / cell_size) + 1) * cell_size
+    ylist = np.arange(-int(width / cell_size / 2), int(width / cell_size / 2)) * cell_size
+    current_backend, current_dtype = erf_backend, plume_dtype
+
+    set_erf_backend("math")
+    reference = dr.eval(xlist, ylist, 0)
+    above = reference > threshold
+    results = {}
+    for dtype in (np.float64, np.float32):
+        set_plume_dtype(dtype)
+        for backend in ERF_BACKENDS:
+            set_erf_backend(backend)
+            elapsed = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = dr.eval(xlist, ylist, 0)
+                elapsed.append(time.perf_counter() - start)
+            error = np.abs(result - reference)
+            relative = (error[above] / reference[above]).max(initial=0)
+            changed = ((result > threshold) != above).sum()
+            results[(np.dtype(dtype).name, backend)] = (min(elapsed), error.max(), relative, changed)
+            print("{:7s} {:8s} {} x {} cells, {:.3f} s, max error {:.2e}, relative error above the threshold {:.1e}, "
+                  "threshold cells changed {}".format(np.dtype(dtype).name, backend, len(ylist), len(xlist),
+                                                      min(elapsed), error.max(), relative, changed))
+    set_erf_backend(current_backend)
+    set_plume_dtype(current_dtype)
+    return results
+
+
+def benchmark_batch_half_widths(nsource=192, lengths=(20.0, 150.0), cell_size=0.8, threshold=1e-6, seed=0,
+                                name="DomenicoRobbinsSSDecay2D"):
+    """Time the half widths of nsource plumes, one SeparablePlume at a time and stacked in a DomenicoRobbinsBatch
+
+    The flow path lengths, velocities and concentrations are drawn uniformly, e.g. the short paths of septic
+    systems next to a lake. The half widths of the batch must equal those of the single plumes.
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    plumes = []
+    for _ in range(nsource):
+        dr = DomenicoRobbins(name, rng.uniform(5, 80), 2.113, 0.234, 0.234, 12, 1.5, 0.008, rng.uniform(0.02, 0.5),
+                             -1)
+        plumes.append(dr.separable(np.arange(1, math.ceil(rng.uniform(*lengths) / cell_size) + 1) * cell_size))
+    start = time.perf_counter()
+    single = [plume.half_widths(threshold, HALF_WIDTH_TOLERANCE) for plume in plumes]
+    elapsed_single = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = DomenicoRobbinsBatch(plumes).half_widths(threshold, HALF_WIDTH_TOLERANCE)
+    elapsed_batch = time.perf_counter() - start
+    print("{} plumes of {:.0f} to {:.0f} m: single {:.3f} s, batch {:.3f} s ({:.1f} x faster)".format(
+        nsource, lengths[0], lengths[1], elapsed_single, elapsed_batch, elapsed_single / elapsed_batch))
+    if any(not np.array_equal(a, b) for a, b in zip(single, batch)):
+        raise AssertionError("The half widths of the batch differ from those of the single plumes")
+    return elapsed_single, elapsed_batch
+
+
+def check_plume_dtypes(length=200.0, cell_size=0.8, threshold=1e-6, area_tolerance=1e-3, mass_tolerance=1e-5,
+                       angle=0.5):
+    """Compare the float32 plume with the float64 plume for the Lakeshore example defaults
+
+    Build the reference NO3-N plume the way the Transport tool does (source column followed by the
+    cropped separable plume, rows and columns below the threshold removed) and check the relative
+    difference of the reductions of Transport.plume_statistics: plume area, mass input rate (massInRate
+    of the info file, up to the constant factor), summed downstream concentration and concentration at
+    the end of the plume. The plume is then warped onto a grid rotated by angle [rad], with nearest
+    neighbor and bilinear sampling as in Transport.warp_plumes, and the area and the summed
+    concentration of the warped tiles are compared as well.
+    """
+    from PlumeWarp import rotation, warp_array
+
+    current = plume_dtype
+    dispx, concinit, Y = 2.113, 40.0, 12.0
+    ny = int(Y / cell_size)
+    results = {}
+    for dtype in (np.float64, np.float32):
+        set_plume_dtype(dtype)
+        dr = DomenicoRobbins("DomenicoRobbinsSSDecay2D", concinit, dispx, 0.234, 0.234, Y, 1.5, 0.008, 0.1, -1)
+        xlist = np.arange(1, math.ceil(length / cell_size) + 1) * cell_size
+        plume = dr.separable(xlist)
+        edge = max(math.ceil(plume.half_widths(threshold).max(initial=0) / cell_size) + 2, math.ceil(ny / 2) + 1)
+        ylist = np.arange(-edge, edge + ny % 2) * cell_size
+        plumey = np.zeros(len(ylist), dtype=dtype)
+        plumey[edge - ny // 2:edge - ny // 2 + ny] = concinit
+        tile = eval_shared([plume], ylist, [(slice(None), slice(None))])[0]
+        result = np.hstack((plumey.reshape(-1, 1), tile))
+        result = result[~np.all(result <= threshold, axis=1)]
+        result = result[:, ~np.all(result <= threshold, axis=0)]
+
+        source_rows = result[:, 0] != 0
+        mass_in = (concinit - dispx * (result[source_rows, 1].astype(np.float64) - concinit) / cell_size).sum()
+        reductions = [(result > threshold).sum() * cell_size ** 2, mass_in,
+                      result[:, 1:].sum(dtype=np.float64), float(result[result.shape[0] // 2, -1])]
+        y_lower = -result.shape[0] * cell_size / 2
+        dtypes = [result.dtype]
+        for order in (0, 1):
+            warped = warp_array(result, 0.0, y_lower, cell_size, rotation(angle, (0.0, 0.0)),
+                                rotation(-angle, (0.0, 0.0)), order=order)[0]
+            warped[warped <= threshold] = 0
+            dtypes.append(warped.dtype)
+            reductions += [np.count_nonzero(warped) * cell_size ** 2, warped.sum(dtype=np.float64) * cell_size ** 2]
+        results[np.dtype(dtype).name] = (dtypes, reductions)
+    set_plume_dtype(current)
+
+    (_, reductions64), (dtypes32, reductions32) = results["float64"], results["float32"]
+    # the plume and both warped tiles are float32, otherwise the comparison would not test the float32 path
+    if any(dtype32 != np.float32 for dtype32 in dtypes32):
+        raise AssertionError("The float32 plume or its warped tiles are not float32: {}".format(dtypes32))
+    names = ["area", "mass input rate", "downstream sum", "end concentration",
+             "warped area", "warped sum", "bilinear warped area", "bilinear warped sum"]
+    tolerances = [area_tolerance, mass_tolerance, mass_tolerance, mass_tolerance] + [area_tolerance, mass_tolerance] * 2
+    failed = False
+    errors = {}
+    print("float32 plume ({}):".format(", ".join(np.dtype(dtype32).name for dtype32 in dtypes32)))
+    for name, value32, value64, tolerance in zip(names, reductions32, reductions64, tolerances):
+        errors[name] = abs(value32 - value64) / abs(value64)
+        failed = failed or errors[name] > tolerance
+        print("    {:20s} {:.6g} vs {:.6g} ({:.1e})".format(name, value32, value64, errors[name]))
+    if failed:
+        raise AssertionError("float32 plume differs from the float64 plume")
+    return errors
+
+
+def benchmark_adaptive_grid(length=5000.0, cell_size=1.0, threshold=1e-6, tolerances=(1e-2, 1e-3, 1e-4),
+                            name="DomenicoRobbinsSSDecay2D"):
+    """Compare the multi-resolution plume grid of SeparablePlume.adaptive_columns with the uniform grid
+
+    A slowly decaying plume along a length path is evaluated once per cell and on the adaptive columns, which are
+    interpolated back to every cell (as warp_array samples them). Report the columns, the time and the largest
+    error relative to the peak, the relative change of the area above the threshold and of the summed mass.
+    """
+    import time
+    from PlumeWarp import interpolate_columns, column_weights
+
+    dr = DomenicoRobbins(name, 40, 2.113, 0.234, 0.234, 12, 1.5, 0.0008, 0.1, -1)
+    xlist = np.arange(1, math.ceil(length / cell_size) + 1) * cell_size
+    start = time.perf_counter()
+    plume = dr.separable(xlist)
+    edge = math.ceil(plume.half_widths(threshold).max(initial=0) / cell_size) + 2
+    ylist = np.arange(-edge, edge + 1) * cell_size
+    stop = int(np.flatnonzero(plume.half_widths(threshold))[-1]) + 1
+    reference = eval_shared([plume], ylist, [(slice(None), slice(0, stop))])[0]
+    elapsed = time.perf_counter() - start
+    area = (reference > threshold).sum()
+    mass = reference.sum()
+    print("uniform  {} x {} cells, {:.3f} s".format(len(ylist), stop, elapsed))
+
+    results = []
+    for tolerance in tolerances:
+        start = time.perf_counter()
+        plume = dr.separable(xlist)
+        columns = plume.adaptive_columns(threshold, tolerance)
+        tile = eval_shared([plume.select(columns)], ylist, [(slice(None), slice(None))])[0]
+        elapsed_adaptive = time.perf_counter() - start
+        full = interpolate_columns(tile, columns, np.arange(stop))
+        error = np.abs(full - reference).max() / reference.max()
+        area_error = abs((full > threshold).sum() - area) / area
+        mass_error = abs((tile * column_weights(columns)).sum() - mass) / mass
+        print("tol {:.0e} {} x {} cells ({:.1%}), {:.3f} s ({:.1f} x faster), max error {:.1e}, "
+              "area {:.1e}, mass {:.1e}".format(tolerance, len(ylist), len(columns), len(columns) / stop,
+                                                 elapsed_adaptive, elapsed / elapsed_adaptive, error, area_error,
+                                                 mass_error))
+        results.append((tolerance, len(columns), error, area_error, mass_error))
+    return results
+
+
+def check_cut_statistics(cases=((0.0005, 600.0), (0.008, 100.0)), length=2000.0, cell_size=1.0, threshold=1e-6,
+                         tolerance=1e-3, max_error=1e-2):
+    """Compare the plume statistics of the multi-resolution plume with the uniform plume when max_dist cuts it
+
+    For every (decay coefficient, max_dist) the plume is built the way the Transport tool does, a source column
+    followed by the plume on every cell or on the adaptive columns, and both plumes are cut at max_dist. The area
+    above the threshold and the summed concentration downstream of the source of column_reductions must agree within
+    max_error, the concentration at the water body within tolerance times the source concentration, the error
+    bound of the adaptive columns.
+    """
+    from PlumeWarp import column_reductions
 
-            erfy_p1_withinf = np.where(np.isnan(erfy_p1),  np.inf, erfy_p1)
-            erfy_p2_withinf = np.where(np.isnan(erfy_p2), -np.inf, erfy_p2)
+    concinit, Y = 40.0, 12.0
+    ny = int(Y / cell_size)
+    results = []
+    for k, max_dist in cases:
+        dr = DomenicoRobbins("DomenicoRobbinsSSDecay2D", concinit, 2.113, 0.234, 0.234, Y, 1.5, k, 0.1, -1)
+        plume = dr.separable(np.arange(1, math.ceil(length / cell_size) + 1) * cell_size)
+        edge = max(math.ceil(plume.half_widths(threshold).max(initial=0) / cell_size) + 2, math.ceil(ny / 2) + 1)
+        ylist = np.arange(-edge, edge + ny % 2) * cell_size
+        plumey = np.zeros((len(ylist), 1), dtype=plume_dtype)
+        plumey[edge - ny // 2:edge - ny // 2 + ny] = concinit
+        subset = plume.adaptive_columns(threshold, tolerance)
+        uniform = np.hstack((plumey, eval_shared([plume], ylist, [(slice(None), slice(0, len(subset) and
+                                                                                   subset[-1] + 1))])[0]))
+        adaptive = np.hstack((plumey, eval_shared([plume.select(subset)], ylist, [(slice(None), slice(None))])[0]))
+        columns = np.concatenate(([0], subset + 1))
 
-            return self.s * 2 * (vertorized_erfc(x - self.vt + correction) / self.xden)\
-                * (vertorized_erf(erfy_p1_withinf) - vertorized_erf(erfy_p2_withinf))
+        plumelen = min(int(max_dist / cell_size), uniform.shape[1])
+        wb_col = plumelen - 1
+        reference = column_reductions(uniform, None, plumelen, wb_col, threshold)
+        reductions = column_reductions(adaptive, columns, plumelen, wb_col, threshold)
+        errors = [abs(reductions[1] - reference[1]) / reference[1], abs(reductions[3] - reference[3]) / reference[3],
+                  abs(reductions[4] - reference[4]) / concinit]
+        print("k {} max_dist {} cut {} of {} cells: area {:.1e}, downstream sum {:.1e}, water body "
+              "concentration {:.1e} of the source".format(k, max_dist, plumelen, uniform.shape[1], *errors))
+        assert max(errors[:2]) < max_error and errors[2] < tolerance, \
+            "statistics of the cut multi-resolution plume differ by {:.1e}".format(max(errors))
+        results.append(errors)
+    return results
 
 
 if __name__ == "__main__":
-    pass
+    check_eval_broadcast()
+    benchmark_eval_memory()
+    benchmark_erf_backends()
+    benchmark_batch_half_widths()
+    benchmark_batch_half_widths(lengths=(100.0, 2000.0))
+    check_plume_dtypes()
+    benchmark_adaptive_grid()
+    check_cut_statistics()
@@ -198,6 +198,99 @@ class InterfaceTransport(object):
                                   )
         option6.value = 400
 
+        option7 = arcpy.Parameter(name="Special function backend",
+                                  displayName="Special function backend",
+                                  datatype="String",
+                                  parameterType="Optional",  # Required|Optional|Derived
+                                  direction="Input",  # Input|Output
+                                  category="Solution Options",  # Category
+                                  )
+        choices = ['SciPy', 'Rational', 'Math']
+        option7.filter.type = "ValueList"
+        option7.filter.list = choices
+        option7.value = choices[0]
+
+        option8 = arcpy.Parameter(name="Plume precision",
+                                  displayName="Plume precision",
+                                  datatype="String",
+                                  parameterType="Optional",  # Required|Optional|Derived
+                                  direction="Input",  # Input|Output
+                                  category="Solution Options",  # Category
+                                  )
+        choices = ['Float64', 'Float32']
+        option8.filter.type = "ValueList"
+        option8.filter.list = choices
+        option8.value = choices[0]
+
+        option9 = arcpy.Parameter(name="Output times [d]",
+                                  displayName="Output times [d]",
+                                  datatype="GPDouble",
+                                  parameterType="Optional",  # Required|Optional|Derived
+                                  direction="Input",  # Input|Output
+                                  category="Solution Options",  # Category
+                                  multiValue=True)
+
+        option10 = arcpy.Parameter(name="Lateral kernel cache folder",
+                                   displayName="Lateral kernel cache folder",
+                                   datatype="DEFolder",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+
+        option11 = arcpy.Parameter(name="Output depths [m]",
+                                   displayName="Output depths [m]",
+                                   datatype="GPDouble",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   multiValue=True)
+
+        option12 = arcpy.Parameter(name="Plume warping engine",
+                                   displayName="Plume warping engine",
+                                   datatype="String",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+        choices = ['NumPy', 'ArcGIS']
+        option12.filter.type = "ValueList"
+        option12.filter.list = choices
+        option12.value = choices[0]
+
+        option13 = arcpy.Parameter(name="Parallel workers",
+                                   displayName="Parallel workers",
+                                   datatype="Long",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+        option13.value = 1
+
+        option14 = arcpy.Parameter(name="Source cache folder",
+                                   displayName="Source cache folder",
+                                   datatype="DEFolder",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+
+        option15 = arcpy.Parameter(name="Tile size [m]",
+                                   displayName="Tile size [m]",
+                                   datatype="Double",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+
+        option16 = arcpy.Parameter(name="Plume grid tolerance",
+                                   displayName="Plume grid tolerance",
+                                   datatype="Double",
+                                   parameterType="Optional",  # Required|Optional|Derived
+                                   direction="Input",  # Input|Output
+                                   category="Solution Options",  # Category
+                                   )
+
         param0 = arcpy.Parameter(name="Mass input of nitrogen [mg/d]",
                                  displayName="Mass input of nitrogen [mg/d]",
                                  datatype="Double",
@@ -439,7 +532,9 @@ class InterfaceTransport(object):
                 no3param0, no3param1, no3param2, no3param3,                              # 27 - 30
                 nh4param0, nh4param1, nh4param2, nh4param3, nh4param5,                   # 31 - 35
                 phosparam0, phosparam1, phosparam2, phosparam3, phosparam4, phosparam5,  # 36 - 41
-                phosparam6, phosparam7]                                                  # 42 - 43
+                phosparam6, phosparam7,                                                  # 42 - 43
+                option7, option8, option9, option10, option11, option12, option13,       # 44 - 50
+                option14, option15, option16]                                            # 51 - 53
 
     def isLicensed(self) -> bool:
         """Set whether tool is licensed to execute."""
@@ -771,6 +866,16 @@ class InterfaceTransport(object):
             parameters[43].setErrorMessage("Maximum sorption capacity must be a positive number.")
         if parameters[41].value is not None and parameters[41].value < 0:
             parameters[41].setErrorMessage("Linear distribution coefficient must be a positive number.")
+        if parameters[46].values is not None and any(value <= 0 for value in parameters[46].values):
+            parameters[46].setErrorMessage("Output times must be positive numbers.")
+        if parameters[48].values is not None and any(value < 0 for value in parameters[48].values):
+            parameters[48].setErrorMessage("Output depths must be positive numbers.")
+        if parameters[50].value is not None and parameters[50].value < 0:
+            parameters[50].setErrorMessage("Parallel workers must be a non-negative integer.")
+        if parameters[52].value is not None and parameters[52].value < 0:
+            parameters[52].setErrorMessage("Tile size must be a non-negative number.")
+        if parameters[53].value is not None and not 0 <= parameters[53].value < 1:
+            parameters[53].setErrorMessage("Plume grid tolerance must be between 0 and 1.")
         return
 
     def execute(self, parameters, messages) -> None:
@@ -837,6 +942,16 @@ class InterfaceTransport(object):
         phoparam5 = parameters[41].value
         phoparam6 = parameters[42].value
         phoparam7 = parameters[43].value
+        option7 = parameters[44].valueAsText
+        option8 = parameters[45].valueAsText
+        option9 = parameters[46].valueAsText
+        option10 = parameters[47].valueAsText
+        option11 = parameters[48].valueAsText
+        option12 = parameters[49].valueAsText
+        option13 = parameters[50].value
+        option14 = parameters[51].valueAsText
+        option15 = parameters[52].value
+        option16 = parameters[53].value
 
         # Okay finally go ahead and do the work.
         try:
@@ -847,7 +962,8 @@ class InterfaceTransport(object):
                            no3param0, no3param1, no3param2, no3param3,
                            nh4param0, nh4param1, nh4param2, nh4param3, nh4param4,
                            poutput, poutputinfo, phoparam0, phoparam1, phoparam2, phoparam3, phoparam4, phoparam5,
-                           phoparam6, phoparam7)
+                           phoparam6, phoparam7, option7, option8, option9,
+                           option10, option11, option12, option13, option14, option15, option16)
 
             TP.main()
             current_time = time.strftime("%H:%M:%S", time.localtime())
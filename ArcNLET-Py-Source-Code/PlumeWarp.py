@@ -0,0 +1,456 @@
+"""
+This script contains the NumPy plume warping engine.
+
+The reference plume is computed on a straight grid starting at the source and bent along the flow path by a
+transformation fitted to the control points of Transport.get_control_points / get_target_points_gis, the same
+points passed to arcpy.management.Warp. Polynomial (order 1 and 2) and thin plate spline transformations are
+supported, matching the POLYORDER1, POLYORDER2 and SPLINE methods of Warp. The warped plume is sampled with
+scipy.ndimage.map_coordinates directly on a grid snapped to the water body raster, so no geoprocessing tool is
+needed and the module runs without arcpy. PlumeCanvas sums the warped plumes of many sources on the same grid.
+"""
+import math
+import os
+import tempfile
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+
+# output cells evaluated at a time, bounds the memory of the thin plate spline (cells x control points)
+CHUNK_CELLS = 2 ** 16
+# canvases larger than this are memory-mapped files instead of arrays
+CANVAS_MEMORY_CELLS = 2 ** 26
+
+
+class PolynomialTransform:
+    """Least squares polynomial transformation of order 1 (affine) or 2 between two sets of points"""
+    def __init__(self, order=1):
+        if order not in (1, 2):
+            raise ValueError("Invalid polynomial order: {}".format(order))
+        self.order = order
+        self.origin = np.zeros(2)
+        self.coef = None
+
+    def terms(self, points):
+        """Polynomial terms of points relative to the origin of the fit"""
+        x = points[:, 0] - self.origin[0]
+        y = points[:, 1] - self.origin[1]
+        if self.order == 1:
+            return np.column_stack((np.ones_like(x), x, y))
+        return np.column_stack((np.ones_like(x), x, y, x * x, x * y, y * y))
+
+    def fit(self, source, target):
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        if len(source) < (3 if self.order == 1 else 6):
+            raise ValueError("Not enough control points for a polynomial of order {}".format(self.order))
+        self.origin = source.mean(axis=0)
+        self.coef = np.linalg.lstsq(self.terms(source), target, rcond=None)[0]
+        return self
+
+    def __call__(self, points):
+        return self.terms(np.asarray(points, dtype=float)) @ self.coef
+
+
+class ThinPlateSplineTransform:
+    """Thin plate spline through the control points, U(r) = r^2 log(r^2)
+
+    The control points are centered and scaled to unit size before fitting, which keeps the linear system well
+    conditioned for projected coordinates of several hundred thousand meters.
+    """
+    def __init__(self, regularization=0.0):
+        self.regularization = regularization
+        self.origin = np.zeros(2)
+        self.scale = 1.0
+        self.centers = None
+        self.weights = None
+        self.affine = None
+
+    @staticmethod
+    def kernel(points, centers):
+        r2 = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(r2 > 0, r2 * np.log(r2), 0.0)
+
+    def fit(self, source, target):
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        if len(source) < 3:
+            raise ValueError("Not enough control points for a thin plate spline")
+        self.origin = source.mean(axis=0)
+        self.scale = max(np.abs(source - self.origin).max(), 1e-12)
+        centers = (source - self.origin) / self.scale
+        n = len(centers)
+        p = np.column_stack((np.ones(n), centers))
+        system = np.zeros((n + 3, n + 3))
+        system[:n, :n] = self.kernel(centers, centers) + self.regularization * np.eye(n)
+        system[:n, n:] = p
+        system[n:, :n] = p.T
+        rhs = np.zeros((n + 3, 2))
+        rhs[:n] = target
+        try:
+            solution = np.linalg.solve(system, rhs)
+        except np.linalg.LinAlgError:
+            # duplicated control points
+            solution = np.linalg.lstsq(system, rhs, rcond=None)[0]
+        self.centers = centers
+        self.weights = solution[:n]
+        self.affine = solution[n:]
+        return self
+
+    def __call__(self, points):
+        points = (np.asarray(points, dtype=float) - self.origin) / self.scale
+        return (self.kernel(points, self.centers) @ self.weights + self.affine[0]
+                + points @ self.affine[1:])
+
+
+def fit_transform(method, source, target):
+    """Transformation from the source to the target points for the warping method spline, polyorder1 or polyorder2"""
+    method = method.lower()
+    if method == "spline":
+        return ThinPlateSplineTransform().fit(source, target)
+    elif method == "polyorder1":
+        return PolynomialTransform(1).fit(source, target)
+    elif method == "polyorder2":
+        return PolynomialTransform(2).fit(source, target)
+    raise ValueError("Invalid warping method: {}".format(method))
+
+
+def rotation(angle, pivot):
+    """Counterclockwise rotation by angle [rad] about pivot as a PolynomialTransform"""
+    transform = PolynomialTransform(1)
+    transform.origin = np.asarray(pivot, dtype=float)
+    cos, sin = math.cos(angle), math.sin(angle)
+    transform.coef = np.array([[pivot[0], pivot[1]], [cos, sin], [-sin, cos]])
+    return transform
+
+
+def snapped_grid(xmin, ymin, xmax, ymax, cell_size, snap_x=0.0, snap_y=0.0):
+    """Grid covering the bounds with cell edges on snap_x + i * cell_size, snap_y + j * cell_size
+
+    Returns the lower left corner and the number of rows and columns.
+    """
+    x_left = snap_x + math.floor((xmin - snap_x) / cell_size) * cell_size
+    y_lower = snap_y + math.floor((ymin - snap_y) / cell_size) * cell_size
+    ncol = max(int(math.ceil((xmax - x_left) / cell_size)), 1)
+    nrow = max(int(math.ceil((ymax - y_lower) / cell_size)), 1)
+    return x_left, y_lower, nrow, ncol
+
+
+def column_index(positions, columns):
+    """Fractional indices into the columns of a multi-resolution plume for positions in cells
+
+    columns, increasing positions of the array columns in cells. Positions between two columns are interpolated
+    linearly, positions outside of the array continue with one index per cell like a uniform grid.
+    """
+    positions = np.asarray(positions, dtype=float)
+    last = len(columns) - 1
+    index = np.interp(positions, columns, np.arange(last + 1))
+    index = np.where(positions < columns[0], positions - columns[0], index)
+    return np.where(positions > columns[-1], last + positions - columns[-1], index)
+
+
+def interpolate_columns(array, columns, positions):
+    """Columns of a multi-resolution plume at the positions (in cells), interpolated linearly along the last axis"""
+    index = np.clip(column_index(positions, columns), 0, len(columns) - 1)
+    lower = np.minimum(np.floor(index).astype(np.int64), max(len(columns) - 2, 0))
+    upper = np.minimum(lower + 1, len(columns) - 1)
+    weight = (index - lower).astype(array.dtype)
+    return array[..., lower] * (1 - weight) + array[..., upper] * weight
+
+
+def column_weights(columns):
+    """Weights w of the columns with sum(w * values) = the sum of the values interpolated to every cell
+
+    The weights are the trapezoid rule over the column positions plus half a cell at both ends, all ones for
+    consecutive columns.
+    """
+    columns = np.asarray(columns, dtype=float)
+    weights = np.zeros(len(columns))
+    spacing = np.diff(columns) / 2
+    weights[:-1] += spacing
+    weights[1:] += spacing
+    if len(weights):
+        weights[0] += 0.5
+        weights[-1] += 0.5
+    return weights
+
+
+def truncate_columns(array, columns, length):
+    """Cells 0 to length - 1 of a multi-resolution plume, returns (array, columns)
+
+    If the cut falls between two columns a column is interpolated at length - 1, so the column weights cover the
+    same cells as the uniform plume cut at length.
+    """
+    ncol = int(np.searchsorted(columns, length))
+    if ncol == 0 or ncol == len(columns) or columns[ncol - 1] == length - 1:
+        return array[..., :ncol], columns[:ncol]
+    last = interpolate_columns(array, columns, [length - 1])
+    return np.concatenate((array[..., :ncol], last), axis=-1), np.append(columns[:ncol], length - 1)
+
+
+def column_reductions(plume, columns, length, position, threshold):
+    """Reductions of the cells 0 to length - 1 of a plume, see Transport.plume_statistics
+
+    columns, cell of every column of a multi-resolution plume, None for a plume with one column per cell
+    position, cell of the concentration on the center row (the water body), -1 for the last cell
+    Returns the cut plume (its columns), the number of cells above the threshold, the column next to the source
+    (None for a plume of one cell), the summed concentration downstream of the source and the concentration at
+    the position. The sums of a multi-resolution plume are the sums over its columns interpolated to every cell.
+    """
+    if columns is None:
+        result = plume[:, 0: length]
+        nrow, ncol = result.shape
+        area = np.count_nonzero(result > threshold)
+        next_column = result[:, 1] if ncol > 1 else None
+        downstream_sum = result[:, 1:].sum()
+        return result, area, next_column, downstream_sum, result[nrow // 2, min(position, ncol - 1)]
+
+    result, cut = truncate_columns(plume, columns, length)
+    weights = column_weights(cut)
+    area = (np.count_nonzero(result > threshold, axis=0) * weights).sum()
+    next_column = interpolate_columns(result, cut, [1])[:, 0] if cut[-1] > 0 else None
+    # the cells downstream of the source are all cells but the source column
+    downstream_sum = (result.sum(axis=0) * weights).sum() - result[:, 0].sum()
+    conc = interpolate_columns(plume[plume.shape[0] // 2], columns, position if position >= 0 else cut[-1])
+    return result, area, next_column, downstream_sum, conc
+
+
+def warp_array(array, x_left, y_lower, cell_size, forward, inverse, snap_x=0.0, snap_y=0.0, order=1,
+               max_growth=16, columns=None):
+    """
+    Warp a raster array onto a grid snapped to (snap_x, snap_y)
+
+    array, values with the first row at the top, cells <= 0 or nan are treated as empty
+    x_left, y_lower, lower left corner of the array
+    forward, transformation from the array coordinates to the target coordinates, used for the extent
+    inverse, transformation from the target coordinates back to the array coordinates, used for sampling
+    order, 1 for bilinear and 0 for nearest neighbor sampling
+    max_growth, largest ratio of the output to the input cells, larger extents mean the transformation is
+                folded or extrapolates wildly and raise ValueError
+    columns, positions of the array columns in cells for multi-resolution plumes, None for one column per cell.
+             The plume is interpolated linearly between the columns, so it is sampled as if it had every cell.
+
+    Returns the warped array (first row at the top, zeros outside of the plume) in the precision of the array and its
+    lower left corner.
+    """
+    values = np.asarray(array)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    values = np.nan_to_num(values)
+    nrow = values.shape[0]
+    ncol = values.shape[1] if columns is None else int(columns[-1]) + 1
+    y_top = y_lower + nrow * cell_size
+
+    # the extent is the image of the array outline
+    steps = max(nrow, ncol) + 1
+    edge = np.linspace(0.0, 1.0, steps)
+    outline_x = x_left + ncol * cell_size * np.concatenate((edge, np.ones(steps), edge, np.zeros(steps)))
+    outline_y = y_lower + nrow * cell_size * np.concatenate((np.zeros(steps), edge, np.ones(steps), edge))
+    outline = forward(np.column_stack((outline_x, outline_y)))
+    if not np.isfinite(outline).all():
+        raise ValueError("Warp error!")
+    xmin, ymin = outline.min(axis=0) - cell_size
+    xmax, ymax = outline.max(axis=0) + cell_size
+    out_x, out_y, out_nrow, out_ncol = snapped_grid(xmin, ymin, xmax, ymax, cell_size, snap_x, snap_y)
+    if out_nrow * out_ncol > max_growth * nrow * ncol + 4 * (nrow + ncol) ** 2:
+        raise ValueError("Warp error!")
+
+    warped = np.zeros((out_nrow, out_ncol), dtype=values.dtype)
+    centers_x = out_x + (np.arange(out_ncol) + 0.5) * cell_size
+    out_top = out_y + out_nrow * cell_size
+    chunk_rows = max(CHUNK_CELLS // out_ncol, 1)
+    for row_start in range(0, out_nrow, chunk_rows):
+        row_stop = min(row_start + chunk_rows, out_nrow)
+        centers_y = out_top - (np.arange(row_start, row_stop) + 0.5) * cell_size
+        grid_x, grid_y = np.meshgrid(centers_x, centers_y)
+        source = inverse(np.column_stack((grid_x.ravel(), grid_y.ravel())))
+        cols = (source[:, 0] - x_left) / cell_size - 0.5
+        rows = (y_top - source[:, 1]) / cell_size - 0.5
+        if columns is not None:
+            if order == 0:
+                # nearest cell of the full grid, whose value is interpolated between the columns
+                cols = np.floor(cols + 0.5)
+                rows = np.floor(rows + 0.5)
+            cols = column_index(cols, columns)
+        warped[row_start:row_stop] = map_coordinates(values, [rows, cols], order=order if columns is None else 1,
+                                                     mode='grid-constant', cval=0.0,
+                                                     output=values.dtype).reshape(grid_x.shape)
+    return warped, out_x, out_y
+
+
+def resample_array(array, x_left, y_lower, cell_width, cell_height, cell_size, snap_x=0.0, snap_y=0.0, order=0):
+    """
+    Resample a raster array onto a grid of cell_size snapped to (snap_x, snap_y), in the precision of the array
+
+    array, values with the first row at the top, nan for nodata
+    cell_width, cell_height, cell size of the array
+    order, 0 for nearest neighbor and 1 for bilinear sampling. An output cell has data where its nearest input cell
+           has data, the bilinear weights of the nodata cells are dropped so the plume edges keep their values.
+
+    Returns the resampled array (first row at the top, nan for nodata) and its lower left corner.
+    """
+    values = np.asarray(array)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    nrow, ncol = values.shape
+    y_top = y_lower + nrow * cell_height
+    out_x, out_y, out_nrow, out_ncol = snapped_grid(x_left, y_lower, x_left + ncol * cell_width, y_top, cell_size,
+                                                    snap_x, snap_y)
+    out_top = out_y + out_nrow * cell_size
+    # output cell centers in fractional input indices, input cell centers are on whole numbers
+    cols = (out_x + (np.arange(out_ncol) + 0.5) * cell_size - x_left) / cell_width - 0.5
+    rows = (y_top - out_top + (np.arange(out_nrow) + 0.5) * cell_size) / cell_height - 0.5
+    nearest_cols = np.floor(cols + 0.5).astype(int)
+    nearest_rows = np.floor(rows + 0.5).astype(int)
+    inside_cols = (nearest_cols >= 0) & (nearest_cols < ncol)
+    inside_rows = (nearest_rows >= 0) & (nearest_rows < nrow)
+
+    resampled = np.full((out_nrow, out_ncol), np.nan, dtype=values.dtype)
+    window = np.ix_(inside_rows, inside_cols)
+    resampled[window] = values[np.ix_(nearest_rows[inside_rows], nearest_cols[inside_cols])]
+    if order == 0:
+        return resampled, out_x, out_y
+
+    valid = np.isfinite(values)
+    filled = np.where(valid, values, 0)
+    weights = valid.astype(values.dtype)
+    interpolated = np.zeros((out_nrow, out_ncol), dtype=values.dtype)
+    total = np.zeros((out_nrow, out_ncol), dtype=values.dtype)
+    chunk_rows = max(CHUNK_CELLS // out_ncol, 1)
+    for row_start in range(0, out_nrow, chunk_rows):
+        row_stop = min(row_start + chunk_rows, out_nrow)
+        grid_cols, grid_rows = np.meshgrid(cols, rows[row_start:row_stop])
+        coordinates = [grid_rows.ravel(), grid_cols.ravel()]
+        interpolated[row_start:row_stop] = map_coordinates(filled, coordinates, order=1, mode='nearest',
+                                                           output=values.dtype).reshape(grid_cols.shape)
+        total[row_start:row_stop] = map_coordinates(weights, coordinates, order=1, mode='nearest',
+                                                    output=values.dtype).reshape(grid_cols.shape)
+    has_data = np.isfinite(resampled) & (total > 0)
+    resampled[has_data] = interpolated[has_data] / total[has_data]
+    return resampled, out_x, out_y
+
+
+class PlumeCanvas:
+    """Study area array that accumulates the plumes of many sources by offset
+
+    Cells are aligned with (snap_x, snap_y), i.e. the water body raster, and tiles on the same grid are added
+    in place, replacing one Mosaic of the output raster per source. The canvas covers the tiles added so far
+    and grows on demand; canvases above max_memory_cells are backed by a temporary file in directory.
+    """
+    def __init__(self, cell_size, snap_x=0.0, snap_y=0.0, dtype=np.float32, max_memory_cells=CANVAS_MEMORY_CELLS,
+                 directory=None):
+        self.cell_size = cell_size
+        self.snap_x = snap_x
+        self.snap_y = snap_y
+        self.dtype = dtype
+        self.max_memory_cells = max_memory_cells
+        self.directory = directory
+        self.array = None
+        self.filename = None
+        # covered cells in grid indices, columns from snap_x and rows upwards from snap_y
+        self.col_start = self.col_stop = self.row_start = self.row_stop = 0
+
+    def add(self, array, x_lower_left, y_lower_left):
+        """Add a tile (first row at the top) with the given lower left corner, nan cells are skipped"""
+        nrow, ncol = array.shape
+        col = int(round((x_lower_left - self.snap_x) / self.cell_size))
+        row = int(round((y_lower_left - self.snap_y) / self.cell_size))
+        self.reserve(col, row, col + ncol, row + nrow)
+        top = self.row_stop - row - nrow
+        left = col - self.col_start
+        self.array[top:top + nrow, left:left + ncol] += np.nan_to_num(array).astype(self.dtype, copy=False)
+
+    def reserve(self, col_start, row_start, col_stop, row_stop):
+        """Grow the canvas to cover the cells, with room for the next tiles"""
+        if self.array is not None and col_start >= self.col_start and row_start >= self.row_start and \
+                col_stop <= self.col_stop and row_stop <= self.row_stop:
+            return
+        if self.array is None:
+            margin = max(col_stop - col_start, row_stop - row_start)
+            new_bounds = (col_start - margin, row_start - margin, col_stop + margin, row_stop + margin)
+        else:
+            margin = max(self.col_stop - self.col_start, self.row_stop - self.row_start) // 2
+            new_bounds = (min(col_start, self.col_start - margin) if col_start < self.col_start else self.col_start,
+                          min(row_start, self.row_start - margin) if row_start < self.row_start else self.row_start,
+                          max(col_stop, self.col_stop + margin) if col_stop > self.col_stop else self.col_stop,
+                          max(row_stop, self.row_stop + margin) if row_stop > self.row_stop else self.row_stop)
+        new_array, new_filename = self.allocate(new_bounds[3] - new_bounds[1], new_bounds[2] - new_bounds[0])
+        if self.array is not None:
+            top = new_bounds[3] - self.row_stop
+            left = self.col_start - new_bounds[0]
+            new_array[top:top + self.array.shape[0], left:left + self.array.shape[1]] = self.array
+            self.close()
+        self.array, self.filename = new_array, new_filename
+        self.col_start, self.row_start, self.col_stop, self.row_stop = new_bounds
+
+    def allocate(self, nrow, ncol):
+        if nrow * ncol <= self.max_memory_cells:
+            return np.zeros((nrow, ncol), dtype=self.dtype), None
+        handle, filename = tempfile.mkstemp(suffix=".canvas", dir=self.directory)
+        os.close(handle)
+        return np.memmap(filename, dtype=self.dtype, mode='w+', shape=(nrow, ncol)), filename
+
+    def extent(self, floor=0.0):
+        """Lower left corner and rows / columns of the cells above floor, None for an empty canvas"""
+        if self.array is None:
+            return None
+        rows = np.flatnonzero((self.array > floor).any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero((self.array[rows[0]:rows[-1] + 1] > floor).any(axis=0))
+        x_lower_left = self.snap_x + (self.col_start + cols[0]) * self.cell_size
+        y_lower_left = self.snap_y + (self.row_stop - rows[-1] - 1) * self.cell_size
+        return (x_lower_left, y_lower_left), (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+
+    def result(self, nodata=np.nan, floor=0.0, dtype=None):
+        """Summed plumes cropped to the cells above floor (other cells set to nodata) and the lower left corner
+
+        floor above 0 drops the rounding residuals left by subtract. Returns None, None for an empty canvas.
+        """
+        extent = self.extent(floor)
+        if extent is None:
+            return None, None
+        corner, (row_start, row_stop, col_start, col_stop) = extent
+        array = np.array(self.array[row_start:row_stop, col_start:col_stop], dtype=dtype or self.dtype)
+        array[array <= floor] = nodata
+        return array, corner
+
+    def subtract(self, array, x_lower_left, y_lower_left):
+        """Remove a tile added before"""
+        self.add(-np.nan_to_num(array), x_lower_left, y_lower_left)
+
+    def clip(self, col_start, row_start, col_stop, row_stop):
+        """Zero the cells outside of the window (grid indices), e.g. the halo of a spatial tile"""
+        if self.array is None:
+            return
+        top = max(0, self.row_stop - row_stop)
+        bottom = max(top, min(self.array.shape[0], self.row_stop - row_start))
+        left = max(0, col_start - self.col_start)
+        right = max(left, min(self.array.shape[1], col_stop - self.col_start))
+        self.array[:top] = 0
+        self.array[bottom:] = 0
+        self.array[top:bottom, :left] = 0
+        self.array[top:bottom, right:] = 0
+
+    @property
+    def bounds(self):
+        """Covered cells (col_start, row_start, col_stop, row_stop) in grid indices"""
+        return self.col_start, self.row_start, self.col_stop, self.row_stop
+
+    def restore(self, array, bounds):
+        """Replace the content by array (first row at the top) covering bounds, e.g. sums kept from an earlier run"""
+        self.close()
+        self.array, self.filename = self.allocate(*array.shape)
+        self.array[:] = array
+        self.col_start, self.row_start, self.col_stop, self.row_stop = bounds
+
+    def close(self):
+        """Release the array and delete the backing file"""
+        filename = self.filename
+        self.array = None
+        self.filename = None
+        if filename is not None and os.path.exists(filename):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -0,0 +1,311 @@
+"""
+This script contains the water body label grid of the transport module.
+
+The water bodies are rasterized once (arcpy.conversion.FeatureToRaster of the FIDs, the water body raster of
+Transport.main) and kept as an integer array, -1 on land. Plumes on the same grid are clipped at the water bodies
+by a connected component labelling of the plume cells, keeping the component of the source (full post process)
+or the components of any source (medium post process). This replaces the ExtractByMask, RasterToPolygon, Buffer
+and cursor round trips of the post processes.
+
+WaterBodyIndex keeps the water body polygons in memory with an STR-tree (sort-tile-recursive R-tree) of their
+bounding boxes, for the nearest water body, boundary crossing and rasterization queries of the particle tracking
+and transport modules. The module runs without arcpy, except WaterBodyIndex.read.
+
+@author: Wei Mao <wm23a@fsu.edu>
+"""
+import heapq
+import math
+import numpy as np
+from scipy.ndimage import label
+
+
+# children per node of the STR-tree
+NODE_CAPACITY = 16
+# rows of a polygon rasterized at a time, bounds the memory of rasterize (rows x edges)
+RASTER_ROWS = 256
+
+
+class WaterBodyGrid:
+    """Water body FIDs on a grid with the lower left corner (x_lower_left, y_lower_left), -1 on land
+
+    labels has the first row at the top, as returned by arcpy.RasterToNumPyArray. Without labels, the windows are
+    rasterized from the polygons of index (a WaterBodyIndex) on demand, so the grid of a large study area is never
+    held in memory.
+    """
+    def __init__(self, labels, x_lower_left, y_lower_left, cell_size, index=None):
+        self.labels = None if labels is None else np.asarray(labels, dtype=np.int32)
+        self.x_lower_left = x_lower_left
+        self.y_lower_left = y_lower_left
+        self.cell_size = cell_size
+        self.index = index
+
+    def window(self, shape, x_lower_left, y_lower_left):
+        """Labels of a tile with the given shape and lower left corner on the grid, -1 outside of the grid"""
+        nrow, ncol = shape
+        if self.labels is None:
+            # snap the tile to the grid, cells are water if their center is in a water body
+            col = round((x_lower_left - self.x_lower_left) / self.cell_size)
+            row = round((y_lower_left - self.y_lower_left) / self.cell_size)
+            return self.index.rasterize(self.x_lower_left + col * self.cell_size,
+                                        self.y_lower_left + row * self.cell_size, self.cell_size, nrow, ncol)
+        col = int(round((x_lower_left - self.x_lower_left) / self.cell_size))
+        # rows of the grid from the top
+        row = self.labels.shape[0] - int(round((y_lower_left - self.y_lower_left) / self.cell_size)) - nrow
+        window = np.full((nrow, ncol), -1, dtype=np.int32)
+        top, bottom = max(row, 0), min(row + nrow, self.labels.shape[0])
+        left, right = max(col, 0), min(col + ncol, self.labels.shape[1])
+        if top < bottom and left < right:
+            window[top - row:bottom - row, left - col:right - col] = self.labels[top:bottom, left:right]
+        return window
+
+    def components(self, array, x_lower_left, y_lower_left, threshold=0.0, maximum=None):
+        """Plume cells of a tile labelled by connected component, see scipy.ndimage.label
+
+        The plume cells are the cells above threshold (and up to maximum) on land, connected through their edges.
+        Returns the labels (0 outside of the plume) and the number of components.
+        """
+        plume = (np.nan_to_num(array) > threshold) & (self.window(array.shape, x_lower_left, y_lower_left) < 0)
+        if maximum is not None:
+            plume &= array <= maximum
+        return label(plume)
+
+    def source_labels(self, components, x_lower_left, y_lower_left, source_x, source_y):
+        """Labels of the source cells and their neighbours, rows (source) by 9 cells, 0 outside of the tile"""
+        nrow, ncol = components.shape
+        col = np.floor((np.asarray(source_x) - x_lower_left) / self.cell_size).astype(np.int64)
+        row = nrow - 1 - np.floor((np.asarray(source_y) - y_lower_left) / self.cell_size).astype(np.int64)
+        labels = np.zeros((len(col), 9), dtype=components.dtype)
+        # the source cell first, its neighbours stand in for the 1 m buffer of the polygons
+        offsets = [(0, 0)] + [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+        for index, (dr, dc) in enumerate(offsets):
+            inside = (row + dr >= 0) & (row + dr < nrow) & (col + dc >= 0) & (col + dc < ncol)
+            labels[inside, index] = components[row[inside] + dr, col[inside] + dc]
+        return labels
+
+    def clip(self, array, x_lower_left, y_lower_left, source_x, source_y, threshold=0.0, maximum=None):
+        """Cells of a plume tile connected to the source without crossing a water body, others set to 0
+
+        The source is the cell of (source_x, source_y), or its neighbours if the source cell is not a plume cell.
+        Returns None if no plume cell touches the source.
+        """
+        components, number = self.components(array, x_lower_left, y_lower_left, threshold, maximum)
+        if number == 0:
+            return None
+        seeds = self.source_labels(components, x_lower_left, y_lower_left, [source_x], [source_y])[0]
+        if seeds[0] > 0:
+            seed = seeds[0]
+        elif seeds.any():
+            # the component with the most cells next to the source
+            seed = np.bincount(seeds, minlength=number + 1)[1:].argmax() + 1
+        else:
+            return None
+        return np.where(components == seed, np.nan_to_num(array), 0)
+
+    def select(self, array, x_lower_left, y_lower_left, source_x, source_y, threshold=0.0, maximum=None):
+        """Cells of the plume components with a source (medium post process), others set to 0
+
+        One labelling of the tile, the components are looked up at the cells of all sources at once.
+        """
+        components, number = self.components(array, x_lower_left, y_lower_left, threshold, maximum)
+        keep = np.zeros(number + 1, dtype=bool)
+        keep[self.source_labels(components, x_lower_left, y_lower_left, source_x, source_y).ravel()] = True
+        keep[0] = False
+        return np.where(keep[components], np.nan_to_num(array), 0)
+
+
+class WaterBodyIndex:
+    """Water body polygons with an STR-tree of their bounding boxes
+
+    fids, the FIDs of the water bodies, rings, per water body the (n, 2) vertex arrays of its outer and inner rings.
+    The point in polygon tests use the even-odd rule over all rings, so the inner rings are holes.
+    """
+    def __init__(self, fids, rings):
+        self.fids = np.asarray(fids, dtype=np.int64)
+        # edges (x0, y0, x1, y1) of all rings of a water body
+        self.edges = []
+        boxes = np.empty((len(self.fids), 4))
+        for position, polygon in enumerate(rings):
+            edges = [np.hstack((ring, np.roll(ring, -1, axis=0))) for ring in (np.asarray(r, dtype=float)
+                                                                               for r in polygon) if len(ring) > 2]
+            edges = np.vstack(edges) if edges else np.empty((0, 4))
+            self.edges.append(edges)
+            if len(edges):
+                boxes[position] = (edges[:, 0].min(), edges[:, 1].min(), edges[:, 0].max(), edges[:, 1].max())
+            else:
+                boxes[position] = (np.inf, np.inf, -np.inf, -np.inf)
+        self.boxes = boxes
+        self.positions = {fid: position for position, fid in enumerate(self.fids.tolist())}
+        self.levels = self.build(boxes)
+
+    @classmethod
+    def read(cls, feature_class):
+        """Read the polygons of a water body feature class with one cursor"""
+        import arcpy
+        fids = []
+        rings = []
+        with arcpy.da.SearchCursor(feature_class, ["OID@", "SHAPE@"]) as cursor:
+            for fid, shape in cursor:
+                polygon = []
+                for part in (shape or []):
+                    ring = []
+                    for point in part:
+                        if point is None:
+                            # the next ring of the part is an inner ring
+                            polygon.append(ring)
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    polygon.append(ring)
+                fids.append(fid)
+                rings.append([ring for ring in polygon if len(ring) > 2])
+        return cls(fids, rings)
+
+    @staticmethod
+    def build(boxes):
+        """STR-tree levels from the leaves up, the children of node i are i * NODE_CAPACITY ... of the level below
+
+        Returns (order, [node boxes of each level]) where order sorts the water bodies into the leaves.
+        """
+        number = len(boxes)
+        if number == 0:
+            return np.zeros(0, dtype=np.int64), []
+        centers = np.column_stack(((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2))
+        centers = np.nan_to_num(centers, nan=0.0, posinf=0.0, neginf=0.0)
+        # sort by x into vertical slices, then by y within the slices
+        slices = max(1, math.ceil(math.sqrt(math.ceil(number / NODE_CAPACITY))))
+        order = np.argsort(centers[:, 0], kind="stable")
+        slice_size = slices * NODE_CAPACITY
+        order = np.concatenate([part[np.argsort(centers[part, 1], kind="stable")]
+                                for part in np.array_split(order, range(slice_size, number, slice_size))])
+        levels = []
+        level = boxes[order]
+        while True:
+            starts = np.arange(0, len(level), NODE_CAPACITY)
+            nodes = np.column_stack((np.minimum.reduceat(level[:, 0], starts), np.minimum.reduceat(level[:, 1], starts),
+                                     np.maximum.reduceat(level[:, 2], starts), np.maximum.reduceat(level[:, 3], starts)))
+            levels.append(nodes)
+            if len(nodes) == 1:
+                break
+            level = nodes
+        return order, levels
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Positions of the water bodies with a bounding box intersecting the box"""
+        order, levels = self.levels
+        if not levels:
+            return np.zeros(0, dtype=np.int64)
+        nodes = np.zeros(1, dtype=np.int64)
+        for boxes in reversed(levels):
+            nodes = nodes[nodes < len(boxes)]
+            boxes = boxes[nodes]
+            nodes = nodes[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
+            # children of the nodes in the level below
+            nodes = (nodes[:, None] * NODE_CAPACITY + np.arange(NODE_CAPACITY)).ravel()
+        nodes = nodes[nodes < len(order)]
+        positions = order[nodes]
+        boxes = self.boxes[positions]
+        return positions[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
+
+    def contains(self, position, x, y):
+        """Whether the point is in the water body (even-odd rule)"""
+        edges = self.edges[position]
+        x0, y0, x1, y1 = edges.T
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        return bool(np.count_nonzero(crosses & (xs > x)) % 2)
+
+    def distance(self, position, x, y):
+        """Distance of the point to the water body, 0 inside"""
+        if self.contains(position, x, y):
+            return 0.0
+        x0, y0, x1, y1 = self.edges[position].T
+        dx, dy = x1 - x0, y1 - y0
+        length = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(length > 0, ((x - x0) * dx + (y - y0) * dy) / length, 0).clip(0, 1)
+        return float(np.hypot(x0 + t * dx - x, y0 + t * dy - y).min(initial=np.inf))
+
+    def nearest(self, x, y):
+        """FID of the nearest water body and its distance, (-1, inf) without water bodies
+
+        Best first search of the STR-tree by the distance to the bounding boxes.
+        """
+        order, levels = self.levels
+        if not levels:
+            return -1, math.inf
+
+        def box_distance(boxes):
+            dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]), 0)
+            dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0)
+            return np.hypot(dx, dy)
+
+        best_fid, best_distance = -1, math.inf
+        # (lower bound, level, node), level -1 for the water bodies
+        queue = [(0.0, len(levels) - 1, 0)]
+        while queue:
+            bound, level, node = heapq.heappop(queue)
+            if bound >= best_distance:
+                break
+            if level < 0:
+                distance = self.distance(node, x, y)
+                if distance < best_distance:
+                    best_fid, best_distance = int(self.fids[node]), distance
+                continue
+            children = np.arange(node * NODE_CAPACITY, (node + 1) * NODE_CAPACITY)
+            if level == 0:
+                children = order[children[children < len(order)]]
+                bounds = box_distance(self.boxes[children])
+            else:
+                children = children[children < len(levels[level - 1])]
+                bounds = box_distance(levels[level - 1][children])
+            for child, child_bound in zip(children.tolist(), bounds.tolist()):
+                if child_bound < best_distance:
+                    heapq.heappush(queue, (child_bound, level - 1, child))
+        return best_fid, best_distance
+
+    def crossings(self, fid, x0, y0, x1, y1):
+        """Sorted positions t (0 <= t <= 1) along the segment where it crosses the boundary of the water body fid"""
+        position = self.positions.get(fid)
+        if position is None:
+            return np.zeros(0)
+        ex0, ey0, ex1, ey1 = self.edges[position].T
+        dx, dy = x1 - x0, y1 - y0
+        ex, ey = ex1 - ex0, ey1 - ey0
+        denominator = dx * ey - dy * ex
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((ex0 - x0) * ey - (ey0 - y0) * ex) / denominator
+            u = ((ex0 - x0) * dy - (ey0 - y0) * dx) / denominator
+        hits = (denominator != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u < 1)
+        return np.sort(t[hits])
+
+    def contains_fid(self, fid, x, y):
+        """Whether the point is in the water body fid"""
+        position = self.positions.get(fid)
+        return position is not None and self.contains(position, x, y)
+
+    def rasterize(self, x_lower_left, y_lower_left, cell_size, nrow, ncol):
+        """FIDs of the water bodies at the cell centers of a grid (first row at the top), -1 on land"""
+        labels = np.full((nrow, ncol), -1, dtype=np.int32)
+        x_upper_right = x_lower_left + ncol * cell_size
+        y_upper_right = y_lower_left + nrow * cell_size
+        for position in self.query(x_lower_left, y_lower_left, x_upper_right, y_upper_right).tolist():
+            xmin, ymin, xmax, ymax = self.boxes[position]
+            # rows with the center in the bounding box
+            first = max(0, math.ceil((y_upper_right - ymax) / cell_size - 0.5))
+            last = min(nrow, math.floor((y_upper_right - ymin) / cell_size - 0.5) + 1)
+            x0, y0, x1, y1 = self.edges[position].T
+            for start in range(first, last, RASTER_ROWS):
+                rows = np.arange(start, min(start + RASTER_ROWS, last))
+                yc = (y_upper_right - (rows + 0.5) * cell_size)[:, None]
+                crosses = (y0 > yc) != (y1 > yc)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    xs = np.where(crosses, x0 + (yc - y0) * (x1 - x0) / (y1 - y0), np.inf)
+                xs.sort(axis=1)
+                for row, row_xs in zip(rows.tolist(), xs):
+                    row_xs = row_xs[:np.count_nonzero(np.isfinite(row_xs))]
+                    # cells with the center between a pair of crossings
+                    cols = np.ceil((row_xs - x_lower_left) / cell_size - 0.5).clip(0, ncol).astype(np.int64)
+                    for col_start, col_stop in zip(cols[0::2], cols[1::2]):
+                        labels[row, col_start:col_stop] = self.fids[position]
+        return labels
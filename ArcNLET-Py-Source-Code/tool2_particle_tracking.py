@@ -16,6 +16,7 @@ import time
 import datetime
 import pandas as pd
 import numpy as np
+from WaterBodyGrid import WaterBodyIndex
 # import cProfile
 
 __version__ = "V1.0.0"
@@ -63,6 +64,8 @@ class ParticleTracking:
         arcpy.conversion.FeatureToRaster(self.water_bodies, "FID", self.waterbody_raster, self.resolution)
 
         self.waterbody_array = arcpy.RasterToNumPyArray(self.waterbody_raster, nodata_to_value=-9999)
+        # polygons of the water bodies for the nearest water body and crossing queries
+        self.water_index = WaterBodyIndex.read(self.water_bodies)
         self.velocity_array = arcpy.RasterToNumPyArray(self.velocity)
         self.velocity_dir_array = arcpy.RasterToNumPyArray(self.velocity_dir)
         self.poro_array = arcpy.RasterToNumPyArray(self.poro)
@@ -90,7 +93,6 @@ class ParticleTracking:
         self.poro_cell_size = desc.meanCellWidth
 
         self.modify_seg = c_option
-        self.temp_layer_name = "temp_layer"
 
     def create_shapefile(self):
         """ Create a shapefile with the given name and spatial reference """
@@ -141,8 +143,6 @@ class ParticleTracking:
         count = arcpy.management.GetCount(self.source_location)
         segments = []
 
-        arcpy.MakeFeatureLayer_management(self.water_bodies, self.temp_layer_name)
-
         if count == 0:
             arcpy.AddError("No source location found!")
             return
@@ -217,18 +217,7 @@ class ParticleTracking:
             for xx, yy in zip(allx, ally):
                 if abs(next_x - xx) < self.step_size/100 and abs(next_y - yy) < self.step_size/100:
                     "If the next point is the same as the previous point, return the segments."
-                    point = arcpy.Point(cur_x, cur_y)
-                    point_geometry = arcpy.PointGeometry(point)
-                    min_distance = float('inf')
-                    min_fid = -1
-                    with arcpy.da.SearchCursor(self.water_bodies, ["FID", "SHAPE@"]) as cursor:
-                        for row in cursor:
-                            fid = row[0]
-                            polygon_geometry = row[1]
-                            distance = point_geometry.distanceTo(polygon_geometry)
-                            if distance < min_distance:
-                                min_distance = distance
-                                min_fid = fid
+                    min_fid, min_distance = self.water_index.nearest(cur_x, cur_y)
                     if min_distance < self.step_size/100:
                         segments[-1][-2] = int(min_fid)
                         for seg in segments:
@@ -289,40 +278,22 @@ class ParticleTracking:
         """
         if segments[-1][-2] != -1:
             water_bodies_id = segments[-1][-2]
-            # temp_layer_name = "temp_layer"
             try:
-                # arcpy.MakeFeatureLayer_management(self.water_bodies, temp_layer_name)
-                query = "FID = {}".format(water_bodies_id)
-                arcpy.SelectLayerByAttribute_management(self.temp_layer_name, "NEW_SELECTION", query)
-
-                intersect_output = r'memory\intersect'
-
-                index = 0
-                with arcpy.da.SearchCursor(self.water_bodies, ["SHAPE@"], where_clause=query) as cursor:
-                    for row in cursor:
-                        polygon = row[0]
-                        for i in range(-1, -len(segments) - 1, -1):
-                            if segments[i][0].crosses(polygon):
-                                arcpy.analysis.Intersect([self.temp_layer_name, segments[i][0]], intersect_output,
-                                                         "ALL", "", "POINT")
-                                delete_index = len(segments) + i
-                                segments = segments[: delete_index + 1]
-                                segments[-1][-2] = water_bodies_id
-                                index = 1
-                                break
-                if index == 1:
-                    with arcpy.da.SearchCursor(intersect_output, ["SHAPE@"]) as cursor:
-                        row_count = sum(1 for _ in cursor)
-                        if row_count != 0:
-                            with arcpy.da.SearchCursor(intersect_output, ["SHAPE@"]) as cursorr:
-                                for row in cursorr:
-                                    intersect_polyline = row[0]
-                                    first_x = intersect_polyline.firstPoint.X
-                                    first_y = intersect_polyline.firstPoint.Y
-                                    break
-                        else:
-                            print("No intersection found!")
-                            return segments
+                # the last segment crossing the boundary of the water body ends the path
+                crossing = None
+                for i in range(-1, -len(segments) - 1, -1):
+                    shape = segments[i][0]
+                    x0, y0 = shape.firstPoint.X, shape.firstPoint.Y
+                    x1, y1 = shape.lastPoint.X, shape.lastPoint.Y
+                    t = self.water_index.crossings(water_bodies_id, x0, y0, x1, y1)
+                    if len(t):
+                        delete_index = len(segments) + i
+                        segments = segments[: delete_index + 1]
+                        segments[-1][-2] = water_bodies_id
+                        crossing = (x0 + t[0] * (x1 - x0), y0 + t[0] * (y1 - y0))
+                        break
+                if crossing is not None:
+                    first_x, first_y = crossing
                 else:
                     first_x = segments[-1][0].lastPoint.X
                     first_y = segments[-1][0].lastPoint.Y
@@ -343,15 +314,11 @@ class ParticleTracking:
                                      segments[-1][-2], segments[-1][-1]])
                     segments[-2][-2] = -1
 
-                    arcpy.analysis.Intersect([self.temp_layer_name, intersect_polyline], intersect_output,
-                                             "ALL", "", "LINE")
-
-                    with arcpy.da.SearchCursor(intersect_output, ["SHAPE@"]) as cursor:
-                        for row in cursor:
-                            intersect_polyline = row[0]
-                            first_x = intersect_polyline.firstPoint.X
-                            first_y = intersect_polyline.firstPoint.Y
-                            break
+                    # the extended path enters the water body at the first crossing, if it starts outside
+                    if not self.water_index.contains_fid(water_bodies_id, first_x, first_y):
+                        t = self.water_index.crossings(water_bodies_id, first_x, first_y, next_x, next_y)
+                        if len(t):
+                            first_x, first_y = first_x + t[0] * (next_x - first_x), first_y + t[0] * (next_y - first_y)
 
                 origin_x = segments[-1][0].firstPoint.X
                 origin_y = segments[-1][0].firstPoint.Y
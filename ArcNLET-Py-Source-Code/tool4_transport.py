@@ -9,20 +9,28 @@ For detailed algorithms, please see https://atmos.eoas.fsu.edu/~mye/ArcNLET and
 """
 
 import datetime
+import glob
+import hashlib
+import json
+import pickle
 import shutil
 import sys
 
 import arcpy
 import os
-import tempfile
 import psutil
 import math
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pandas as pd
 from scipy.stats import hmean
 from scipy.ndimage import map_coordinates
-from DomenicoRobbins import DomenicoRobbins
+from PlumeWarp import fit_transform, rotation, warp_array, resample_array, interpolate_columns, \
+    column_reductions, PlumeCanvas
+from WaterBodyGrid import WaterBodyGrid, WaterBodyIndex
+from DomenicoRobbins import DomenicoRobbins, DomenicoRobbinsBatch, SEPARABLE_SOLUTIONS, HALF_WIDTH_TOLERANCE, \
+    eval_shared, set_erf_backend, set_plume_dtype, set_kernel_cache, LateralKernelCache
 # from tps import ThinPlateSpline
 import matplotlib.pyplot as plt
 import cProfile
@@ -41,11 +49,14 @@ class Transport:
                  c_no3param0, c_no3param1, c_no3param2, c_no3param3,
                  c_nh4param0, c_nh4param1, c_nh4param2, c_nh4param3, c_nh4param4,
                  c_poutput, c_poutput_info, phosparam0, phosparam1, phosparam2, phosparam3, phosparam4, phosparam5,
-                 phosparam6, phosparam7):
+                 phosparam6, phosparam7, c_option7="SciPy", c_option8="Float64", c_option9=None,
+                 c_option10=None, c_option11=None, c_option12="NumPy", c_option13=1,
+                 c_option14=None, c_option15=None, c_option16=None):
         """Initialize the transport module
         """
+        # the tool parameters, part of the checkpoint hash of chunked runs
+        self.arguments = {name: value for name, value in locals().items() if name != 'self'}
         self.pixeltype = "32_BIT_FLOAT"
-        self.minimum_correction = True
         self.type_of_contaminants = type_of_contaminants
         self.whether_nh4 = c_whethernh4
 
@@ -54,6 +65,8 @@ class Transport:
         self.waterbodies = arcpy.Describe(c_waterbodies).catalogPath if not self.is_file_path(
             c_waterbodies) else c_waterbodies
         self.waterbody_raster = None
+        self.water_grid = None  # WaterBodyGrid of the water body raster, clips the plumes of the post processes
+        self.snap_x, self.snap_y = 0.0, 0.0
         self.particle_path = arcpy.Describe(c_particlepath).catalogPath if not self.is_file_path(
             c_particlepath) else c_particlepath
 
@@ -64,6 +77,39 @@ class Transport:
         self.post_process = c_option4.lower()  # Post process, none, medium, and full
         self.solute_mass_type = c_option5  # Solute mass type, specified input mass rate, or specified Z
         self.maxnum = c_option6
+        self.erf_backend = (c_option7 or "SciPy").lower()  # Special function backend, math, scipy and rational
+        # Plume precision, float64 or float32 (the output rasters are 32_BIT_FLOAT either way)
+        self.plume_dtype = np.float32 if (c_option8 or "Float64").lower() == "float32" else np.float64
+        # Output times [d] of the transient plumes, written as one band per time next to the steady-state plumes
+        self.output_times = sorted(float(t) for t in c_option9.split(";") if t.strip()) if c_option9 else []
+        # Output depths [m] below the water table, the 3D plumes are written as one band per depth
+        self.output_depths = sorted(float(z) for z in c_option11.split(";") if z.strip()) if c_option11 else []
+        # Per species stacks of the band plumes (output times followed by output depths)
+        self.band_plumes = [None, None, None]
+        # Per species positions [cells] of the columns of multi-resolution plumes, None for one column per cell
+        self.plume_columns = [None, None, None]
+        # Folder of the tabulated lateral kernels kept across runs, the kernels are shared in memory if None
+        self.kernel_cache = LateralKernelCache(c_option10 or None)
+        # Plume warping engine, numpy (PlumeWarp, snapped to the water body grid) or arcgis (Warp and Rotate tools)
+        self.warp_engine = (c_option12 or "NumPy").lower()
+        # Worker processes of the plume calculation, 1 for serial, 0 for one per CPU core
+        self.workers = int(c_option13) if c_option13 is not None else 1
+        if self.workers < 1:
+            self.workers = os.cpu_count() or 1
+        # Folder of the per-source plume tiles kept across runs, only changed sources are recomputed if set
+        self.source_cache_dir = c_option14 or None
+        # Tile size [m] of the spatial chunks, the sources are chunked by OSTDS_ID if None or 0
+        self.tile_size = float(c_option15) if c_option15 else None
+        # Interpolation tolerance of the multi-resolution plume grid, one column per cell if None or 0
+        self.plume_grid_tolerance = float(c_option16) if c_option16 else None
+        self.pool = None
+        self.worker = False  # True in the worker processes of the pool
+        self.flow_paths = None  # FlowPaths of the particle tracking, read by main
+        # FID, location and initial concentrations of every source, read by read_initial_conc
+        self.source_fids = np.zeros(0, dtype=np.int64)
+        self.source_xy = np.zeros((0, 2))
+        self.source_conc = [None, None, None]
+        self.source_conc_fields = [None, None, None]
 
         self.Y = c_param2  # Y of the source plane
         if self.solute_mass_type.lower() == 'specified z':
@@ -172,6 +218,9 @@ class Transport:
         arcpy.SetLogMetadata(False)
         arcpy.SetLogHistory(False)
         arcpy.env.workspace = self.working_dir
+        set_erf_backend(self.erf_backend)
+        set_plume_dtype(self.plume_dtype)
+        set_kernel_cache(self.kernel_cache)
         factor = self.maxnum
 
         current_time = time.strftime("%H:%M:%S", time.localtime())
@@ -183,12 +232,30 @@ class Transport:
             arcpy.conversion.FeatureToRaster(self.waterbodies, "FID", self.waterbody_raster,
                                              self.plume_cell_size)
             arcpy.env.snapRaster = self.waterbody_raster
+            extent = arcpy.Describe(self.waterbody_raster).extent
+            self.snap_x, self.snap_y = extent.XMin, extent.YMin
+            if self.post_process in ("medium", "full"):
+                # the windows of the plumes are rasterized from the polygons, not the raster of the study area
+                self.water_grid = WaterBodyGrid(None, extent.XMin, extent.YMin, self.plume_cell_size,
+                                                index=WaterBodyIndex.read(self.waterbodies))
         except Exception as e:
             arcpy.AddMessage("[Error]: Failed to create water body raster: "+str(e))
             sys.exit(-1)
 
+        current_time = time.strftime("%H:%M:%S", time.localtime())
+        arcpy.AddMessage("{}     Reading sources and flow paths...".format(current_time))
+        try:
+            # one scan of the septic tank locations and concentrations
+            self.read_initial_conc()
+            # read the segments feature class (flow paths) once, the chunks slice it by OSTDS_ID
+            self.flow_paths = FlowPaths.read(self.particle_path)
+        except Exception as e:
+            arcpy.AddMessage("[Error]: Failed to read the sources and flow paths: "+str(e))
+            sys.exit(-1)
+
         current_time = time.strftime("%H:%M:%S", time.localtime())
         arcpy.AddMessage("{}     Calculating plumes...".format(current_time))
+        self.pool = self.create_pool()
 
         no3plume = []
         no3plume_info = []
@@ -198,43 +265,65 @@ class Transport:
         phoplume_info = []
 
         ostds_number = int(arcpy.management.GetCount(self.source_location).getOutput(0))
-        if ostds_number > self.maxnum:
-            for num in range(0, ostds_number, factor):
+        checkpoint = None
+        if self.tile_size:
+            # spatial chunks, the plumes of a tile and its halo are summed on a canvas of the tile size
+            chunks = [(None, None, tile) for tile in self.spatial_tiles()]
+        elif ostds_number > self.maxnum:
+            chunks = [(num, min(num + factor, ostds_number), None) for num in range(0, ostds_number, factor)]
+        else:
+            chunks = []
+        if chunks:
+            # chunks finished by an earlier run with the same inputs are reused
+            checkpoint = RunCheckpoint(os.path.join(self.working_dir, "transport_checkpoint.json"),
+                                       self.input_hash())
+            for chunk_start, chunk_end, tile in chunks:
                 # delete temp files
                 temp_folder = os.path.join(os.environ['USERPROFILE'], 'AppData', 'Local', 'Temp')
                 delete_temp_files(temp_folder)
 
-                chunk_start = num
-                chunk_end = min(num + factor, ostds_number)
+                chunk = chunk_name(chunk_start, chunk_end, tile)
+                chunk_outputs = []
                 if "NO3-N" in self.contaminant_list:
-                    no3plume_name = "n3p{}_{}".format(chunk_start, chunk_end)
-                    no3info_name = "n3i{}_{}".format(chunk_start, chunk_end)
-                    if arcpy.Exists(os.path.join(self.no3_dir, no3plume_name)):
-                        arcpy.management.Delete(os.path.join(self.no3_dir, no3plume_name))
-                    if arcpy.Exists(os.path.join(self.no3_dir, no3info_name + '.shp')):
-                        arcpy.management.Delete(os.path.join(self.no3_dir, no3info_name + '.shp'))
+                    no3plume_name = "n3p{}".format(chunk)
+                    no3info_name = "n3i{}".format(chunk)
+                    chunk_outputs.append((self.no3_dir, no3plume_name, no3info_name))
                     no3plume.append(no3plume_name)
                     no3plume_info.append(no3info_name)
                 if "NH4-N" in self.contaminant_list:
-                    nh4plume_name = "n4p{}_{}".format(chunk_start, chunk_end)
-                    nh4info_name = "n4i{}_{}".format(chunk_start, chunk_end)
-                    if arcpy.Exists(os.path.join(self.nh4_dir, nh4plume_name)):
-                        arcpy.management.Delete(os.path.join(self.nh4_dir, nh4plume_name))
-                    if arcpy.Exists(os.path.join(self.nh4_dir, nh4info_name + '.shp')):
-                        arcpy.management.Delete(os.path.join(self.nh4_dir, nh4info_name + '.shp'))
+                    nh4plume_name = "n4p{}".format(chunk)
+                    nh4info_name = "n4i{}".format(chunk)
+                    chunk_outputs.append((self.nh4_dir, nh4plume_name, nh4info_name))
                     nh4plume.append(nh4plume_name)
                     nh4plume_info.append(nh4info_name)
                 if "PO4-P" in self.contaminant_list:
-                    phoplume_name = "pp{}_{}".format(chunk_start, chunk_end)
-                    phoplume_info_name = "pi{}_{}".format(chunk_start, chunk_end)
-                    if arcpy.Exists(os.path.join(self.phos_dir, phoplume_name)):
-                        arcpy.management.Delete(os.path.join(self.phos_dir, phoplume_name))
-                    if arcpy.Exists(os.path.join(self.phos_dir, phoplume_info_name + '.shp')):
-                        arcpy.management.Delete(os.path.join(self.phos_dir, phoplume_info_name + '.shp'))
+                    phoplume_name = "pp{}".format(chunk)
+                    phoplume_info_name = "pi{}".format(chunk)
+                    chunk_outputs.append((self.phos_dir, phoplume_name, phoplume_info_name))
                     phoplume.append(phoplume_name)
                     phoplume_info.append(phoplume_info_name)
 
-                self.calculate_plumes(chunk_start, chunk_end)
+                if checkpoint.done(chunk) and self.chunk_outputs_exist(chunk_outputs):
+                    current_time = time.strftime("%H:%M:%S", time.localtime())
+                    if tile is not None:
+                        arcpy.AddMessage("{}     Skip the finished tile {}".format(current_time, tile.name))
+                    else:
+                        arcpy.AddMessage("{}     Skip the finished plumes {} to {}".format(current_time,
+                                                                                         chunk_start, chunk_end))
+                    continue
+                for directory, plume_name, info_name in chunk_outputs:
+                    if arcpy.Exists(os.path.join(directory, plume_name)):
+                        arcpy.management.Delete(os.path.join(directory, plume_name))
+                    if arcpy.Exists(os.path.join(directory, info_name + '.shp')):
+                        arcpy.management.Delete(os.path.join(directory, info_name + '.shp'))
+
+                if tile is not None:
+                    current_time = time.strftime("%H:%M:%S", time.localtime())
+                    arcpy.AddMessage("{}     Tile {}, {} plumes in the tile and {} in the halo".format(
+                        current_time, tile.name, len(tile.own), len(tile.locations) - len(tile.own)))
+                self.calculate_plumes(chunk_start, chunk_end, tile=tile)
+                self.kernel_cache.save()
+                checkpoint.complete(chunk)
         else:
             if "NO3-N" in self.contaminant_list:
                 no3plume_name = self.no3_output
@@ -261,9 +350,11 @@ class Transport:
                 phoplume_info.append(phoplume_info_name)
 
             self.calculate_plumes(0, ostds_number, True)
+            self.kernel_cache.save()
+        self.close_pool()
 
         try:
-            if len(no3plume) < 2 and len(nh4plume) < 2 and len(phoplume) < 2 and ostds_number > self.maxnum:
+            if len(no3plume) < 2 and len(nh4plume) < 2 and len(phoplume) < 2 and chunks:
                 if "NO3-N" in self.contaminant_list:
                     arcpy.management.Rename(no3plume[0], self.no3_output)
                     arcpy.management.Rename(no3plume_info[0], self.no3_output_info)
@@ -273,7 +364,7 @@ class Transport:
                 if "PO4-P" in self.contaminant_list:
                     arcpy.management.Rename(phoplume[0], self.phos_output)
                     arcpy.management.Rename(phoplume_info[0], self.phos_output_info)
-            elif ostds_number > self.maxnum:
+            elif chunks:
                 if "NO3-N" in self.contaminant_list:
                     if arcpy.Exists(os.path.join(self.no3_dir, self.no3_output)):
                         arcpy.management.Delete(os.path.join(self.no3_dir, self.no3_output))
@@ -314,24 +405,184 @@ class Transport:
             arcpy.AddMessage("[Error]: Failed to mosaic the entire plumes: "+str(e))
             sys.exit(-1)
 
-    def calculate_plumes(self, start_num, end_num, flag=False):
-        info_names = self.create_new_plume_data_shapefile(start_num, end_num, flag)
+        if self.output_times or self.output_depths:
+            current_time = time.strftime("%H:%M:%S", time.localtime())
+            arcpy.AddMessage("{}     Composing multi-band plumes...".format(current_time))
+            try:
+                if "NO3-N" in self.contaminant_list:
+                    self.compose_bands(no3plume or [self.no3_output], self.no3_output, self.no3_dir)
+                if "NH4-N" in self.contaminant_list:
+                    self.compose_bands(nh4plume or [self.nh4_output], self.nh4_output, self.nh4_dir)
+                if "PO4-P" in self.contaminant_list:
+                    self.compose_bands(phoplume or [self.phos_output], self.phos_output, self.phos_dir)
+            except Exception as e:
+                arcpy.AddMessage("[Error]: Failed to compose the multi-band plumes: "+str(e))
+                sys.exit(-1)
 
-        # read the segments feature class (flow paths)
-        colname = ["Shape", "OSTDS_ID", "SegID", "TotDist", "TotTime", "SegPrsity", "SegVel", "DirAngle", "WBId",
-                   "PathWBId"]
-        data = []
-        with arcpy.da.SearchCursor(self.particle_path,
-                                   ["SHAPE@", "OSTDS_ID", "SegID", "TotDist", "TotTime", "SegPrsity", "SegVel",
-                                    "DirAngle", "WBId", "PathWBId"]) as cursor:
-            for row in cursor:
-                data.append(row)
-        segments = pd.DataFrame(data, columns=colname)
-        sorted_segments = segments.sort_values(by=['OSTDS_ID', 'SegID'])
+        if checkpoint is not None:
+            # the chunk outputs are merged and deleted, the next run starts over
+            checkpoint.remove()
+
+    def input_hash(self):
+        """
+        Hash of the tool parameters and the input data, checkpoints are only resumed with the same inputs
+
+        The worker count and the cache folders do not change the results and are left out, so a crashed run can be
+        resumed with other settings.
+        """
+        ignored = {"c_option10", "c_option13", "c_option14"}
+        parameters = {name: value for name, value in self.arguments.items() if name not in ignored}
+        digest = hashlib.sha256()
+        digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+        arrays = [self.source_fids, self.source_xy] + [column for column in self.source_conc if column is not None]
+        for array in arrays + self.flow_paths.columns():
+            digest.update(np.ascontiguousarray(array).tobytes())
+        self.hash_waterbodies(digest)
+        return digest.hexdigest()
+
+    def model_hash(self):
+        """
+        Hash of the model parameters and the water bodies, the plumes of the source cache are only reused with the
+        same model. The inputs and outputs of the tool are left out, the sources are hashed by source_key.
+        """
+        ignored = {"c_source_location", "c_waterbodies", "c_particlepath", "c_no3output", "c_nh4output",
+                   "c_no3output_info", "c_nh4output_info", "c_poutput", "c_poutput_info", "c_option6",
+                   "c_option10", "c_option13", "c_option14"}
+        parameters = {name: value for name, value in self.arguments.items() if name not in ignored}
+        digest = hashlib.sha256()
+        digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+        self.hash_waterbodies(digest)
+        return digest.hexdigest()
+
+    def hash_waterbodies(self, digest):
+        # the water bodies are only read by geoprocessing tools, their files are hashed by size and time
+        for filename in sorted(glob.glob(os.path.splitext(self.waterbodies)[0] + ".*")):
+            stat = os.stat(filename)
+            digest.update("{} {} {}".format(os.path.basename(filename), stat.st_size, stat.st_mtime_ns).encode())
+
+    @staticmethod
+    def source_key(segment, concentrations, xy):
+        """
+        Hash of the flow path, initial concentrations and location of a source, the key of the source cache
+        """
+        digest = hashlib.sha256()
+        for array in (segment.tot_dist, segment.tot_time, segment.porosity, segment.velocity, segment.angle,
+                      segment.wbid, segment.path_wbid, segment.first_x, segment.first_y, segment.last_x,
+                      segment.last_y):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(np.asarray(list(concentrations) + list(xy), dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def chunk_outputs_exist(self, chunk_outputs):
+        """
+        Whether the plume, band and info outputs of a chunk, (directory, plume name, info name), all exist
+        """
+        for directory, plume_name, info_name in chunk_outputs:
+            names = [plume_name, info_name + '.shp'] + [band_raster_name(plume_name, band) for band in
+                                                         range(len(self.output_times) + len(self.output_depths))]
+            if not all(arcpy.Exists(os.path.join(directory, name)) for name in names):
+                return False
+        return True
 
-        sl_segments = sorted_segments[(sorted_segments['OSTDS_ID'] >= start_num) & (sorted_segments['OSTDS_ID'] < end_num)]
-        del segments
-        del sorted_segments
+    def spatial_tiles(self):
+        """
+        Bin the locations into square tiles of tile_size on the water body grid
+
+        A location contributes to every tile its plume can reach, within its flow path plus the extension of the
+        post process and the source width. The tiles are named by their absolute grid indices, so they keep their
+        names (and source cache folders) when locations are added. Returns the SpatialTiles with at least one
+        location in the tile or its halo.
+        """
+        tile_cells = max(1, int(math.ceil(self.tile_size / self.plume_cell_size)))
+        tile_size = tile_cells * self.plume_cell_size
+        ny = int(self.Y / self.plume_cell_size)
+        extension = (int(ny * self.multiplier) + 2) * self.plume_cell_size + self.Y
+
+        ids = self.flow_paths.ids
+        if len(ids) == 0:
+            return []
+        path_lengths = np.maximum.reduceat(self.flow_paths.tot_dist, self.flow_paths.starts)
+        positions = np.searchsorted(self.source_fids, ids).clip(0, max(len(self.source_fids) - 1, 0))
+        found = self.source_fids[positions] == ids if len(self.source_fids) else np.zeros(len(ids), dtype=bool)
+        ids, positions = ids[found], positions[found]
+        halo = path_lengths[found] + extension
+        reach = int(math.ceil(halo.max(initial=0) / tile_size))
+        x = self.source_xy[positions, 0] - self.snap_x
+        y = self.source_xy[positions, 1] - self.snap_y
+        column = np.floor(x / tile_size).astype(np.int64)
+        row = np.floor(y / tile_size).astype(np.int64)
+
+        members = []
+        for column_offset in range(-reach, reach + 1):
+            for row_offset in range(-reach, reach + 1):
+                tile_column, tile_row = column + column_offset, row + row_offset
+                # distance of the location to the tile
+                dx = np.maximum(0, np.maximum(tile_column * tile_size - x, x - (tile_column + 1) * tile_size))
+                dy = np.maximum(0, np.maximum(tile_row * tile_size - y, y - (tile_row + 1) * tile_size))
+                inside = (dx <= halo) & (dy <= halo)
+                own = np.full(np.count_nonzero(inside), column_offset == 0 and row_offset == 0)
+                members.append((tile_column[inside], tile_row[inside], ids[inside], own))
+        tile_column, tile_row, member_ids, own = (np.concatenate(arrays) for arrays in zip(*members))
+        if len(member_ids) == 0:
+            return []
+
+        order = np.lexsort((member_ids, tile_row, tile_column))
+        tile_column, tile_row, member_ids, own = tile_column[order], tile_row[order], member_ids[order], own[order]
+        breaks = np.flatnonzero((np.diff(tile_column) != 0) | (np.diff(tile_row) != 0)) + 1
+
+        def index_name(index):
+            # negative indices are written as m<index>, names must not contain a minus sign
+            return "m{}".format(-index) if index < 0 else str(index)
+
+        tiles = []
+        for start, stop in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(member_ids)]))):
+            tile_col, tile_r = tile_column[start], tile_row[start]
+            window = (tile_col * tile_cells, tile_r * tile_cells, (tile_col + 1) * tile_cells,
+                      (tile_r + 1) * tile_cells)
+            tiles.append(SpatialTile("t{}_{}".format(index_name(tile_col), index_name(tile_r)), window,
+                                     member_ids[start:stop], set(member_ids[start:stop][own[start:stop]].tolist())))
+        return tiles
+
+    def compose_bands(self, plume_names, output, directory):
+        """
+        Combine the band rasters of all chunks into the multi-band rasters, <output>_t with one band per output
+        time and <output>_z with one band per output depth
+        """
+        ntimes = len(self.output_times)
+        groups = [("t", range(0, ntimes)), ("z", range(ntimes, ntimes + len(self.output_depths)))]
+        for suffix, band_range in groups:
+            if not len(band_range):
+                continue
+            bands = []
+            for band in band_range:
+                chunk_bands = [os.path.join(directory, band_raster_name(name, band)) for name in plume_names]
+                band_name = os.path.join(directory, band_raster_name(output, band))
+                if chunk_bands != [band_name]:
+                    if arcpy.Exists(band_name):
+                        arcpy.management.Delete(band_name)
+                    arcpy.management.MosaicToNewRaster(chunk_bands, directory, band_raster_name(output, band),
+                                                       self.crs, self.pixeltype, self.plume_cell_size, 1, "SUM")
+                    for chunk_band in chunk_bands:
+                        if arcpy.Exists(chunk_band):
+                            arcpy.management.Delete(chunk_band)
+                bands.append(band_name)
+            multiband_output = os.path.join(directory, multiband_raster_name(output, suffix))
+            if arcpy.Exists(multiband_output):
+                arcpy.management.Delete(multiband_output)
+            arcpy.management.CompositeBands(bands, multiband_output)
+            for band_name in bands:
+                if arcpy.Exists(band_name):
+                    arcpy.management.Delete(band_name)
+
+    def calculate_plumes(self, start_num, end_num, flag=False, tile=None):
+        """
+        Calculate and sum the plumes of the locations start_num <= OSTDS_ID < end_num, or of a SpatialTile and its
+        halo. The outputs of a tile are clipped to the tile and only list the locations in the tile.
+        """
+        info_names = self.create_new_plume_data_shapefile(start_num, end_num, flag, tile)
+        chunk = chunk_name(start_num, end_num, tile)
+
+        flow_paths = self.flow_paths
 
         plume_name = []
         try:
@@ -339,347 +590,572 @@ class Transport:
                 if flag:
                     nh4plume_name = self.nh4_output
                 else:
-                    nh4plume_name = "n4p{}_{}".format(start_num, end_num)
-                arcpy.management.CreateRasterDataset(self.nh4_dir, nh4plume_name, self.plume_cell_size,
-                                                     self.pixeltype, self.crs, 1)
+                    nh4plume_name = "n4p{}".format(chunk)
             else:
                 nh4plume_name = None
             if "NO3-N" in self.contaminant_list:
                 if flag:
                     no3plume_name = self.no3_output
                 else:
-                    no3plume_name = "n3p{}_{}".format(start_num, end_num)
-                arcpy.management.CreateRasterDataset(self.no3_dir, no3plume_name, self.plume_cell_size,
-                                                     self.pixeltype, self.crs, 1)
+                    no3plume_name = "n3p{}".format(chunk)
             else:
                 no3plume_name = None
             if "PO4-P" in self.contaminant_list:
                 if flag:
                     phoplume_name = self.phos_output
                 else:
-                    phoplume_name = "pp{}_{}".format(start_num, end_num)
-                arcpy.management.CreateRasterDataset(self.phos_dir, phoplume_name, self.plume_cell_size,
-                                                     self.pixeltype, self.crs, 1)
+                    phoplume_name = "pp{}".format(chunk)
             else:
                 phoplume_name = None
             plume_name.append(nh4plume_name)
             plume_name.append(no3plume_name)
             plume_name.append(phoplume_name)
+            directories = [self.nh4_dir if nh4plume_name else None,
+                           self.no3_dir if no3plume_name else None,
+                           self.phos_dir if phoplume_name else None]
+            # the plumes of the chunk are summed in memory and written once by write_canvases
+            canvases = self.create_canvases(plume_name)
+
+            # one single band raster per output time and depth, combined into multi-band rasters by main
+            band_names = []
+            band_canvases = []
+            for band in range(len(self.output_times) + len(self.output_depths)):
+                names = []
+                for name, directory in zip(plume_name, directories):
+                    if name is None:
+                        names.append(None)
+                        continue
+                    names.append(band_raster_name(name, band))
+                    if arcpy.Exists(os.path.join(directory, names[-1])):
+                        arcpy.management.Delete(os.path.join(directory, names[-1]))
+                band_names.append(names)
+                band_canvases.append(self.create_canvases(names))
         except Exception as e:
             arcpy.AddMessage("[Error]: Failed to create output raster: "+str(e))
             sys.exit(-1)
-        plume_info = []
-
-        for ostdsid in sl_segments['OSTDS_ID'].unique():
-            current_time = time.strftime("%H:%M:%S", time.localtime())
-            arcpy.AddMessage("{}     Calculating plume for location: {}".format(current_time, ostdsid))
-            # memoryview, _ = self.get_memory_usage()
-            # arcpy.AddMessage("Memory usage before calculation: {} GB".format(memoryview))
-
-            seg = sl_segments[sl_segments['OSTDS_ID'] == ostdsid]
-            seg = seg.reset_index(drop=True)
-
-            if (seg['SegPrsity'] < 0.01).any() or (seg['SegVel'] < 1E-8).any():
+        sources = []
+
+        # output slots, the steady-state plumes followed by one slot per output time and depth
+        slots = [canvases] + band_canvases
+        cache = None
+        if self.source_cache_dir:
+            # unchanged sources reuse their tiles, the sums of the last run are updated by difference
+            cache = SourceCache(self.source_cache_dir, "all" if flag else chunk, self.model_hash(),
+                                (self.plume_cell_size, self.snap_x, self.snap_y))
+            cache.restore(slots)
+
+        entries = []
+        locations = tile.locations if tile is not None else flow_paths.locations(start_num, end_num)
+        for ostdsid in locations:
+            seg = flow_paths.flow_path(ostdsid)
+
+            if (seg.porosity < 0.01).any() or (seg.velocity < 1E-8).any():
                 arcpy.AddMessage("[Warning]: Skip {}th OSTDS. The Ks or porosity may be missed.\n"
                                  "Please check particle tracking results".format(ostdsid))
                 continue
 
-            mean_poro = seg['SegPrsity'].mean()
-            mean_velo = hmean(seg['SegVel'])  # harmonic mean
-            mean_angle = seg['DirAngle'].mean()
-            max_dist = seg['TotDist'].max()
-            maxtime = seg['TotTime'].max()
-            wbid = seg['WBId'].iloc[-1]
-            path_wbid = seg['PathWBId'].iloc[-1]
+            mean_poro = seg.porosity.mean()
+            mean_velo = hmean(seg.velocity)  # harmonic mean
+            mean_angle = seg.angle.mean()
+            max_dist = seg.tot_dist.max()
+            maxtime = seg.tot_time.max()
+            wbid = seg.wbid[-1]
+            path_wbid = seg.path_wbid[-1]
 
-            # calculate a single plume
+            initial = self.get_initial_conc(ostdsid)
+            if initial[0] is None:
+                continue
+            point = initial[0]
+            xvalue, yvalue = point.firstPoint.X, point.firstPoint.Y
+            # the info record of the location, completed by the plume statistics
+            source = [ostdsid, (xvalue, yvalue), None, mean_poro, mean_velo, mean_angle, max_dist, maxtime, wbid,
+                      path_wbid, (initial[2], initial[1], initial[3])]
+            key = None
+            cached = None
+            if cache is not None:
+                key = self.source_key(seg, initial[1:], (xvalue, yvalue))
+                cached = cache.get(ostdsid, key)
+            if self.pool is not None:
+                # the worker processes get the concentrations without the arcpy point
+                initial = (None,) + tuple(initial[1:])
+            job = (ostdsid, initial, (xvalue, yvalue), seg, mean_poro, mean_velo,
+                   mean_angle, max_dist, maxtime, wbid, path_wbid)
+            entries.append((ostdsid, seg, source, key, cached, job))
+
+        if cache is not None:
+            # changed, skipped and removed sources leave the sums before the new tiles are added
+            unchanged = set(entry[0] for entry in entries if entry[4] is not None)
+            stale = [ostdsid for ostdsid in cache.keys if ostdsid not in unchanged]
+            if not all(cache.subtract(ostdsid, slots) for ostdsid in stale):
+                arcpy.AddMessage("[Warning]: The source cache of the chunk is damaged, all plumes are recalculated")
+                for slot_canvases in slots:
+                    for canvas in slot_canvases:
+                        if canvas is not None:
+                            canvas.close()
+                cache.clear()
+                entries = [entry[:4] + (None, entry[5]) for entry in entries]
+        jobs = [entry[5] for entry in entries if entry[4] is None]
+
+        if cache is not None:
+            arcpy.AddMessage("          {} of {} plumes are unchanged since the last run".format(
+                len(entries) - len(jobs), len(entries)))
+        # the reference plumes of a batch of locations are sized together, see size_plumes. The workers get at
+        # least four batches each.
+        size = BATCH_SOURCES
+        if self.pool is not None:
+            size = max(1, min(BATCH_SOURCES, len(jobs) // (4 * self.workers)))
+        batches = [jobs[start:start + size] for start in range(0, len(jobs), size)]
+        if self.pool is not None:
             current_time = time.strftime("%H:%M:%S", time.localtime())
-            arcpy.AddMessage("{}          Calculating reference plume for location: {}".format(current_time, ostdsid))
-            filtered, tmp_list = self.calculate_single_plume(ostdsid, mean_poro, mean_velo, max_dist)
-            filtered_nh4, filtered_no3, filtered_pho = filtered
-            if filtered_no3 is None and filtered_nh4 is None and filtered_pho is None:
+            arcpy.AddMessage("{}     Calculating {} plumes with {} worker processes".format(
+                current_time, len(jobs), self.workers))
+            results = self.pool.map(_process_batch, batches)
+        else:
+            results = map(self.process_batch, batches)
+        results = (result for batch in results for result in batch)
+
+        # the results are accumulated in the order of the locations, the sums do not depend on the workers
+        for ostdsid, seg, source, key, cached, _ in entries:
+            # the info records of a tile list the locations in the tile, not those of the halo
+            own = tile is None or ostdsid in tile.own
+            if cached is not None:
+                tiles, source[2] = cached
+                if own:
+                    sources.append(source)
+                continue
+            result = next(results)
+            if self.pool is not None:
+                current_time = time.strftime("%H:%M:%S", time.localtime())
+                arcpy.AddMessage("{}     Merging plume for location: {}".format(current_time, ostdsid))
+            if result is None:
                 continue
+            source[2], warped, band_warped = result
+            if own:
+                sources.append(source)
+            if self.pool is not None:
+                # the empty plumes of the workers are dropped in the main process
+                warped = self.prepare_warped(*warped, ostdsid)
+                band_warped = [self.prepare_warped(*band, ostdsid) for band in band_warped]
+
+            warped_plumes, target_points_list, lengths = warped
+            post_plumes = self.post_process_plume(lengths, warped_plumes, ostdsid, seg, target_points_list, plume_name)
 
-            # calculate info file
-            current_time = time.strftime("%H:%M:%S", time.localtime())
-            arcpy.AddMessage("{}          Calculating info file for location: {}".format(current_time, ostdsid))
-            xvalue, yvalue = tmp_list[0].firstPoint.X, tmp_list[0].firstPoint.Y
-            plume_seg = self.calculate_info(filtered, tmp_list, ostdsid, mean_poro, mean_velo,
-                                            mean_angle, max_dist, maxtime, wbid, path_wbid)
-            plume_info.append(plume_seg)
+            ## merge the plume
+            tiles = [self.mosaic_plumes(post_plumes, canvases, ostdsid)]
 
-            # warp the plume
-            current_time = time.strftime("%H:%M:%S", time.localtime())
-            arcpy.AddMessage("{}          Warping plume for location: {}".format(current_time, ostdsid))
-            if self.warp_option:
-                # This function (affine transformation) is unavailable, Because the current algorithm is too
-                # computationally intensive when the plume is large
-                warped_plume = self.warp_affine_transformation(filtered, ostdsid, xvalue, yvalue, seg)
-            else:
-                warped_plumes, target_points_list, lengths = self.warp_arcgis(filtered, ostdsid, xvalue, yvalue, seg)
+            # merge the transient and 3D plumes, one band per output time and depth
+            for names, band_canvas, (warped_plumes, target_points_list, lengths) in zip(band_names, band_canvases,
+                                                                                         band_warped):
+                post_plumes = self.post_process_plume(lengths, warped_plumes, ostdsid, seg, target_points_list, names)
+                tiles.append(self.mosaic_plumes(post_plumes, band_canvas, ostdsid))
+            if cache is not None:
+                cache.put(ostdsid, key, tiles, source[2])
 
-            post_plumes = self.post_process_plume(lengths, warped_plumes, ostdsid, seg, target_points_list, plume_name)
+        if cache is not None:
+            try:
+                cache.save(slots)
+            except Exception as e:
+                arcpy.AddMessage("[Warning]: Failed to save the source cache: "+str(e))
 
-            ## merge the plume
-            for index, post_plume in enumerate(post_plumes):
-                if index == 0:
-                    if "NH4-N" in self.contaminant_list:
-                        filepath = self.nh4_dir
-                    else:
-                        continue
-                elif index == 1:
-                    if "NO3-N" in self.contaminant_list:
-                        filepath = self.no3_dir
-                    else:
-                        continue
-                elif index == 2:
-                    if "PO4-P" in self.contaminant_list:
-                        filepath = self.phos_dir
-                    else:
-                        continue
-                try:
-                    _, file_extension = os.path.splitext(plume_name[index])
-                    wait_time = 0
-                    if bool(file_extension):
-                        lockfile = os.path.join(filepath, phoplume_name)
-                        while is_file_locked(lockfile):
-                            arcpy.AddMessage("The output raster is used by other software, waiting for 1 second...\n")
-                            time.sleep(1)
-                            wait_time += 1
-                            if wait_time > 60:
-                                arcpy.AddMessage("Skip the plume: {} for NO3-N calculation.".format(ostdsid))
-                                raise Exception("The output raster is used by other software.")
-            # print("post_no3 pixeltype is {}".format(arcpy.Describe(post_no3).pixelType))
-            # print("Output pixeltype is {}".format(arcpy.Describe(self.no3_output).pixelType))
-                    if post_plume is None:
-                        plume_name[index] = plume_name[index]
-                    else:
-                        pixeltype1 = arcpy.Describe(plume_name[index]).pixelType
-                        pixeltype2 = arcpy.Describe(post_plume).pixelType
-                        filename = post_plume
-                        if pixeltype1 != pixeltype2:
-                            filename = r'post_tmp'
-                            arcpy.management.CopyRaster(post_plume, filename, pixel_type=self.pixeltype)
-                        nodataval1 = arcpy.Describe(plume_name[index]).noDataValue
-                        nodataval2 = arcpy.Describe(filename).noDataValue
-                        nodatavalue = nodataval1
-                        if nodataval1 != nodataval2:
-                            nodata = "1 " + str(min(nodataval1, nodataval2))
-                            arcpy.management.SetRasterProperties(plume_name[index], nodata=nodata)
-                            arcpy.management.SetRasterProperties(filename, nodata=nodata)
-                            nodatavalue = min(nodataval1, nodataval2)
-                        try:
-                            temp_raster = os.path.join(tempfile.mkdtemp(), "tmpraster")
-                            arcpy.management.CopyRaster(plume_name[index], temp_raster)
-                            arcpy.management.Mosaic(filename, plume_name[index], mosaic_type="SUM")
-                            # arcpy.management.Delete(filename)
-                            if arcpy.Exists(temp_raster):
-                                shutil.rmtree(tempfile.mkdtemp())
-                        except:
-                            try:
-                                print("                    Try mosaic to new raster method")
-                                if arcpy.Exists(temp_raster):
-                                    arcpy.management.MosaicToNewRaster([filename, temp_raster], filepath,
-                                                                       "tmp_plume", self.crs, self.pixeltype,
-                                                                       self.plume_cell_size, 1, "SUM")
-                                if arcpy.Exists(temp_raster):
-                                    shutil.rmtree(tempfile.mkdtemp())
-                                if arcpy.Exists(plume_name[index]):
-                                    arcpy.management.Delete(plume_name[index])
-                                arcpy.management.Rename("tmp_plume", plume_name[index])
-                            except:
-                                print("                    Try con method")
-
-                                extent1 = arcpy.Describe(temp_raster).extent
-                                extent2 = arcpy.Describe(filename).extent
-                                extent_list = [extent1, extent2]
-                                union_extent = extent_list[0]
-                                for extent in extent_list[1:]:
-                                    union_extent = arcpy.Extent(
-                                        min(union_extent.XMin, extent.XMin),
-                                        min(union_extent.YMin, extent.YMin),
-                                        max(union_extent.XMax, extent.XMax),
-                                        max(union_extent.YMax, extent.YMax))
-                                arcpy.env.extent = union_extent
-
-                                condition1 = (~arcpy.sa.IsNull(temp_raster)) & (~arcpy.sa.IsNull(filename))
-                                condition2 = (~arcpy.sa.IsNull(temp_raster)) & (arcpy.sa.IsNull(filename))
-                                sum_raster = arcpy.sa.Con(condition1, arcpy.Raster(temp_raster)+arcpy.Raster(filename),
-                                                          arcpy.sa.Con(condition2, temp_raster, filename))
-                                if arcpy.Exists(plume_name[index]):
-                                    arcpy.management.Delete(plume_name[index])
-                                sum_raster.save(plume_name[index])
+        # the plumes of the halo outside of the tile are part of the neighbouring tiles
+        window = tile.window if tile is not None else None
+        try:
+            self.write_canvases(canvases, plume_name, directories, window)
+            for names, band_canvas in zip(band_names, band_canvases):
+                self.write_canvases(band_canvas, names, directories, window)
+        except Exception as e:
+            arcpy.AddMessage("[Error]: Failed to write output raster: "+str(e))
+            sys.exit(-1)
 
-                except Exception as e:
-                    error_name = os.path.join(filepath, 'plm_no3_{}'.format(ostdsid))
-                    arcpy.management.CopyRaster(post_plume, error_name)
-                    if not arcpy.Exists(plume_name[index]):
-                        if arcpy.Exists(temp_raster):
-                            arcpy.management.Rename(temp_raster, plume_name[index])
-                    arcpy.AddMessage("[Error]: Failed to mosaic plume {}: ".format(ostdsid) + str(e))
-                    arcpy.AddMessage("Skip the plume: {} for NO3-N calculation.".format(ostdsid))
-
-        if self.post_process == "medium":
-            self.post_process_medium(plume_name)
-
-        for index, infoname in enumerate(info_names):
-            if infoname is not None:
-                with arcpy.da.InsertCursor(infoname, ["SHAPE@", "OSTDS_ID", "is2D", "domBdy", "decayCoeff",
-                                                     "avgVel", "avgPrsity", "DispL", "DispTH", "DispTV",
-                                                     "SourceY", "SourceZ", "MeshDX", "MeshDY", "MeshDZ",
-                                                     "plumeTime", "pathTime", "plumeLen", "pathLen", "plumeArea",
-                                                     "mslnRtNmr", "massInRate", "massRMRate", "avgAngle", "warp",
-                                                     "PostP", "Init_conc", "VolFac", "nextConc", "threshConc",
-                                                     "WBId_plume", "WBId_path", "load", "wb_conc"]) as cursor:
-                    for row in plume_info:
-                        cursor.insertRow(row[index])
+        infos = self.calculate_info(sources)
+        self.write_info(info_names, infos)
         return
 
-    def calculate_single_plume(self, pathid, mean_poro, mean_velo, max_dist):
+    def process_batch(self, jobs):
         """
-        Calculate a single plume
+        process_source for a batch of locations, whose reference plumes are sized at once by size_plumes
+
+        Yields the results one location at a time.
         """
-        try:
-            point, no3_conc, nh4_conc, pho_conc = self.get_initial_conc(pathid)
-            ny = int(self.Y / self.plume_cell_size)
-            nx = math.ceil(max_dist / self.plume_cell_size)
-            nx_old = nx
-            if self.post_process != 'none':
-                nx = nx + int(ny * self.multiplier)
+        for job, half_widths in zip(jobs, self.size_plumes(jobs)):
+            yield self.process_source(job, half_widths)
 
-            if no3_conc < self.threshold and nh4_conc < self.threshold and pho_conc < self.threshold:
-                return [None, None, None], [None, None, None, None]
+    def size_plumes(self, jobs):
+        """
+        Half widths of the separable reference plumes of the locations of jobs at the threshold
 
-            dr3 = None
-            dr4 = None
-            drp = None
+        The plumes of all locations and species are stacked in one DomenicoRobbinsBatch, so the bisection of the half
+        widths runs once for the batch instead of once per plume. Returns the half widths of NH4-N, NO3-N and PO4-P per
+        location, None for the locations that calculate_single_plume sizes itself (skipped or not separable).
+        """
+        if self.solution_type not in SEPARABLE_SOLUTIONS:
+            return [None] * len(jobs)
+        plumes = []
+        for job in jobs:
+            initial, mean_poro, mean_velo, max_dist = job[1], job[4], job[5], job[7]
+            _, no3_conc, nh4_conc, pho_conc = initial
+            try:
+                if no3_conc < self.threshold and nh4_conc < self.threshold and pho_conc < self.threshold:
+                    raise ValueError("No plume")
+                _, nx, _ = self.reference_size(max_dist)
+                models = self.reference_models(mean_poro, mean_velo, no3_conc, nh4_conc, pho_conc)
+                plumes.append(self.reference_plumes(models, np.arange(1, nx + 1) * self.plume_cell_size))
+            except Exception:
+                # the errors are reported by calculate_single_plume
+                plumes.append(None)
+        batch = DomenicoRobbinsBatch([plume for species in plumes if species is not None for plume in species])
+        solved = iter(batch.half_widths(self.threshold, HALF_WIDTH_TOLERANCE))
+        return [None if species is None else [next(solved) for _ in species] for species in plumes]
+
+    def process_source(self, job, half_widths=None):
+        """
+        Reference plume, plume statistics and warped plumes of one location
 
-            if "NH4-N" in self.contaminant_list:
-                self.kno3 = self.denitrification_rate
-                self.knh4 = self.nitrification_rate * (1 + self.nh4_adsorption * self.bulk_density / mean_poro)
-                self.ano3 = no3_conc + self.knh4 / (self.knh4 - self.kno3) * nh4_conc
-                self.anh4 = nh4_conc
-                if self.solute_mass_type.lower() == 'specified input mass rate':
-                    a2 = self.no3_init + self.nh4_init * self.knh4 / (self.knh4 - self.kno3)
-                    # dispcons = -(self.kno3 / (self.kno3 - self.knh4)) * self.anh4 * (
-                    #         0.5 + 0.5 * math.sqrt(1 + 4 * self.knh4 * self.no3_dispx / mean_velo))
-                    # dispcons1 = a2 * (0.5 + 0.5 * math.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo))
-                    dispcons = 1 + np.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo)
-                    mass_in_no3 = self.mass_in * self.no3_init / (self.no3_init + self.nh4_init)
-                    self.no3_Z = mass_in_no3 * 2 / (self.Y * mean_poro * mean_velo * self.vol_conversion_factor *
-                                                    self.no3_init * dispcons)
-                    dispcons = 1 + np.sqrt(1 + 4 * self.knh4 * self.nh4_dispx / mean_velo)
-                    # dispcons1 = a2 * (0.5 + 0.5 * math.sqrt(1 + 4 * self.kno3 * self.nh4_dispx / mean_velo))
-                    mass_in_nh4 = self.mass_in * self.nh4_init / (self.no3_init + self.nh4_init)
-                    self.nh4_Z = mass_in_nh4 * 2 / (self.Y * mean_poro * mean_velo * self.vol_conversion_factor *
-                                                    self.nh4_init * dispcons)
-                    if self.nh4_Z < 0:
-                        self.nh4_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
-                    if self.no3_Z < 0:
-                        self.no3_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
-                    if self.zmax_option:
-                        if self.nh4_Z > self.zmax:
-                            self.nh4_Z = self.zmax
-                        if self.no3_Z > self.zmax:
-                            self.no3_Z = self.zmax
-                else:
-                    self.no3_Z = self.Z
-                    self.nh4_Z = self.Z
+        Runs in the worker processes in parallel mode, where the warped plumes are the in-memory arrays of
+        warp_numpy and are prepared by the main process. Returns None for skipped locations, otherwise the info
+        plume statistics of plume_statistics, the warped plumes and one warped plume list per band.
+        half_widths, the half widths of the reference plumes from size_plumes, if known
+        """
+        ostdsid, initial, (xvalue, yvalue), seg, mean_poro, mean_velo, mean_angle, max_dist, maxtime, wbid, \
+            path_wbid = job
+        current_time = time.strftime("%H:%M:%S", time.localtime())
+        arcpy.AddMessage("{}     Calculating plume for location: {}".format(current_time, ostdsid))
 
-                dr4 = DomenicoRobbins(self.solution_type, self.anh4, self.nh4_dispx, self.nh4_dispyz, self.nh4_dispyz,
-                                      self.Y, self.nh4_Z, self.knh4, mean_velo, -1)
+        # calculate a single plume
+        current_time = time.strftime("%H:%M:%S", time.localtime())
+        arcpy.AddMessage("{}          Calculating reference plume for location: {}".format(current_time, ostdsid))
+        filtered, tmp_list = self.calculate_single_plume(ostdsid, mean_poro, mean_velo, max_dist, initial, half_widths)
+        if filtered is None or all(plume is None for plume in filtered):
+            return None
 
-                dr3 = DomenicoRobbins(self.solution_type, self.ano3, self.no3_dispx, self.no3_dispyz, self.no3_dispyz,
-                                      self.Y, self.no3_Z, self.kno3, mean_velo, -1)
+        # the info records of all locations are calculated at once by calculate_info
+        statistics = self.plume_statistics(filtered, tmp_list, max_dist)
 
-            elif "NO3-N" in self.contaminant_list and "NH4-N" not in self.contaminant_list:
-                self.kno3 = self.denitrification_rate
-                self.ano3 = no3_conc
-                self.knh4 = 0.0
-                self.anh4 = 0.0
-                if self.solute_mass_type.lower() == 'specified input mass rate':
-                    self.no3_Z = self.mass_in * 2 / (
-                                 self.Y * mean_poro * mean_velo * self.ano3 * self.vol_conversion_factor * (
-                                 1 + math.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo)))
-                    if self.no3_Z < 0:
-                        self.no3_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
-                    if self.zmax_option:
-                        if self.no3_Z > self.zmax:
-                            self.no3_Z = self.zmax
-                else:
-                    self.no3_Z = self.Z
-                dr3 = DomenicoRobbins(self.solution_type, self.ano3, self.no3_dispx, self.no3_dispyz, self.no3_dispyz,
-                                      self.Y, self.no3_Z, self.kno3, mean_velo, -1)
-            if "PO4-P" in self.contaminant_list:
-                self.apho = pho_conc
-                if self.phos_choice.lower() == 'linear':
-                    self.kpho = self.phos_prep * (1 + self.phos_kd * self.bulk_density / mean_poro)
-                else:
-                    self.kpho = (1 + self.bulk_density / mean_poro * self.phos_smax * self.phos_kl / (
-                                    1 + self.phos_kl * self.apho)) * self.phos_prep
-                if self.solute_mass_type.lower() == 'specified input mass rate':
-                    self.phos_Z = self.mass_in_phos * 2 / (
-                                 self.Y * mean_poro * mean_velo * self.apho * self.vol_conversion_factor * (
-                                 1 + math.sqrt(1 + 4 * self.apho * self.phos_dispx / mean_velo)))
-                    if self.phos_Z < 0:
-                        self.phos_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
-                    if self.zmax_option:
-                        if self.phos_Z > self.zmax:
-                            self.phos_Z = self.zmax
-                else:
-                    self.phos_Z = self.Z
-                drp = DomenicoRobbins(self.solution_type, self.apho, self.phos_dispx, self.phos_dispyz, self.phos_dispyz,
-                                      self.Y, self.phos_Z, self.kpho, mean_velo, -1)
+        # warp the plume
+        current_time = time.strftime("%H:%M:%S", time.localtime())
+        arcpy.AddMessage("{}          Warping plume for location: {}".format(current_time, ostdsid))
+        if self.warp_option:
+            # This function (affine transformation) is unavailable, Because the current algorithm is too
+            # computationally intensive when the plume is large
+            warped_plume = self.warp_affine_transformation(filtered, ostdsid, xvalue, yvalue, seg)
+        warp = self.warp_numpy if self.worker else self.warp_plumes
+        warped = warp(filtered, ostdsid, xvalue, yvalue, seg)
+
+        # warp the transient and 3D plumes, one band per output time and depth
+        band_warped = []
+        if any(band_plume is not None for band_plume in self.band_plumes):
+            for band in range(len(self.output_times) + len(self.output_depths)):
+                band_plumes = [None if band_plume is None else band_plume[band] for band_plume in self.band_plumes]
+                band_warped.append(warp(band_plumes, ostdsid, xvalue, yvalue, seg))
+        return statistics, warped, band_warped
+
+    def create_canvases(self, plume_name):
+        """
+        One accumulation canvas on the water body grid per output raster in plume_name
+        """
+        # the sums kept by the source cache are updated by difference, double precision limits the round off
+        dtype = np.float64 if self.source_cache_dir else np.float32
+        return [None if name is None else PlumeCanvas(self.plume_cell_size, self.snap_x, self.snap_y, dtype=dtype,
+                                                      directory=self.working_dir) for name in plume_name]
 
-            # calculate the plume
-            edge = 500
-            while True:
-                xlist = np.arange(1, nx + 1) * self.plume_cell_size  # - self.plume_cell_size / 2
-                if ny % 2 != 0:
-                    ylist = np.arange(-edge, edge + 1) * self.plume_cell_size
+    def mosaic_plumes(self, post_plumes, canvases, ostdsid):
+        """
+        Add the post processed plumes of one location to the canvases of the output rasters
+
+        Returns the added tiles, (array, x lower left, y lower left) or None per output raster.
+        """
+        tiles = [None] * len(post_plumes)
+        for index, post_plume in enumerate(post_plumes):
+            if post_plume is None or canvases[index] is None:
+                continue
+            try:
+                if isinstance(post_plume, tuple):
+                    array, x_lower_left, y_lower_left = post_plume
                 else:
-                    ylist = np.arange(-edge, edge) * self.plume_cell_size  # + self.plume_cell_size / 2
+                    post_plume = self.raster_to_grid(post_plume)
+                    if post_plume is None:
+                        continue
+                    array, x_lower_left, y_lower_left = post_plume
+                canvases[index].add(array, x_lower_left, y_lower_left)
+                tiles[index] = (array, x_lower_left, y_lower_left)
+            except Exception as e:
+                arcpy.AddMessage("[Error]: Failed to mosaic plume {}: ".format(ostdsid) + str(e))
+                arcpy.AddMessage("Skip the plume: {} for {} calculation.".format(
+                    ostdsid, ["NH4-N", "NO3-N", "PO4-P"][index]))
+        return tiles
 
-                no3result = np.zeros((2, 2))
-                nh4result = np.zeros((2, 2))
-                phoresult = np.zeros((2, 2))
+    def write_canvases(self, canvases, plume_name, directories, window=None):
+        """
+        Write the summed plumes of the canvases to the output rasters plume_name, an empty raster for empty canvases
 
-                if dr3 is not None:
-                    no3result = dr3.eval(xlist, ylist, 0)
-                if dr4 is not None:
-                    nh4result = dr4.eval(xlist, ylist, 0)
-                if drp is not None:
-                    phoresult = drp.eval(xlist, ylist, 0)
+        The medium post process is applied to the summed plumes, the canvases are clipped to window (grid indices)
+        afterwards.
+        """
+        for index, canvas in enumerate(canvases):
+            if canvas is None:
+                continue
+            output = os.path.join(directories[index], plume_name[index])
+            _, file_extension = os.path.splitext(plume_name[index])
+            wait_time = 0
+            while bool(file_extension) and is_file_locked(output):
+                arcpy.AddMessage("The output raster is used by other software, waiting for 1 second...\n")
+                time.sleep(1)
+                wait_time += 1
+                if wait_time > 60:
+                    raise Exception("The output raster {} is used by other software.".format(output))
+            if arcpy.Exists(output):
+                arcpy.management.Delete(output)
+            if self.post_process == "medium":
+                self.post_process_medium(canvas)
+            if window is not None:
+                canvas.clip(*window)
+            # sums below the threshold are the round off left by the updates of the source cache
+            floor = 1E-3 * self.threshold if self.source_cache_dir else 0.0
+            array, corner = canvas.result(floor=floor, dtype=np.float32)
+            if array is None:
+                arcpy.management.CreateRasterDataset(directories[index], plume_name[index], self.plume_cell_size,
+                                                     self.pixeltype, self.crs, 1)
+            else:
+                raster = arcpy.NumPyArrayToRaster(array, arcpy.Point(*corner), self.plume_cell_size,
+                                                  self.plume_cell_size)
+                raster.save(output)
+                arcpy.management.DefineProjection(output, self.crs)
+            canvas.close()
 
-                if "NO3-N" in self.contaminant_list and "NH4-N" in self.contaminant_list:
-                    no3result = no3result - self.knh4 / (self.knh4 - self.kno3) * nh4result
+    def reference_size(self, max_dist):
+        """
+        Rows of the source plane, columns of the reference plume and columns up to max_dist
+        """
+        ny = int(self.Y / self.plume_cell_size)
+        nx = math.ceil(max_dist / self.plume_cell_size)
+        nx_old = nx
+        if self.post_process != 'none':
+            nx = nx + int(ny * self.multiplier)
+        return ny, nx, nx_old
+
+    def reference_models(self, mean_poro, mean_velo, no3_conc, nh4_conc, pho_conc):
+        """
+        Solutions of NH4-N, NO3-N and PO4-P for the concentrations of a location, None for the species not calculated
 
-                if no3result[0, :].any() > self.threshold or nh4result[0, :].any() > self.threshold or \
-                    phoresult[0, :].any() > self.threshold:
-                    edge = edge + 100
-                else:
-                    break
+        Sets the decay coefficients and the source thicknesses of the location used by plume_statistics.
+        """
+        # the concentrations of the location, as set by get_initial_conc
+        if "NO3-N" in self.contaminant_list:
+            self.no3_init = no3_conc
+        if "NH4-N" in self.contaminant_list:
+            self.nh4_init = nh4_conc
+        if "PO4-P" in self.contaminant_list:
+            self.pho_init = pho_conc
+        dr3 = None
+        dr4 = None
+        drp = None
+
+        if "NH4-N" in self.contaminant_list:
+            self.kno3 = self.denitrification_rate
+            self.knh4 = self.nitrification_rate * (1 + self.nh4_adsorption * self.bulk_density / mean_poro)
+            self.ano3 = no3_conc + self.knh4 / (self.knh4 - self.kno3) * nh4_conc
+            self.anh4 = nh4_conc
+            if self.solute_mass_type.lower() == 'specified input mass rate':
+                a2 = self.no3_init + self.nh4_init * self.knh4 / (self.knh4 - self.kno3)
+                # dispcons = -(self.kno3 / (self.kno3 - self.knh4)) * self.anh4 * (
+                #         0.5 + 0.5 * math.sqrt(1 + 4 * self.knh4 * self.no3_dispx / mean_velo))
+                # dispcons1 = a2 * (0.5 + 0.5 * math.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo))
+                dispcons = 1 + np.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo)
+                mass_in_no3 = self.mass_in * self.no3_init / (self.no3_init + self.nh4_init)
+                self.no3_Z = mass_in_no3 * 2 / (self.Y * mean_poro * mean_velo * self.vol_conversion_factor *
+                                                self.no3_init * dispcons)
+                dispcons = 1 + np.sqrt(1 + 4 * self.knh4 * self.nh4_dispx / mean_velo)
+                # dispcons1 = a2 * (0.5 + 0.5 * math.sqrt(1 + 4 * self.kno3 * self.nh4_dispx / mean_velo))
+                mass_in_nh4 = self.mass_in * self.nh4_init / (self.no3_init + self.nh4_init)
+                self.nh4_Z = mass_in_nh4 * 2 / (self.Y * mean_poro * mean_velo * self.vol_conversion_factor *
+                                                self.nh4_init * dispcons)
+                if self.nh4_Z < 0:
+                    self.nh4_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
+                if self.no3_Z < 0:
+                    self.no3_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
+                if self.zmax_option:
+                    if self.nh4_Z > self.zmax:
+                        self.nh4_Z = self.zmax
+                    if self.no3_Z > self.zmax:
+                        self.no3_Z = self.zmax
+            else:
+                self.no3_Z = self.Z
+                self.nh4_Z = self.Z
+
+            dr4 = DomenicoRobbins(self.solution_type, self.anh4, self.nh4_dispx, self.nh4_dispyz, self.nh4_dispyz,
+                                  self.Y, self.nh4_Z, self.knh4, mean_velo, -1)
+
+            dr3 = DomenicoRobbins(self.solution_type, self.ano3, self.no3_dispx, self.no3_dispyz, self.no3_dispyz,
+                                  self.Y, self.no3_Z, self.kno3, mean_velo, -1)
+
+        elif "NO3-N" in self.contaminant_list and "NH4-N" not in self.contaminant_list:
+            self.kno3 = self.denitrification_rate
+            self.ano3 = no3_conc
+            self.knh4 = 0.0
+            self.anh4 = 0.0
+            if self.solute_mass_type.lower() == 'specified input mass rate':
+                self.no3_Z = self.mass_in * 2 / (
+                             self.Y * mean_poro * mean_velo * self.ano3 * self.vol_conversion_factor * (
+                             1 + math.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo)))
+                if self.no3_Z < 0:
+                    self.no3_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
+                if self.zmax_option:
+                    if self.no3_Z > self.zmax:
+                        self.no3_Z = self.zmax
+            else:
+                self.no3_Z = self.Z
+            dr3 = DomenicoRobbins(self.solution_type, self.ano3, self.no3_dispx, self.no3_dispyz, self.no3_dispyz,
+                                  self.Y, self.no3_Z, self.kno3, mean_velo, -1)
+        if "PO4-P" in self.contaminant_list:
+            self.apho = pho_conc
+            if self.phos_choice.lower() == 'linear':
+                self.kpho = self.phos_prep * (1 + self.phos_kd * self.bulk_density / mean_poro)
+            else:
+                self.kpho = (1 + self.bulk_density / mean_poro * self.phos_smax * self.phos_kl / (
+                                1 + self.phos_kl * self.apho)) * self.phos_prep
+            if self.solute_mass_type.lower() == 'specified input mass rate':
+                self.phos_Z = self.mass_in_phos * 2 / (
+                             self.Y * mean_poro * mean_velo * self.apho * self.vol_conversion_factor * (
+                             1 + math.sqrt(1 + 4 * self.apho * self.phos_dispx / mean_velo)))
+                if self.phos_Z < 0:
+                    self.phos_Z = min(0.0001, self.zmax) if self.zmax_option else 0.0001
+                if self.zmax_option:
+                    if self.phos_Z > self.zmax:
+                        self.phos_Z = self.zmax
+            else:
+                self.phos_Z = self.Z
+            drp = DomenicoRobbins(self.solution_type, self.apho, self.phos_dispx, self.phos_dispyz, self.phos_dispyz,
+                                  self.Y, self.phos_Z, self.kpho, mean_velo, -1)
+        return [dr4, dr3, drp]
+
+    def reference_plumes(self, models, xlist):
+        """
+        Separable plumes of the solutions of reference_models over the columns xlist, NO3-N net of the nitrified NH4-N
+        """
+        results = [None if dr is None else dr.separable(xlist) for dr in models]
+        if "NO3-N" in self.contaminant_list and "NH4-N" in self.contaminant_list:
+            results[1] = results[1].combine(results[0], -self.knh4 / (self.knh4 - self.kno3))
+        return results
+
+    def calculate_single_plume(self, pathid, mean_poro, mean_velo, max_dist, initial=None, half_widths=None):
+        """
+        Calculate a single plume
+
+        initial, (point, no3_conc, nh4_conc, pho_conc) of get_initial_conc, queried if None
+        half_widths, half widths of the separable plumes of NH4-N, NO3-N and PO4-P at the threshold, e.g. from
+                     size_plumes, solved here if None
+        """
+        try:
+            if initial is None:
+                initial = self.get_initial_conc(pathid)
+            point, no3_conc, nh4_conc, pho_conc = initial
+            ny, nx, nx_old = self.reference_size(max_dist)
+
+            self.band_plumes = [None, None, None]
+            self.plume_columns = [None, None, None]
+            if no3_conc < self.threshold and nh4_conc < self.threshold and pho_conc < self.threshold:
+                return [None, None, None], [None, None, None, None]
+
+            dr4, dr3, drp = self.reference_models(mean_poro, mean_velo, no3_conc, nh4_conc, pho_conc)
+
+            # calculate the plume
+            xlist = np.arange(1, nx + 1) * self.plume_cell_size  # - self.plume_cell_size / 2
+            separable = self.solution_type in SEPARABLE_SOLUTIONS
+            columns = None
+            if separable:
+                # keep the plumes in factored form and size the grid by the analytic half widths
+                results = self.reference_plumes([dr4, dr3, drp], xlist)
+                if half_widths is None:
+                    half_widths = [None if plume is None else plume.half_widths(self.threshold, HALF_WIDTH_TOLERANCE)
+                                   for plume in results]
+                half_width = max(widths.max(initial=0) for widths in half_widths if widths is not None)
+                edge = max(math.ceil(half_width / self.plume_cell_size) + 2, math.ceil(ny / 2) + 1)
+                ylist = self.get_plume_ylist(ny, edge)
+                if self.plume_grid_tolerance:
+                    # multi-resolution grid, fine near the source and the plume margins. The species keep the
+                    # union of their columns, so they still share the lateral kernels.
+                    subset = np.arange(0)
+                    for plume, widths in zip(results, half_widths):
+                        if plume is not None:
+                            subset = np.union1d(subset, plume.adaptive_columns(
+                                self.threshold, self.plume_grid_tolerance, self.output_times, self.output_depths,
+                                half_widths=widths))
+                    if 0 < len(subset) < len(xlist):
+                        results = [None if plume is None else plume.select(subset) for plume in results]
+                        half_widths = [None if widths is None else widths[subset] for widths in half_widths]
+                        # the source column is followed by the columns of xlist
+                        columns = np.concatenate(([0], subset + 1))
+            else:
+                edge = 500
+                while True:
+                    ylist = self.get_plume_ylist(ny, edge)
+
+                    no3result = np.zeros((2, 2))
+                    nh4result = np.zeros((2, 2))
+                    phoresult = np.zeros((2, 2))
+
+                    if dr3 is not None:
+                        no3result = dr3.eval(xlist, ylist, 0)
+                    if dr4 is not None:
+                        nh4result = dr4.eval(xlist, ylist, 0)
+                    if drp is not None:
+                        phoresult = drp.eval(xlist, ylist, 0)
+
+                    if "NO3-N" in self.contaminant_list and "NH4-N" in self.contaminant_list:
+                        no3result = no3result - self.knh4 / (self.knh4 - self.kno3) * nh4result
+
+                    if no3result[0, :].any() > self.threshold or nh4result[0, :].any() > self.threshold or \
+                        phoresult[0, :].any() > self.threshold:
+                        edge = edge + 100
+                    else:
+                        break
+                results = [nh4result, no3result, phoresult]
 
             check = [dr4, dr3, drp]
-            results = [nh4result, no3result, phoresult]
+            plumeys = []
+            for inivalue in [nh4_conc, no3_conc, pho_conc]:
+                plumey = np.zeros((len(ylist)), dtype=self.plume_dtype)
+                if ny % 2 != 0:
+                    plumey[math.floor(len(ylist) / 2) - math.floor(ny / 2):
+                           math.floor(len(ylist) / 2) - math.floor(ny / 2) + ny] = inivalue
+                else:
+                    plumey[math.floor(len(ylist) / 2 - ny / 2):
+                           math.floor(len(ylist) / 2 + ny / 2)] = inivalue
+                plumeys.append(plumey)
+
+            if separable:
+                # materialize only the bounding box of the cells above the threshold, the edge rows of the grid
+                # are outside of the analytic half widths. Species with the same dispersivities share the erfs.
+                indices = [index for index, plume in enumerate(results) if plume is not None]
+                boxes = []
+                for index in indices:
+                    rows, cols = results[index].extent(ylist, self.threshold, half_widths=half_widths[index])
+                    rows = np.flatnonzero(rows | (plumeys[index] > self.threshold))
+                    rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+                    cols = np.flatnonzero(cols)
+                    cols = slice(0, cols[-1] + 1 if len(cols) else 0)
+                    plumeys[index] = plumeys[index][rows]
+                    boxes.append((rows, cols))
+                if self.output_times or self.output_depths:
+                    # the kernels are shared by all bands, the steady-state box bounds the transient and 3D plumes
+                    for index, (rows, cols) in zip(indices, boxes):
+                        stacks = []
+                        if self.output_times:
+                            stacks.append(results[index].eval_times(ylist[rows], self.output_times, cols))
+                        if self.output_depths:
+                            stacks.append(results[index].eval_depths(ylist[rows], self.output_depths, cols))
+                        self.band_plumes[index] = np.concatenate(stacks)
+                tiles = eval_shared([results[index] for index in indices], ylist, boxes)
+                for index, tile in zip(indices, tiles):
+                    results[index] = tile
+
             filtered_results = []
             for index, type_cont in enumerate(check):
                 if type_cont is not None:
                     plumeresult = results[index]
-                    if index == 0:
-                        inivalue = nh4_conc
-                    elif index == 1:
-                        inivalue = no3_conc
-                    else:
-                        inivalue = pho_conc
-                    if plumeresult[0, :].all() <= self.threshold and plumeresult[-1, :].all() <= self.threshold:
-                        plumey = np.zeros((len(ylist)))
-                        if ny % 2 != 0:
-                            plumey[math.floor(len(ylist) / 2) - math.floor(ny / 2):
-                                   math.floor(len(ylist) / 2) - math.floor(ny / 2) + ny] = inivalue
-                        else:
-                            plumey[math.floor(len(ylist) / 2 - ny / 2):
-                                   math.floor(len(ylist) / 2 + ny / 2)] = inivalue
+                    plumey = plumeys[index]
+                    if separable or (plumeresult[0, :].all() <= self.threshold and
+                                     plumeresult[-1, :].all() <= self.threshold):
                         plumeresult = np.hstack((plumey.reshape(-1, 1), plumeresult))
 
                         row_to_delete = np.all(plumeresult <= self.threshold, axis=1)
@@ -687,6 +1163,20 @@ class Transport:
                         cols_to_delete = np.all(filtered_result <= self.threshold, axis=0)
                         filtered_result = filtered_result[:, ~cols_to_delete]
                         filtered_results.append(filtered_result)
+                        if columns is not None:
+                            plume_columns = columns[:len(cols_to_delete)][~cols_to_delete]
+                            if len(plume_columns) and plume_columns[-1] >= len(plume_columns):
+                                self.plume_columns[index] = plume_columns
+
+                        if self.band_plumes[index] is not None:
+                            # the source plane spans the depths 0 <= z <= Z of the species
+                            source_z = self.nh4_Z if index == 0 else self.no3_Z if index == 1 else self.phos_Z
+                            band_sources = np.concatenate((np.ones(len(self.output_times)),
+                                                           np.less(self.output_depths, source_z)))
+                            source = band_sources.reshape(-1, 1, 1) * plumey.reshape(1, -1, 1)
+                            band_plume = np.concatenate((source.astype(self.plume_dtype), self.band_plumes[index]),
+                                                        axis=2)
+                            self.band_plumes[index] = band_plume[:, ~row_to_delete][:, :, ~cols_to_delete]
                 else:
                     filtered_results.append(None)
 
@@ -694,16 +1184,16 @@ class Transport:
             nh4_plume_len = nx_old
             pho_plume_len = nx_old
             # if self.post_process != 'none':
-            if filtered_results[0] is not None and filtered_results[0].shape[1] < nx_old:
-                nh4_plume_len = filtered_results[0].shape[1]
+            if filtered_results[0] is not None and self.plume_length(filtered_results[0], 0) < nx_old:
+                nh4_plume_len = self.plume_length(filtered_results[0], 0)
             elif filtered_results[0] is None:
                 nh4_plume_len = 0
-            if filtered_results[1] is not None and filtered_results[1].shape[1] < nx_old:
-                no3_plume_len = filtered_results[1].shape[1]
+            if filtered_results[1] is not None and self.plume_length(filtered_results[1], 1) < nx_old:
+                no3_plume_len = self.plume_length(filtered_results[1], 1)
             elif filtered_results[1] is None:
                 no3_plume_len = 0
-            if filtered_results[2] is not None and filtered_results[2].shape[1] < nx_old:
-                pho_plume_len = filtered_results[2].shape[1]
+            if filtered_results[2] is not None and self.plume_length(filtered_results[2], 2) < nx_old:
+                pho_plume_len = self.plume_length(filtered_results[2], 2)
             elif filtered_results[2] is None:
                 pho_plume_len = 0
             output_list = [point, nh4_plume_len, no3_plume_len, pho_plume_len]
@@ -714,165 +1204,197 @@ class Transport:
             arcpy.AddMessage("Skip the plume: {} for calculation.".format(pathid))
             return None, None
 
-    def calculate_info(self, filtered, tmp_list, pathid, mean_poro, mean_velo, mean_angle,
-                       max_dist, maxtime, wbid, path_wbid):
+    def plume_length(self, plume, index):
         """
-        Calculate the info file
+        Length [cells] of the reference plume of the species index, the columns of multi-resolution plumes skip cells
         """
-        point = tmp_list[0]
-        segments = []
+        columns = self.plume_columns[index]
+        return plume.shape[1] if columns is None else int(columns[-1]) + 1
 
+    def get_plume_ylist(self, ny, edge):
+        """
+        Get the y coordinates of the rows of a reference plume, edge rows on each side of the center line
+        """
+        if ny % 2 != 0:
+            return np.arange(-edge, edge + 1) * self.plume_cell_size
+        else:
+            return np.arange(-edge, edge) * self.plume_cell_size  # + self.plume_cell_size / 2
+
+    def plume_statistics(self, filtered, tmp_list, max_dist):
+        """
+        Reductions of the plumes of one location used by calculate_info, None for the species without plume
+
+        Per species: source Z, decay coefficient, whether the plume is empty, plume length [cells], cells above the
+        threshold, source rows, summed concentration next to the source rows, summed concentration downstream of
+        the source, maximum concentration next to the source and the concentration at the water body.
+        """
+        statistics = []
         for index, plume in enumerate(filtered):
-            if plume is not None:
-                if index == 0:
-                    plume_name = "NH4-N"
-                    z_value = self.nh4_Z
-                    init_value = self.nh4_init
-                    dispx = self.nh4_dispx
-                    dispyz = self.nh4_dispyz
-                    kvalue = self.knh4
-                elif index == 1:
-                    plume_name = "NO3-N"
-                    z_value = self.no3_Z
-                    init_value = self.no3_init
-                    dispx = self.no3_dispx
-                    dispyz = self.no3_dispyz
-                    kvalue = self.kno3
-                else:
-                    plume_name = "PO4-P"
-                    z_value = self.phos_Z
-                    init_value = self.pho_init
-                    dispx = self.phos_dispx
-                    dispyz = self.phos_dispyz
-                    kvalue = self.kpho
-
-                if plume.shape[1] < 1:
-                    segment = [point, pathid, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-                               0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-                    segments.append(segment)
-                    continue
+            if plume is None:
+                statistics.append(None)
+                continue
+            if index == 0:
+                z_value, kvalue = self.nh4_Z, self.knh4
+            elif index == 1:
+                z_value, kvalue = self.no3_Z, self.kno3
+            else:
+                z_value, kvalue = self.phos_Z, self.kpho
+            if plume.shape[1] < 1:
+                statistics.append((z_value, kvalue, 1, 0, 0, 0, 0, 0, 0, 0))
+                continue
 
-                plumelen = tmp_list[index + 1] * self.plume_cell_size
-                plume_result = plume[:, 0: tmp_list[index + 1]]
+            plumelen = tmp_list[index + 1]
+            wb_col = int(min(plumelen * self.plume_cell_size, max_dist) / self.plume_cell_size) - 1
+            plume_result, area, next_column, downstream_sum, wb_conc = column_reductions(
+                plume, self.plume_columns[index], plumelen, wb_col, self.threshold)
+            if next_column is not None:
+                source_rows = plume_result[:, 0] != 0
+                count = np.count_nonzero(source_rows)
+                next_sum = next_column[source_rows].sum()
+                next_conc = next_column.max()
+            else:
+                count, next_sum, next_conc = 1, 0, 0
+            statistics.append((z_value, kvalue, 0, plumelen, area, count, next_sum, downstream_sum, next_conc,
+                               wb_conc))
+        return statistics
 
-                plume_area = (plume_result > self.threshold).sum() * self.plume_cell_size ** 2
-                non_zero_indices = np.nonzero(plume_result[:, 0])
-                if plume_result.shape[1] > 1:
-                    massinratemt3d = (
-                                mean_poro * self.plume_cell_size * z_value * mean_velo * self.vol_conversion_factor * (
-                                    init_value - dispx * (
-                                        plume_result[non_zero_indices, 1] - init_value) / self.plume_cell_size)).sum()
-                else:
-                    massinratemt3d = (mean_poro * self.plume_cell_size * z_value * mean_velo *
-                                      self.vol_conversion_factor * (init_value - dispx * (0 - init_value) / self.plume_cell_size))
+    def calculate_info(self, sources):
+        """
+        Calculate the info records of all locations at once
 
+        sources, per location [ostdsid, (x, y), plume statistics, mean_poro, mean_velo, mean_angle, max_dist,
+        maxtime, wbid, path_wbid, (nh4_init, no3_init, pho_init)]. Returns one structured array of INFO_FIELDS
+        (and the location XY) per species, NH4-N, NO3-N and PO4-P, None for the species that are not calculated.
+        """
+        dtype = np.dtype([("XY", np.float64, 2)] + INFO_FIELDS)
+        names = ["NH4-N", "NO3-N", "PO4-P"]
+        infos = [np.zeros(0, dtype) if name in self.contaminant_list else None for name in names]
+        if not sources:
+            return infos
+
+        number = len(sources)
+        ostdsid = np.array([source[0] for source in sources])
+        xy = np.array([source[1] for source in sources], dtype=np.float64)
+        mean_poro, mean_velo, mean_angle, max_dist, maxtime, wbid, path_wbid = np.array(
+            [source[3:10] for source in sources], dtype=np.float64).T
+        initial = np.array([source[10] for source in sources], dtype=np.float64)
+        # statistics[species, location], NaN for the species without plume
+        statistics = np.full((3, number, 10), np.nan)
+        for location, source in enumerate(sources):
+            for index, plume_statistics in enumerate(source[2]):
+                if plume_statistics is not None:
+                    statistics[index, location] = plume_statistics
+
+        cell_size = self.plume_cell_size
+        factor = self.vol_conversion_factor
+        dispersivities = [(self.nh4_dispx, self.nh4_dispyz) if "NH4-N" in self.contaminant_list else (0, 0),
+                          (self.no3_dispx, self.no3_dispyz) if "NO3-N" in self.contaminant_list else (0, 0),
+                          (self.phos_dispx, self.phos_dispyz) if "PO4-P" in self.contaminant_list else (0, 0)]
+        nitrogen = "NH4-N" in self.contaminant_list and "NO3-N" in self.contaminant_list
+        processes = {"none": 0, "medium": 1, "full": 2}[self.post_process]
+        warp_method = {"spline": 0, "polyorder1": 1, "polyorder2": 2}[self.warp_method]
+
+        massmdn = np.zeros((3, number))
+        for index in range(3):
+            if infos[index] is None:
+                continue
+            z_value, kvalue, empty, plumelen, area, count, next_sum, downstream_sum, next_conc, wb_conc = \
+                statistics[index].T
+            init_value = initial[:, index]
+            dispx, dispyz = dispersivities[index]
+
+            massinratemt3d = mean_poro * cell_size * z_value * mean_velo * factor * (
+                count * init_value - dispx * (next_sum - count * init_value) / cell_size)
+            with np.errstate(divide='ignore', invalid='ignore'):
                 if self.solute_mass_type.lower() == 'specified input mass rate':
                     dombdy = 1
-                    if "NH4-N" in self.contaminant_list and "NO3-N" in self.contaminant_list:
-                        if index == 0:
-                            massin = self.mass_in * self.nh4_init / (self.nh4_init + self.no3_init)
-                        elif index == 1:
-                            massin = self.mass_in * self.no3_init / (self.nh4_init + self.no3_init)
-                    elif "NO3-N" in self.contaminant_list and "NH4-N" not in self.contaminant_list:
-                        if index == 1:
-                            massin = self.mass_in
-                    if "PO4-P" in self.contaminant_list:
-                        if index == 2:
-                            massin = self.mass_in_phos
-                elif self.solute_mass_type.lower() == 'specified z':
-                    dombdy = 2
-                    if "NH4-N" in self.contaminant_list and "NO3-N" in self.contaminant_list:
-                        if index == 0:
-                            massin = mean_velo * mean_poro * z_value * self.Y * self.vol_conversion_factor * \
-                                     init_value * (0.5 + 0.5 * math.sqrt(1 + (4 * self.knh4 * dispx) / mean_velo))
-                        elif index == 1:
-                            dispcon0 = 0.5 * self.nh4_init * (self.knh4 / (self.knh4 - self.kno3)) * (
-                                    math.sqrt(1 + 4 * self.kno3 * self.no3_dispx / mean_velo) - math.sqrt(
-                                1 + (4 * self.knh4 * self.no3_dispx) / mean_velo))
-                            dispcon1 = self.no3_init * (
-                                        0.5 + 0.5 * math.sqrt(1 + (4 * self.kno3 * self.no3_dispx) / mean_velo))
-                            massin = mean_velo * mean_poro * self.no3_Z * self.Y * self.vol_conversion_factor * max(
-                                dispcon1, dispcon1 + dispcon0)
-                    elif "NO3-N" in self.contaminant_list and "NH4-N" not in self.contaminant_list:
-                        if index == 1:
-                            massin = mean_velo * mean_poro * z_value * self.Y * self.vol_conversion_factor * \
-                                     init_value * (0.5 + 0.5 * math.sqrt(1 + (4 * self.kno3 * dispx) / mean_velo))
-                            # advcon = mean_velo * mean_poro * z_value * self.Y * self.vol_conversion_factor * init_value
-                            # nonzero_indices = np.flatnonzero(plume_result[:, 0])
-                            # discon = mean_velo * mean_poro * z_value * self.vol_conversion_factor * \
-                            #     dispx * (plume_result[nonzero_indices, 1] - init_value).sum()
-                            # massin = advcon - discon
-                    if "PO4-P" in self.contaminant_list:
-                        if index == 2:
-                            massin = mean_velo * mean_poro * z_value * self.Y * self.vol_conversion_factor * \
-                                     init_value * (0.5 + 0.5 * math.sqrt(1 + (4 * self.kpho * dispx) / mean_velo))
-
-                plume_nextconc = 0
-                if plume_name == "NO3-N":
-                    massmdn = (self.kno3 * mean_poro * self.no3_Z * self.plume_cell_size * self.plume_cell_size *
-                               self.vol_conversion_factor * plume_result[:, 1:]).sum()
-                    if plume_result.shape[1] > 1:
-                        plume_nextconc = plume_result[:, 1].max()
-                    if "NH4-N" in self.contaminant_list:
-                        load = self.nh4massmdn + massin - massmdn
+                    if index == 2:
+                        massin = np.full(number, float(self.mass_in_phos))
+                    elif nitrogen:
+                        massin = self.mass_in * init_value / (initial[:, 0] + initial[:, 1])
                     else:
-                        load = massin - massmdn
-                elif plume_name == "NH4-N":
-                    massmdn = (self.knh4 * mean_poro * self.nh4_Z * self.plume_cell_size * self.plume_cell_size *
-                               self.vol_conversion_factor * plume_result[:, 1:]).sum()
-                    self.nh4massmdn = massmdn
-                    if plume_result.shape[1] > 1:
-                        plume_nextconc = plume_result[:, 1].max()
-                    load = massin - massmdn
-                else:
-                    massmdn = (self.kpho * mean_poro * self.phos_Z * self.plume_cell_size * self.plume_cell_size *
-                               self.vol_conversion_factor * plume_result[:, 1:]).sum()
-                    if plume_result.shape[1] > 1:
-                        plume_nextconc = plume_result[:, 1].max()
-                    load = massin - massmdn
-
-                if self.post_process == "none":
-                    processes = 0
-                elif self.post_process == "medium":
-                    processes = 1
-                elif self.post_process == "full":
-                    processes = 2
-
-                if self.warp_method == "spline":
-                    warp_method = 0
-                elif self.warp_method == "polyorder1":
-                    warp_method = 1
-                elif self.warp_method == "polyorder2":
-                    warp_method = 2
-
-                if plumelen < max_dist:
-                    wbid = -1
-                else:
-                    plumelen = max_dist
-                    wbid = wbid
-                nrow, ncol = plume_result.shape
-                if int(plumelen/self.plume_cell_size) - 1 < ncol:
-                    wb_conc = plume_result[nrow//2, int(plumelen/self.plume_cell_size) - 1]
+                        massin = np.full(number, float(self.mass_in))
                 else:
-                    wb_conc = plume_result[nrow//2, ncol - 1]
-
-                if load < 0:
-                    load = 0
-                if wbid == -1:
-                    load = 0
-
-                # if massin < massmdn:
-                #     massmdn = massin
-
-                segment = [point, pathid, 1, dombdy, kvalue, mean_velo, mean_poro, dispx, dispyz, 0, self.Y,
-                           z_value, self.plume_cell_size, self.plume_cell_size, z_value, -1, maxtime, plumelen,
-                           max_dist, plume_area, massinratemt3d, massin, massmdn, mean_angle, warp_method, processes,
-                           init_value, self.vol_conversion_factor, plume_nextconc, self.threshold, wbid, path_wbid,
-                           load, wb_conc]
-                segments.append(segment)
-            else:
-                segments.append(None)
-        return segments
+                    dombdy = 2
+                    massin = mean_velo * mean_poro * z_value * self.Y * factor * init_value * (
+                        0.5 + 0.5 * np.sqrt(1 + (4 * kvalue * dispx) / mean_velo))
+                    if index == 1 and nitrogen:
+                        knh4 = statistics[0, :, 1]
+                        dispcon0 = 0.5 * initial[:, 0] * (knh4 / (knh4 - kvalue)) * (
+                            np.sqrt(1 + 4 * kvalue * dispx / mean_velo) - np.sqrt(1 + (4 * knh4 * dispx) / mean_velo))
+                        dispcon1 = init_value * (0.5 + 0.5 * np.sqrt(1 + (4 * kvalue * dispx) / mean_velo))
+                        massin = mean_velo * mean_poro * z_value * self.Y * factor * np.maximum(
+                            dispcon1, dispcon1 + dispcon0)
+
+            massmdn[index] = kvalue * mean_poro * z_value * cell_size * cell_size * factor * downstream_sum
+            load = massin - massmdn[index]
+            if index == 1 and nitrogen:
+                load = load + np.nan_to_num(massmdn[0])
+
+            # the plumes reaching the end of the flow path discharge into the water body
+            reached = plumelen * cell_size >= max_dist
+            length = np.where(reached, max_dist, plumelen * cell_size)
+            load = np.where(reached, np.maximum(load, 0), 0)
+
+            info = np.zeros(number, dtype)
+            info["XY"] = xy
+            info["OSTDS_ID"] = ostdsid
+            info["is2D"] = 1
+            info["domBdy"] = dombdy
+            info["decayCoeff"] = kvalue
+            info["avgVel"] = mean_velo
+            info["avgPrsity"] = mean_poro
+            info["DispL"] = dispx
+            info["DispTH"] = dispyz
+            info["SourceY"] = self.Y
+            info["SourceZ"] = z_value
+            info["MeshDX"] = cell_size
+            info["MeshDY"] = cell_size
+            info["MeshDZ"] = z_value
+            info["plumeTime"] = -1
+            info["pathTime"] = maxtime
+            info["plumeLen"] = length
+            info["pathLen"] = max_dist
+            info["plumeArea"] = area * cell_size ** 2
+            info["mslnRtNmr"] = massinratemt3d
+            info["massInRate"] = massin
+            info["massRMRate"] = massmdn[index]
+            info["avgAngle"] = mean_angle
+            info["warp"] = warp_method
+            info["PostP"] = processes
+            info["Init_conc"] = init_value
+            info["volFac"] = factor
+            info["nextConc"] = next_conc
+            info["threshConc"] = self.threshold
+            info["WBId_plume"] = np.where(reached, wbid, -1)
+            info["WBId_path"] = path_wbid
+            info["load"] = load
+            info["wb_conc"] = wb_conc
+
+            # the records of empty plumes only have the location
+            empty = empty == 1
+            for name, _ in INFO_FIELDS[2:]:
+                info[name][empty] = 0
+            infos[index] = info[~np.isnan(statistics[index, :, 0])]
+        return infos
+
+    def write_info(self, info_names, infos):
+        """
+        Append the info records of calculate_info to the info shapefiles of create_new_plume_data_shapefile
+        """
+        for index, (infoname, info) in enumerate(zip(info_names, infos)):
+            if infoname is None or info is None or len(info) == 0:
+                continue
+            try:
+                # one bulk append instead of a cursor insert per record
+                records = r'memory\info_{}'.format(index)
+                if arcpy.Exists(records):
+                    arcpy.management.Delete(records)
+                arcpy.da.NumPyArrayToFeatureClass(info, records, ["XY"], self.crs)
+                arcpy.management.Append(records, infoname, "NO_TEST")
+                arcpy.management.Delete(records)
+            except Exception as e:
+                arcpy.AddMessage("[Error]: Failed to write the info file {}: ".format(infoname) + str(e))
 
     def warp_affine_transformation(self, plume_array, pathid, xvalue, yvalue, segment):
         """
@@ -944,15 +1466,125 @@ class Transport:
 
         return name
 
+    def warp_plumes(self, plume_arrays, pathid, xvalue, yvalue, segment):
+        """
+        Warp the plumes with the selected engine, returns the warped plumes, the target body points and the lengths
+
+        The warped plumes are rasters of warp_arcgis, or (array, x lower left, y lower left) of warp_numpy.
+        """
+        if self.warp_engine == "numpy":
+            return self.prepare_warped(*self.warp_numpy(plume_arrays, pathid, xvalue, yvalue, segment), pathid)
+        return self.warp_arcgis(plume_arrays, pathid, xvalue, yvalue, segment)
+
+    def prepare_warped(self, warped_arrays, target_body_pts_list, lengths, pathid):
+        """
+        Drop the empty plumes of warp_numpy
+        """
+        warped_arrays = [None if warped is None or warped[0].max() < self.threshold else warped
+                         for warped in warped_arrays]
+        return warped_arrays, target_body_pts_list, lengths
+
+    def warp_numpy(self, plume_arrays, pathid, xvalue, yvalue, segment):
+        """
+        Warp the plume in memory with PlumeWarp, using the control points and fallbacks of warp_arcgis
+
+        The warped plumes are (array, x lower left, y lower left) on the water body grid, None for skipped plumes.
+        """
+        perstepnum = segment.tot_dist[0] / self.plume_cell_size
+        warped_arrays = []
+        target_body_pts_list = []
+        lengths = []
+
+        for index, plume_array in enumerate(plume_arrays):
+            if plume_array is None:
+                warped_arrays.append(None)
+                target_body_pts_list.append(None)
+                lengths.append(0)
+                continue
+            columns = self.plume_columns[index]
+            length = self.plume_length(plume_array, index)
+            lengths.append(length)
+            target_body_pts = None
+            try:
+                y_lower_left = yvalue - plume_array.shape[0] * self.plume_cell_size / 2
+                if columns is None:
+                    # multi-resolution plumes are cut at the threshold after the interpolation between the columns
+                    plume_array = np.where(plume_array > self.threshold, plume_array, np.nan)
+
+                langle = segment.angle[0:int(length * self.plume_cell_size / segment.tot_dist[0])]
+                if len(langle) > 1:
+                    diffs = (np.diff(langle) + 180) % 360 - 180
+                    maxangle_diff = np.max(np.abs(diffs))
+                else:
+                    maxangle_diff = 90
+
+                pivot = (xvalue, yvalue)
+                if maxangle_diff < 0.1 and abs(langle[0] - 90) < 0.1:
+                    # straight plume, only snapped to the water body grid
+                    transform = rotation(0.0, pivot)
+                    warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size, transform, transform,
+                                        self.snap_x, self.snap_y, order=0, columns=columns)
+                elif length <= perstepnum or maxangle_diff > 30:
+                    angle = self.get_rotation_angle(segment, length)
+                    warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size,
+                                        rotation(angle, pivot), rotation(-angle, pivot),
+                                        self.snap_x, self.snap_y, order=0, columns=columns)
+                else:
+                    try:
+                        center_pts, body_pts = self.get_control_points(plume_array, True, columns)
+                        if body_pts is None:
+                            raise Exception("No body points")
+                        results = self.get_target_points_gis(segment, center_pts, body_pts, xvalue, yvalue)
+                        target_center_pts, origin_center_pts, target_body_pts, origin_body_pts = results
+                        if len(target_center_pts) >= 10:
+                            source_control_points = np.vstack((origin_center_pts, origin_body_pts))
+                            target_control_points = np.vstack((target_center_pts, target_body_pts))
+                        else:
+                            source_control_points = origin_center_pts
+                            target_control_points = target_center_pts
+                        forward = fit_transform(self.warp_method, source_control_points, target_control_points)
+                        inverse = fit_transform(self.warp_method, target_control_points, source_control_points)
+                        warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size, forward, inverse,
+                                            self.snap_x, self.snap_y, order=1, columns=columns)
+                        if warped[0].max() < self.threshold:
+                            raise Exception("Warp error!")
+                    except Exception:
+                        target_body_pts = None
+                        angle = self.get_rotation_angle(segment, length)
+                        warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size,
+                                            rotation(angle, pivot), rotation(-angle, pivot),
+                                            self.snap_x, self.snap_y, order=0, columns=columns)
+                warped[0][warped[0] <= self.threshold] = 0
+                warped_arrays.append(warped)
+            except Exception as e:
+                arcpy.AddMessage("[Error] Plume {} cannot be warped.".format(pathid) + str(e))
+                arcpy.AddMessage("Skip the plume: {} for warp calculation.".format(pathid))
+                warped_arrays.append(None)
+                target_body_pts = None
+            target_body_pts_list.append(target_body_pts)
+        return warped_arrays, target_body_pts_list, lengths
+
+    def get_rotation_angle(self, segment, plumelen):
+        """
+        Counterclockwise angle [rad] from the source to the end of the flow path segment reached by the plume
+        """
+        end_number = int(plumelen * self.plume_cell_size / segment.tot_dist[0])
+        end_number = min(max(end_number, 1), len(segment))
+        return math.atan2(segment.last_y[end_number - 1] - segment.first_y[0],
+                          segment.last_x[end_number - 1] - segment.first_x[0])
+
     def warp_arcgis(self, plume_arrays, pathid, xvalue, yvalue, segment):
         """
         Warp the plume
+
+        The bent plumes are warped by arcpy.management.Warp in the float32 precision of the plume raster, the
+        straight and rotated plumes are sampled in memory like warp_numpy. Returns raster names or (array,
+        x lower left, y lower left), None for skipped plumes.
         """
-        perstepnum = segment['TotDist'].iloc[0] / self.plume_cell_size
+        perstepnum = segment.tot_dist[0] / self.plume_cell_size
         warped_plumes = []
         target_body_pts_list = []
         lengths = []
-        target_body_pts_term = None
 
         for index, plume_array in enumerate(plume_arrays):
             if plume_array is None:
@@ -960,23 +1592,35 @@ class Transport:
                 target_body_pts_list.append(None)
                 lengths.append(0)
                 continue
-            else:
-                lengths.append(plume_array.shape[1])
-                try:
-                    y_lower_left = yvalue - plume_array.shape[0] * self.plume_cell_size / 2
-                    plume_array[plume_array <= self.threshold] = np.nan
-                    plume_array = plume_array.astype(np.float32)
-
-                    langle = np.array(segment['DirAngle'][
-                                      0:int(plume_array.shape[1] * self.plume_cell_size / segment['TotDist'].iloc[0])])
-                    if len(langle) > 1:
-                        diffs = (np.diff(langle) + 180) % 360 - 180
-                        maxangle_diff = np.max(np.abs(diffs))
-                    else:
-                        maxangle_diff = 90
-
-                    plume_raster = arcpy.NumPyArrayToRaster(plume_array, arcpy.Point(xvalue, y_lower_left),
-                                                            self.plume_cell_size, self.plume_cell_size)
+            columns = self.plume_columns[index]
+            length = self.plume_length(plume_array, index)
+            lengths.append(length)
+            target_body_pts = None
+            try:
+                y_lower_left = yvalue - plume_array.shape[0] * self.plume_cell_size / 2
+                if columns is None:
+                    # multi-resolution plumes are cut at the threshold after the interpolation between the columns
+                    plume_array = np.where(plume_array > self.threshold, plume_array, np.nan).astype(np.float32)
+
+                langle = segment.angle[0:int(length * self.plume_cell_size / segment.tot_dist[0])]
+                if len(langle) > 1:
+                    diffs = (np.diff(langle) + 180) % 360 - 180
+                    maxangle_diff = np.max(np.abs(diffs))
+                else:
+                    maxangle_diff = 90
+
+                pivot = (xvalue, yvalue)
+                if maxangle_diff < 0.1 and abs(langle[0] - 90) < 0.1:
+                    # straight plume, only snapped to the water body grid
+                    transform = rotation(0.0, pivot)
+                    warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size, transform, transform,
+                                        self.snap_x, self.snap_y, order=0, columns=columns)
+                elif length <= perstepnum or maxangle_diff > 30:
+                    angle = self.get_rotation_angle(segment, length)
+                    warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size,
+                                        rotation(angle, pivot), rotation(-angle, pivot),
+                                        self.snap_x, self.snap_y, order=0, columns=columns)
+                else:
                     if index == 0:
                         plume_name = r'memory\pnh4_{}'.format(pathid)
                         name = r'memory\rnh4_{}'.format(pathid)
@@ -986,55 +1630,10 @@ class Transport:
                     else:
                         plume_name = r'memory\phos_{}'.format(pathid)
                         name = r'memory\rphos_{}'.format(pathid)
-                    if arcpy.Exists(plume_name):
-                        arcpy.management.Delete(plume_name)
-                    if arcpy.Exists(name):
-                        arcpy.management.Delete(name)
-                    plume_raster.save(plume_name)
-                    arcpy.management.DefineProjection(plume_name, self.crs)
-
-                    if maxangle_diff < 0.1 and abs(langle[0] - 90) < 0.1:
-                        warped_plumes.append(plume_name)
-                        target_body_pts_list.append(None)
-                        continue
-
-                    if plume_array.shape[1] <= perstepnum or maxangle_diff > 30:
-                        end_number = int(plume_array.shape[1] * self.plume_cell_size / segment['TotDist'].iloc[0])
-                        if end_number > len(segment['Shape']):
-                            end_number = len(segment['Shape'])
-                        elif end_number < 1:
-                            end_number = 1
-                        first_x = segment['Shape'].iloc[0].firstPoint.X
-                        first_y = segment['Shape'].iloc[0].firstPoint.Y
-                        last_x = segment['Shape'].iloc[end_number - 1].lastPoint.X
-                        last_y = segment['Shape'].iloc[end_number - 1].lastPoint.Y
-                        if first_x == last_x:
-                            if first_y > last_y:
-                                angle = 90
-                            else:
-                                angle = 270
-                        else:
-                            angle = math.degrees(math.atan2((last_y - first_y), (last_x - first_x)))
-                        if (last_y - first_y) >= 0:
-                            angle = 360 - angle
-                        else:
-                            angle = - angle
-                        pivot_point = "" + str(xvalue) + " " + str(yvalue)
-                        factor = 1
-                        if arcpy.Raster(plume_name).maximum < 1E-1 and self.minimum_correction:
-                            factor = int(10 / arcpy.Raster(plume_name).maximum)
-                            plume_name = arcpy.sa.Times(plume_name, factor)
-                        arcpy.management.Rotate(plume_name, name, angle, pivot_point, "NEAREST")
-                        if factor != 1 and self.minimum_correction:
-                            name = arcpy.sa.Times(name, 1 / factor)
-                            factor = 1
-                        warped_plumes.append(name)
-                    else:
-                        center_pts, body_pts = self.get_control_points(plume_array, True)
-
-                        if center_pts is None and body_pts is None:
-                            return plume_name, None
-
+                    try:
+                        center_pts, body_pts = self.get_control_points(plume_array, True, columns)
+                        if body_pts is None:
+                            raise Exception("No body points")
                         results = self.get_target_points_gis(segment, center_pts, body_pts, xvalue, yvalue)
                         target_center_pts, origin_center_pts, target_body_pts, origin_body_pts = results
                         if len(target_center_pts) >= 10:
@@ -1043,428 +1642,230 @@ class Transport:
                         else:
                             source_control_points = origin_center_pts
                             target_control_points = target_center_pts
-
-                        # shp1_list = []
-                        # shp2_list = []
-                        # for index in range(len(source_control_points)):
-                        #     xvalue = source_control_points[index][0]
-                        #     yvalue = source_control_points[index][1]
-                        #     point = arcpy.Point(xvalue, yvalue)
-                        #     geometry = arcpy.PointGeometry(point, self.crs)
-                        #     shp1_list.append(geometry)
-                        #
-                        #     xvalue = target_control_points[index][0]
-                        #     yvalue = target_control_points[index][1]
-                        #     point = arcpy.Point(xvalue, yvalue)
-                        #     geometry = arcpy.PointGeometry(point, self.crs)
-                        #     shp2_list.append(geometry)
-                        # shp1_name = 'shp1.shp'
-                        # arcpy.management.CopyFeatures(shp1_list, shp1_name)
-                        # shp2_name = 'shp2.shp'
-                        # arcpy.management.CopyFeatures(shp2_list, shp2_name)
-
                         source_control_points = ';'.join([f"'{x} {y}'" for x, y in source_control_points])
                         target_control_points = ';'.join([f"'{x} {y}'" for x, y in target_control_points])
 
-                        try:
-                            if body_pts is None:
-                                raise Exception("No body points")
-                            factor = 1
-                            if arcpy.Raster(plume_name).maximum < 1E-1 and self.minimum_correction:
-                                factor = int(10 / arcpy.Raster(plume_name).maximum)
-                                plume_name = arcpy.sa.Times(plume_name, factor)
-                            arcpy.management.Warp(plume_name, source_control_points, target_control_points, name,
-                                                  self.warp_method.upper(), "BILINEAR")
-                            if factor != 1 and self.minimum_correction:
-                                name = arcpy.sa.Times(name, 1 / factor)
-                                factor = 1
-                            if arcpy.Describe(
-                                name).meanCellHeight == 0 or arcpy.Describe(name).meanCellWidth == 0 or arcpy.Raster(
+                        for raster in (plume_name, name):
+                            if arcpy.Exists(raster):
+                                arcpy.management.Delete(raster)
+                        full_array = plume_array
+                        if columns is not None:
+                            # the Warp tool needs every cell of the plume
+                            full_array = interpolate_columns(plume_array, columns, np.arange(length))
+                            full_array = np.where(full_array > self.threshold, full_array, np.nan).astype(np.float32)
+                        plume_raster = arcpy.NumPyArrayToRaster(full_array, arcpy.Point(xvalue, y_lower_left),
+                                                                self.plume_cell_size, self.plume_cell_size)
+                        plume_raster.save(plume_name)
+                        arcpy.management.DefineProjection(plume_name, self.crs)
+                        arcpy.management.Warp(plume_name, source_control_points, target_control_points, name,
+                                              self.warp_method.upper(), "BILINEAR")
+                        arcpy.management.Delete(plume_name)
+                        desc = arcpy.Describe(name)
+                        if desc.meanCellHeight == 0 or desc.meanCellWidth == 0 or arcpy.Raster(
                                 name).maximum is None or arcpy.Raster(name).maximum < self.threshold:
-                                # abs(arcpy.Describe(
-                                #     name).meanCellHeight - self.plume_cell_size) > self.plume_cell_size or abs(
-                                #     arcpy.Describe(
-                                #         name).meanCellWidth - self.plume_cell_size) > self.plume_cell_size or
-                                # arcpy.AddMessage("              Warp failed for plume {}, use rotate method.".format(pathid))
-                                raise Exception("Warp error!")
-                            if arcpy.Exists(plume_name):
-                                arcpy.management.Delete(plume_name)
-                            warped_plumes.append(name)
-                            target_body_pts_term = target_body_pts
-                        except:
-                            end_number = int(plume_array.shape[1] * self.plume_cell_size / segment['TotDist'].iloc[0])
-                            if end_number > len(segment['Shape']):
-                                end_number = len(segment['Shape'])
-                            elif end_number < 1:
-                                end_number = 1
-                            first_x = segment['Shape'].iloc[0].firstPoint.X
-                            first_y = segment['Shape'].iloc[0].firstPoint.Y
-                            last_x = segment['Shape'].iloc[end_number - 1].lastPoint.X
-                            last_y = segment['Shape'].iloc[end_number - 1].lastPoint.Y
-                            if first_x == last_x:
-                                if first_y > last_y:
-                                    angle = 90
-                                else:
-                                    angle = 270
-                            else:
-                                angle = math.degrees(math.atan2((last_y - first_y), (last_x - first_x)))
-                            if (last_y - first_y) >= 0:
-                                angle = 360 - angle
-                            else:
-                                angle = - angle
-                            pivot_point = "" + str(xvalue) + " " + str(yvalue)
-                            try:
-                                if index == 0:
-                                    name = r'memory\rnh4_{}'.format(pathid)
-                                elif index == 1:
-                                    name = r'memory\rno3_{}'.format(pathid)
-                                else:
-                                    name = r'memory\rphos_{}'.format(pathid)
-                                if arcpy.Exists(name):
-                                    arcpy.management.Delete(name)
-                            except:
-                                print("Delete failed")
-                            factor = 1
-                            if arcpy.Raster(plume_name).maximum < 1E-1 and self.minimum_correction:
-                                factor = int(10 / arcpy.Raster(plume_name).maximum)
-                                plume_name = arcpy.sa.Times(plume_name, factor)
-                            arcpy.management.Rotate(plume_name, name, angle, pivot_point, "NEAREST")
-                            if factor != 1 and self.minimum_correction:
-                                name = arcpy.sa.Times(name, 1 / factor)
-                                factor = 1
-                            warped_plumes.append(name)
-                except Exception as e:
-                    arcpy.AddMessage("[Error] Plume {} cannot be warped.".format(pathid) + str(e))
-                    arcpy.AddMessage("Skip the plume: {} for warp calculation.".format(pathid))
-                    warped_plumes.append(None)
-                    target_body_pts_list.append(None)
-                    continue
-            target_body_pts_list.append(target_body_pts_term)
+                            raise Exception("Warp error!")
+                        warped = name
+                    except Exception:
+                        target_body_pts = None
+                        angle = self.get_rotation_angle(segment, length)
+                        warped = warp_array(plume_array, xvalue, y_lower_left, self.plume_cell_size,
+                                            rotation(angle, pivot), rotation(-angle, pivot),
+                                            self.snap_x, self.snap_y, order=0, columns=columns)
+                if isinstance(warped, tuple):
+                    warped[0][warped[0] <= self.threshold] = 0
+                warped_plumes.append(warped)
+            except Exception as e:
+                arcpy.AddMessage("[Error] Plume {} cannot be warped.".format(pathid) + str(e))
+                arcpy.AddMessage("Skip the plume: {} for warp calculation.".format(pathid))
+                warped_plumes.append(None)
+                target_body_pts = None
+            target_body_pts_list.append(target_body_pts)
         return warped_plumes, target_body_pts_list, lengths
 
     def post_process_plume(self, lengths, name_list, pathid, segment, target_body_pts_list, output_raster_list):
         """
         Post process the plume
         """
-        method  = 1
         fnames = []
-        maxDist = segment['TotDist'].iloc[-1]
+        maxDist = segment.tot_dist[-1]
         for index, name in enumerate(name_list):
             if name is None:
                 fnames.append(None)
                 continue
+            elif isinstance(name, tuple):
+                # in memory plume, already on the water body grid
+                fname = name
             else:
-                if index == 0:
-                    fname = r'memory\rsn4_{}'.format(pathid)
-                elif index == 1:
-                    fname = r'memory\rsn3_{}'.format(pathid)
-                else:
-                    fname = r'memory\rsp_{}'.format(pathid)
+                # raster of arcpy.management.Warp, resampled to the water body grid in memory
+                try:
+                    fname = self.raster_to_grid(name)
+                except Exception as e:
+                    arcpy.AddMessage("[Error] Resample plume {}: ".format(pathid) + str(e))
+                    fname = None
+                if fname is None:
+                    fnames.append(None)
+                    continue
 
-                if pathid != 0:
-                    try:
-                        out_raster = arcpy.sa.SetNull(name, name, "VALUE < {}".format(self.threshold))
-                        max_value = arcpy.Raster(out_raster).maximum
-                        if float(max_value) < self.threshold:
-                            fnames.append(None)
-                            continue
-
-                        arcpy.env.snapRaster = self.waterbody_raster
-                        factor = 1
-                        if max_value < 1E-1 and self.minimum_correction:
-                            factor = int(10 / max_value)
-                            name = arcpy.sa.Times(name, factor)
-                        arcpy.management.Resample(name, fname, str(self.plume_cell_size), "NEAREST")
-                        if factor != 1 and self.minimum_correction:
-                            fname = arcpy.sa.Times(fname, 1 / factor)
-                            factor = 1
-                        # arcpy.env.snapRaster = None
-                    except Exception as e:
-                        continue
-                else:
-                    fname = name
+            if lengths[index] * self.plume_cell_size < maxDist:
+                fnames.append(fname)
+                continue
 
-                if lengths[index] * self.plume_cell_size < maxDist:
+            if self.post_process == 'none' or self.post_process == 'medium':
+                fnames.append(fname)
+            elif self.post_process == 'full':
+                try:
+                    fnames.append(self.clip_plume(fname, pathid))
+                except Exception as e:
+                    arcpy.AddMessage("[Error] Post process plume {}: ".format(pathid) + str(e))
+                    arcpy.AddMessage("Skip the plume: {} for post process.".format(pathid))
                     fnames.append(fname)
-                    continue
-
-                if self.post_process == 'none' or self.post_process == 'medium':
-                    if pathid != 0:
-                        fnames.append(fname)
-                    else:
-                        fnames.append(name)
-                elif self.post_process == 'full':
-                    if method > 0:
-                        try:
-                            result = arcpy.sa.ExtractByMask(name, self.waterbodies, "OUTSIDE", name)
-                            arcpy.env.snapRaster = None
-                            result = arcpy.sa.SetNull(result, result, "VALUE < {}".format(self.threshold))
-                            result = arcpy.sa.SetNull(result, result, "VALUE > {}".format(10000))
-                            result.save(name)
-
-                            polygon = arcpy.sa.Con(result, 1, "", "VALUE > 0")
-                            shp_name = r"memory\polygon"
-                            arcpy.conversion.RasterToPolygon(polygon, shp_name, "NO_SIMPLIFY", "VALUE")
-                            shp_buffer = r"memory\buffer"
-                            arcpy.analysis.Buffer(shp_name, shp_buffer, "1 Meters")
-
-                            with arcpy.da.SearchCursor(self.source_location, ['SHAPE@'],
-                                                       where_clause=f"FID = {pathid}") as point_cursor:
-                                point_geom = None
-                                for point_row in point_cursor:
-                                    point_geom = point_row[0]
-                                    break
-
-                                if point_geom:
-                                    with arcpy.da.UpdateCursor(shp_buffer, ['SHAPE@']) as poly_cursor:
-                                        for poly_row in poly_cursor:
-                                            polygon_geom = poly_row[0]
-                                            if not polygon_geom.contains(point_geom):
-                                                poly_cursor.deleteRow()
-
-                            result = arcpy.management.GetCount(shp_buffer)
-                            count = int(result.getOutput(0))
-                            if count < 1:
-                                continue
-                            outpt = arcpy.sa.ExtractByMask(name, shp_buffer, "INSIDE", name)
-
-                            if index == 0:
-                                save_name = r'memory\pfn4_{}'.format(pathid)
-                            elif index == 1:
-                                save_name = r'memory\pfn3_{}'.format(pathid)
-                            else:
-                                save_name = r'memory\pfph_{}'.format(pathid)
-                            if arcpy.Exists(save_name):
-                                arcpy.management.Delete(save_name)
-                            outpt.save(save_name)
-                            fnames.append(save_name)
-
-                        except Exception as e:
-                            # arcpy.AddMessage("[Error] Post process medium: " + str(e))
-                            fnames.append(fname)
-                            continue
-                    else:
-                        try:
-                            point_list = []
-                            if target_body_pts_list[index] is None:
-                                fnames.append(fname)
-                                continue
-                            for row in target_body_pts_list[index]:
-                                point = arcpy.Point(row[0], row[1])
-                                point_list.append(point)
-                            polyline = arcpy.Polyline(arcpy.Array(point_list), self.crs)
-
-                            arcpy.management.CopyFeatures(polyline, r'memory\polyline')
-                            arcpy.management.Delete(polyline)
-
-                            arcpy.management.FeatureToPolygon([polyline], r'memory\linecheck', "", "NO_ATTRIBUTES")
-                            if arcpy.management.GetCount(r'memory\linecheck')[0] == "1":
-                                arcpy.management.Delete(r'memory\linecheck')
-                                arcpy.management.Delete(polyline)
-                                fnames.append(fname)
-                                continue
-
-                            if arcpy.Exists(r'memory\slwb'):
-                                arcpy.management.Delete(r'memory\slwb')
-                            arcpy.analysis.Select(self.waterbodies, r'memory\slwb',
-                                                  "fid = {}".format(segment["WBId"].iloc[-1]))
-
-                            inFeatures = [r'memory\polyline', r'memory\slwb']
-                            outFeatures = r'memory\polygon'
-                            arcpy.management.FeatureToPolygon(inFeatures, outFeatures, "", "NO_ATTRIBUTES")
-                            Erase_polygon = r'memory\Erase_polygon'
-                            arcpy.analysis.Erase(outFeatures, r'memory\slwb', Erase_polygon)
-
-                            if index == 0:
-                                save_name = r'memory\pfn4_{}'.format(pathid)
-                            elif index == 1:
-                                save_name = r'memory\pfn3_{}'.format(pathid)
-                            else:
-                                save_name = r'memory\pfph_{}'.format(pathid)
-                            if arcpy.Exists(save_name):
-                                arcpy.management.Delete(save_name)
-
-                            if arcpy.management.GetCount(Erase_polygon)[0] == "1":
-                                result = arcpy.sa.ExtractByMask(fname, Erase_polygon)
-                                result.save(save_name)
-                                fnames.append(save_name)
-                                arcpy.management.Delete(polyline)
-                                arcpy.management.Delete(outFeatures)
-                                arcpy.management.Delete(Erase_polygon)
-                                continue
-
-                            elif arcpy.management.GetCount(Erase_polygon)[0] == "0":
-                                while True:
-                                    with arcpy.da.UpdateCursor(r'memory\polyline', ['SHAPE@']) as cursor:
-                                        for row in cursor:
-                                            polyline = row[0]
-
-                                            first_point = polyline.firstPoint
-                                            last_point = polyline.lastPoint
-                                            new_first_x = 2 * first_point.X - polyline.getPart(0)[1].X
-                                            new_first_y = 2 * first_point.Y - polyline.getPart(0)[1].Y
-                                            new_last_x = 2 * last_point.X - polyline.getPart(0)[-2].X
-                                            new_last_y = 2 * last_point.Y - polyline.getPart(0)[-2].Y
-
-                                            new_part = arcpy.Array()
-                                            new_part.add(arcpy.Point(new_first_x, new_first_y))
-                                            for point in polyline.getPart(0):
-                                                new_part.add(point)
-                                            new_part.add(arcpy.Point(new_last_x, new_last_y))
-
-                                            new_polyline = arcpy.Polyline(new_part)
-                                            row[0] = new_polyline
-                                            cursor.updateRow(row)
-
-                                    arcpy.analysis.Intersect([r'memory\polyline', r'memory\slwb'], r'memory\Intersect')
-                                    ppp = arcpy.da.SearchCursor(r'memory\Intersect', ["SHAPE@"]).next()[0]
-                                    if ppp.isMultipart:
-                                        break
-
-                                if arcpy.Exists(r'memory\linecheck'):
-                                    arcpy.management.Delete(r'memory\linecheck')
-                                arcpy.management.FeatureToPolygon([polyline], r'memory\linecheck', "", "NO_ATTRIBUTES")
-                                if arcpy.management.GetCount(r'memory\linecheck')[0] == "1":
-                                    arcpy.management.Delete(r'memory\linecheck')
-                                    arcpy.management.Delete(polyline)
-                                    fnames.append(fname)
-                                    continue
-
-                                inFeatures = [r'memory\polyline', r'memory\slwb']
-                                outFeatures = r'memory\polygon'
-                                arcpy.management.FeatureToPolygon(inFeatures, outFeatures, "", "NO_ATTRIBUTES")
-                                Erase_polygon = r'memory\Erase_polygon'
-                                arcpy.analysis.Erase(outFeatures, r'memory\slwb', Erase_polygon)
-
-                                result = arcpy.sa.ExtractByMask(fname, Erase_polygon)
-                                result.save(save_name)
-                                fnames.append(save_name)
-                            else:
-                                fnames.append(fname)
-                                continue
-                        except Exception as e:
-                            arcpy.AddMessage("[Error] Post process plume {}: ".format(pathid) + str(e))
-                            arcpy.AddMessage("Skip the plume: {} for post process.".format(pathid))
-                            fnames.append(fname)
         return fnames
 
-    def post_process_medium(self, plume_names):
+    def raster_to_grid(self, raster):
         """
-        Medium post process the plume
+        Resample a plume raster to the water body grid in memory by nearest neighbor, keeping its precision
+
+        Cells below the threshold are dropped. Returns (array, x lower left, y lower left) with zeros outside of the
+        plume, None if no cell reaches the threshold.
         """
-        for index, name in enumerate(plume_names):
-            if name is not None:
-                try:
-                    # if arcpy.Describe(name).extent.overlaps(arcpy.Describe(self.waterbodies).extent):
-                    result = arcpy.sa.ExtractByMask(name, self.waterbodies, "OUTSIDE", name)
-
-                    arcpy.env.snapRaster = None
-                    result = arcpy.sa.SetNull(result, result, "VALUE < {}".format(self.threshold))
-                    result = arcpy.sa.SetNull(result, result, "VALUE > {}".format(10000))
-                    result.save(name)
-
-                    polygon = arcpy.sa.Con(result, 1, "", "VALUE > 0")
-                    shp_name = r"memory\polygon"
-                    arcpy.conversion.RasterToPolygon(polygon, shp_name, "NO_SIMPLIFY", "VALUE")
-                    shp_buffer = r"memory\buffer"
-                    arcpy.analysis.Buffer(shp_name, shp_buffer, "1 Meters")
-
-                    with arcpy.da.UpdateCursor(shp_buffer, ['SHAPE@']) as poly_cursor:
-                        for poly_row in poly_cursor:
-                            polygon_geom = poly_row[0]
-
-                            with arcpy.da.SearchCursor(self.source_location, ['SHAPE@']) as point_cursor:
-                                point_inside_polygon = False
-                                for point_row in point_cursor:
-                                    point_geom = point_row[0]
-
-                                    if polygon_geom.contains(point_geom):
-                                        point_inside_polygon = True
-                                        break
-
-                                if not point_inside_polygon:
-                                    poly_cursor.deleteRow()
-
-                    result = arcpy.management.GetCount(shp_buffer)
-                    count = int(result.getOutput(0))
-                    if count < 1:
-                        continue
-                    outpt = arcpy.sa.ExtractByMask(name, shp_buffer, "INSIDE", name)
-                    outpt.save(name)
+        desc = arcpy.Describe(raster)
+        array = arcpy.RasterToNumPyArray(raster, nodata_to_value=np.nan)
+        array[~(array >= self.threshold)] = np.nan
+        if np.isnan(array).all():
+            return None
+        array, x_lower_left, y_lower_left = resample_array(array, desc.extent.XMin, desc.extent.YMin,
+                                                           desc.meanCellWidth, desc.meanCellHeight,
+                                                           self.plume_cell_size, self.snap_x, self.snap_y, order=0)
+        return np.nan_to_num(array, copy=False), x_lower_left, y_lower_left
+
+    def clip_plume(self, plume, pathid):
+        """
+        Clip a plume at the water bodies, keeping the cells connected to the source (full post process)
 
-                except Exception as e:
-                    # arcpy.AddMessage("[Error] Post process medium: " + str(e))
-                    continue
-        return None
+        plume, a raster on the water body grid or (array, x lower left, y lower left) of warp_numpy. Returns the
+        clipped (array, x lower left, y lower left), None if no plume cell touches the source.
+        """
+        if not isinstance(plume, tuple):
+            desc = arcpy.Describe(plume)
+            plume = (arcpy.RasterToNumPyArray(plume, nodata_to_value=0), desc.extent.XMin, desc.extent.YMin)
+        array, x_lower_left, y_lower_left = plume
+        source_x, source_y = self.source_xy[self.source_position(pathid)]
+        clipped = self.water_grid.clip(array, x_lower_left, y_lower_left, source_x, source_y, self.threshold, 10000)
+        if clipped is None:
+            return None
+        return clipped, x_lower_left, y_lower_left
+
+    def post_process_medium(self, canvas):
+        """
+        Medium post process the summed plumes of a canvas, in place
+
+        The cells in water bodies and below the threshold are removed, and only the connected plumes with a source
+        are kept.
+        """
+        if canvas.array is None:
+            return
+        try:
+            x_lower_left = canvas.snap_x + canvas.col_start * canvas.cell_size
+            y_lower_left = canvas.snap_y + canvas.row_start * canvas.cell_size
+            canvas.array[:] = self.water_grid.select(canvas.array, x_lower_left, y_lower_left, self.source_xy[:, 0],
+                                                     self.source_xy[:, 1], self.threshold, 10000)
+        except Exception as e:
+            arcpy.AddMessage("[Error] Post process medium: " + str(e))
+
+    def read_initial_conc(self):
+        """
+        Read the locations and the initial concentrations of all sources with a single cursor, see get_initial_conc
+        """
+        field_names = [field.name.lower() for field in arcpy.Describe(self.source_location).fields]
+        self.source_conc_fields = [field if field in field_names and contaminant in self.contaminant_list else None
+                                   for contaminant, field in (("NO3-N", "no3_conc"), ("NH4-N", "nh4_conc"),
+                                                              ("PO4-P", "p_conc"))]
+        fields = ["OID@", "SHAPE@X", "SHAPE@Y"] + [field for field in self.source_conc_fields if field is not None]
+        with arcpy.da.SearchCursor(self.source_location, fields) as cursor:
+            # missing concentrations are read as 0, the source is skipped like sources below the threshold
+            table = np.array([[0.0 if value is None else value for value in row] for row in cursor],
+                             dtype=float).reshape(-1, len(fields))
+        table = table[np.argsort(table[:, 0], kind='stable')]
+        self.source_fids = table[:, 0].astype(np.int64)
+        self.source_xy = table[:, 1:3]
+        self.source_conc = [None] * 3
+        column = 3
+        for index, field in enumerate(self.source_conc_fields):
+            if field is not None:
+                self.source_conc[index] = table[:, column]
+                column += 1
+
+    def source_position(self, fid):
+        """
+        Row of the source fid in the tables of read_initial_conc, None if there is no such source
+        """
+        position = int(np.searchsorted(self.source_fids, fid))
+        if position >= len(self.source_fids) or self.source_fids[position] != fid:
+            return None
+        return position
+
+    def source_point(self, fid):
+        """
+        Location of the source fid as an arcpy point geometry
+        """
+        position = self.source_position(fid)
+        if position is None:
+            return None
+        return arcpy.PointGeometry(arcpy.Point(*self.source_xy[position]), self.crs)
 
     def get_initial_conc(self, fid):
         """
         Get the initial concentration of the no3 and nh4
+
+        The per-source concentrations come from the no3_conc, nh4_conc and p_conc fields read by read_initial_conc,
+        sources without a field use the concentrations of the tool parameters.
         """
         try:
-            desc = arcpy.Describe(self.source_location)
-            field_list = desc.fields
-            no3_exists = any(field.name.lower() == "no3_conc" for field in field_list)
-            nh4_exists = any(field.name.lower() == "nh4_conc" for field in field_list)
-            pho_exists = any(field.name.lower() == "p_conc" for field in field_list)
-
-            query = "FID = {}".format(fid)
-            point = None
-
-            if no3_exists and "NO3-N" in self.contaminant_list:
-                cursor = arcpy.da.SearchCursor(self.source_location, ["SHAPE@", "FID", "no3_conc"], query)
-                row = cursor.next()
-                point = row[0]
-                no3_conc = row[2]
+            position = self.source_position(fid)
+            if position is None:
+                raise ValueError("No source with FID = {}".format(fid))
+            point = arcpy.PointGeometry(arcpy.Point(*self.source_xy[position]), self.crs)
+
+            no3_column, nh4_column, pho_column = self.source_conc
+            if no3_column is not None:
+                no3_conc = no3_column[position]
                 self.no3_init = no3_conc
-            elif "NO3-N" in self.contaminant_list and (not no3_exists):
+            elif "NO3-N" in self.contaminant_list:
                 no3_conc = self.no3_init
             else:
                 no3_conc = 0
 
-            if nh4_exists and "NH4-N" in self.contaminant_list:
-                cursor = arcpy.da.SearchCursor(self.source_location, ["SHAPE@", "FID", "nh4_conc"], query)
-                row = cursor.next()
-                if point is None:
-                    point = row[0]
-                nh4_conc = row[2]
+            if nh4_column is not None:
+                nh4_conc = nh4_column[position]
                 self.nh4_init = nh4_conc
-            elif "NH4-N" in self.contaminant_list and (not nh4_exists):
+            elif "NH4-N" in self.contaminant_list:
                 nh4_conc = self.nh4_init
             else:
                 nh4_conc = 0
 
-            if pho_exists and "PO4-P" in self.contaminant_list:
-                cursor = arcpy.da.SearchCursor(self.source_location, ["SHAPE@", "FID", "p_conc"], query)
-                row = cursor.next()
-                if point is None:
-                    point = row[0]
-                pho_conc = row[2]
+            if pho_column is not None:
+                pho_conc = pho_column[position]
                 self.pho_init = pho_conc
-            elif "PO4-P" in self.contaminant_list and (not pho_exists):
+            elif "PO4-P" in self.contaminant_list:
                 pho_conc = self.pho_init
             else:
                 pho_conc = 0
 
-            if point is None:
-                cursor = arcpy.da.SearchCursor(self.source_location, ["SHAPE@", "FID"], query)
-                row = cursor.next()
-                point = row[0]
-
             return point, no3_conc, nh4_conc, pho_conc
         except Exception as e:
             arcpy.AddMessage("[Error] Can not get initial value of NO3 and NH4 for point {}: ".format(fid) + str(e))
             return None, None, None, None
 
-    def create_new_plume_data_shapefile(self, start_num, end_num, flag=False):
+    def create_new_plume_data_shapefile(self, start_num, end_num, flag=False, tile=None):
         """Create a new shapefile to store the plume data
         """
+        chunk = chunk_name(start_num, end_num, tile)
         try:
             if "NO3-N" in self.contaminant_list:
                 if flag:
                     no3info_name = self.no3_output_info
                 else:
-                    no3info_name = "n3i{}_{}".format(start_num, end_num)
+                    no3info_name = "n3i{}".format(chunk)
                 if arcpy.Exists(os.path.join(self.no3_dir, no3info_name)):
                     arcpy.Delete_management(os.path.join(self.no3_dir, no3info_name))
                 create_shapefile(self.no3_dir, no3info_name, self.crs)
@@ -1474,7 +1875,7 @@ class Transport:
                 if flag:
                     nh4info_name = self.nh4_output_info
                 else:
-                    nh4info_name = "n4i{}_{}".format(start_num, end_num)
+                    nh4info_name = "n4i{}".format(chunk)
                 if arcpy.Exists(os.path.join(self.nh4_dir, nh4info_name)):
                     arcpy.Delete_management(os.path.join(self.nh4_dir, nh4info_name))
                 create_shapefile(self.nh4_dir, nh4info_name, self.crs)
@@ -1484,7 +1885,7 @@ class Transport:
                 if flag:
                     phoinfo_name = self.phos_output_info
                 else:
-                    phoinfo_name = "pi{}_{}".format(start_num, end_num)
+                    phoinfo_name = "pi{}".format(chunk)
                 if arcpy.Exists(os.path.join(self.phos_dir, phoinfo_name)):
                     arcpy.Delete_management(os.path.join(self.phos_dir, phoinfo_name))
                 create_shapefile(self.phos_dir, phoinfo_name, self.crs)
@@ -1495,11 +1896,13 @@ class Transport:
             sys.exit(-1)
         return nh4info_name, no3info_name, phoinfo_name
 
-    def get_control_points(self, plume_array, ifgis=False):
+    def get_control_points(self, plume_array, ifgis=False, columns=None):
         """
         Get the control points for warping
+
+        columns, positions [cells] of the columns of a multi-resolution plume, the control points are in cells
         """
-        plumelen = plume_array.shape[1]
+        plumelen = plume_array.shape[1] if columns is None else int(columns[-1]) + 1
         if plumelen < 20:
             warp_ctrl_pt_spacing = 2
             center_number = math.ceil(plumelen / warp_ctrl_pt_spacing) + 1
@@ -1531,10 +1934,12 @@ class Transport:
 
         # get the start and end points bigger than the threshold
         plume_array = np.nan_to_num(plume_array)
-        if np.nanmax(plume_array[:, -1]) >= self.threshold:
+        if columns is None:
             cols = plume_array[:, center_pts]
         else:
-            cols = plume_array[:, center_pts[:-1]]
+            cols = interpolate_columns(plume_array, columns, center_pts)
+        if np.nanmax(plume_array[:, -1]) < self.threshold:
+            cols = cols[:, :-1]
         starts = []
         for col in cols.T:
             start = np.where(col > self.threshold)[0][0]
@@ -1580,24 +1985,21 @@ class Transport:
         target_body_right_pts = []
         target_body_left_pts = []
 
-        segment['dist'] = segment['TotDist'] - segment['TotDist'].shift(1)
-        segment.loc[0, 'dist'] = segment['TotDist'].iloc[0]
+        dist = np.diff(segment.tot_dist, prepend=0.0)
 
-        x_origin_value = segment['Shape'].iloc[0].firstPoint.X
-        y_origin_value = segment['Shape'].iloc[0].firstPoint.Y
+        x_origin_value = segment.first_x[0]
+        y_origin_value = segment.first_y[0]
         for i in range(len(center_pts)):
             length = (center_pts[i, 0] - center_pts[0, 0]) * self.plume_cell_size
-            index = (segment['TotDist'] >= length).idxmax()
+            index = int(np.argmax(segment.tot_dist >= length))
             if i == len(center_pts) - 1 and index == 0:
                 index = len(segment) - 1
-            first_x = segment['Shape'].iloc[index].firstPoint.X
-            first_y = segment['Shape'].iloc[index].firstPoint.Y
-            last_x = segment['Shape'].iloc[index].lastPoint.X
-            last_y = segment['Shape'].iloc[index].lastPoint.Y
-            target_x = last_x - (last_x - first_x) / segment['dist'].iloc[index] * (
-                    segment['TotDist'].iloc[index] - length)
-            target_y = last_y - (last_y - first_y) / segment['dist'].iloc[index] * (
-                    segment['TotDist'].iloc[index] - length)
+            first_x = segment.first_x[index]
+            first_y = segment.first_y[index]
+            last_x = segment.last_x[index]
+            last_y = segment.last_y[index]
+            target_x = last_x - (last_x - first_x) / dist[index] * (segment.tot_dist[index] - length)
+            target_y = last_y - (last_y - first_y) / dist[index] * (segment.tot_dist[index] - length)
             delta_x = (target_x - x_origin_value) / self.plume_cell_size
             delta_y = (target_y - y_origin_value) / self.plume_cell_size
             target_center_pts.append([center_pts[0, 0] + delta_x, center_pts[0, 1] + delta_y])
@@ -1626,9 +2028,8 @@ class Transport:
         """
         Get the target points for warping
         """
-        segment['dist'] = segment['TotDist'] - segment['TotDist'].shift(1)
-        segment['dist'] = segment['dist'].apply(lambda x: 0.1 if x < 0.1 else x)
-        segment.loc[0, 'dist'] = segment['TotDist'].iloc[0]
+        dist = np.maximum(np.diff(segment.tot_dist, prepend=0.0), 0.1)
+        dist[0] = segment.tot_dist[0]
 
         target_center_pts = []
         origin_center_pts = []
@@ -1641,18 +2042,16 @@ class Transport:
             center_origin_x = xvalue + center_pts[i] * self.plume_cell_size
             center_origin_y = yvalue
             length = (center_pts[i] - center_pts[0]) * self.plume_cell_size
-            index = (segment['TotDist'] >= length).idxmax()
-            # if (i == len(center_pts) - 1 and index == 0) or length >= segment['TotDist'].iloc[-1]:
-            if length >= segment['TotDist'].iloc[-1]:
+            index = int(np.argmax(segment.tot_dist >= length))
+            # if (i == len(center_pts) - 1 and index == 0) or length >= segment.tot_dist[-1]:
+            if length >= segment.tot_dist[-1]:
                 index = len(segment) - 1
-            first_x = segment['Shape'].iloc[index].firstPoint.X
-            first_y = segment['Shape'].iloc[index].firstPoint.Y
-            last_x = segment['Shape'].iloc[index].lastPoint.X
-            last_y = segment['Shape'].iloc[index].lastPoint.Y
-            target_x = last_x - (last_x - first_x) / segment['dist'].iloc[index] * (
-                    segment['TotDist'].iloc[index] - length)
-            target_y = last_y - (last_y - first_y) / segment['dist'].iloc[index] * (
-                    segment['TotDist'].iloc[index] - length)
+            first_x = segment.first_x[index]
+            first_y = segment.first_y[index]
+            last_x = segment.last_x[index]
+            last_y = segment.last_y[index]
+            target_x = last_x - (last_x - first_x) / dist[index] * (segment.tot_dist[index] - length)
+            target_y = last_y - (last_y - first_y) / dist[index] * (segment.tot_dist[index] - length)
             origin_center_pts.append([center_origin_x, center_origin_y])
             target_center_pts.append([target_x, target_y])
 
@@ -1714,6 +2113,41 @@ class Transport:
         array[array > max_value] = max_value
         return array
 
+    def create_pool(self):
+        """
+        Process pool of the parallel plume calculation, None for serial runs
+        """
+        if self.workers < 2:
+            return None
+        if self.warp_engine != "numpy":
+            arcpy.AddMessage("[Warning]: Parallel plume calculation needs the NumPy warping engine, "
+                             "the plumes are calculated serially.")
+            return None
+        if os.path.basename(sys.executable).lower().startswith("arcgispro"):
+            # inside ArcGIS Pro the workers are started with the python of the ArcGIS Pro environment
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self,))
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __getstate__(self):
+        """
+        State sent to the worker processes, without the process pool and the arcpy spatial reference
+        """
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['crs'] = None
+        state['worker'] = True
+        # the jobs carry the flow path of their location, the plumes are clipped by the main process
+        state['flow_paths'] = None
+        state['water_grid'] = None
+        # the workers load the tabulated kernels from the cache folder themselves
+        state['kernel_cache'] = LateralKernelCache(self.kernel_cache.directory)
+        return state
+
     def clear_memory(self):
         if arcpy.Exists(r'memory\water_bodies'):
             arcpy.management.Delete(r'memory\water_bodies')
@@ -1750,6 +2184,334 @@ class Transport:
         return memory_usage_gb, stack_usage_gb
 
 
+class FlowPaths:
+    """
+    Flow path segments of the particle tracking as contiguous columns sorted by OSTDS_ID and SegID
+
+    The segments of one location are the rows starts[i]:stops[i] of every column, so a location is found by a
+    binary search instead of filtering all segments. Only the end points of the polylines are kept.
+    """
+    FIELDS = ["SHAPE@", "OSTDS_ID", "SegID", "TotDist", "TotTime", "SegPrsity", "SegVel", "DirAngle", "WBId",
+              "PathWBId"]
+
+    def __init__(self, ostds_id, seg_id, tot_dist, tot_time, porosity, velocity, angle, wbid, path_wbid,
+                 first_x, first_y, last_x, last_y):
+        order = np.lexsort((seg_id, ostds_id))
+        self.ostds_id = np.asarray(ostds_id, dtype=np.int64)[order]
+        self.tot_dist = np.asarray(tot_dist, dtype=float)[order]
+        self.tot_time = np.asarray(tot_time, dtype=float)[order]
+        self.porosity = np.asarray(porosity, dtype=float)[order]
+        self.velocity = np.asarray(velocity, dtype=float)[order]
+        self.angle = np.asarray(angle, dtype=float)[order]
+        self.wbid = np.asarray(wbid, dtype=np.int64)[order]
+        self.path_wbid = np.asarray(path_wbid, dtype=np.int64)[order]
+        self.first_x = np.asarray(first_x, dtype=float)[order]
+        self.first_y = np.asarray(first_y, dtype=float)[order]
+        self.last_x = np.asarray(last_x, dtype=float)[order]
+        self.last_y = np.asarray(last_y, dtype=float)[order]
+        self.ids, self.starts = np.unique(self.ostds_id, return_index=True)
+        self.stops = np.append(self.starts[1:], len(self.ostds_id))
+
+    @classmethod
+    def read(cls, feature_class):
+        """Read the segments feature class, the polylines are reduced to their first and last points"""
+        columns = [[] for _ in range(13)]
+        with arcpy.da.SearchCursor(feature_class, cls.FIELDS) as cursor:
+            for row in cursor:
+                shape = row[0]
+                for column, value in zip(columns, row[1:] + (shape.firstPoint.X, shape.firstPoint.Y,
+                                                             shape.lastPoint.X, shape.lastPoint.Y)):
+                    column.append(value)
+        return cls(*columns)
+
+    def columns(self):
+        """All columns, in a fixed order"""
+        return [self.ostds_id, self.tot_dist, self.tot_time, self.porosity, self.velocity, self.angle, self.wbid,
+                self.path_wbid, self.first_x, self.first_y, self.last_x, self.last_y]
+
+    def locations(self, start_num, end_num):
+        """OSTDS_IDs of the locations start_num <= OSTDS_ID < end_num"""
+        return self.ids[np.searchsorted(self.ids, start_num):np.searchsorted(self.ids, end_num)]
+
+    def flow_path(self, ostdsid):
+        """Segments of one location as a FlowPath of array views"""
+        position = np.searchsorted(self.ids, ostdsid)
+        return FlowPath(self, self.starts[position], self.stops[position])
+
+
+class FlowPath:
+    """
+    Segments of the flow path of one location, see FlowPaths
+    """
+    def __init__(self, paths, start, stop):
+        rows = slice(start, stop)
+        self.tot_dist = paths.tot_dist[rows]
+        self.tot_time = paths.tot_time[rows]
+        self.porosity = paths.porosity[rows]
+        self.velocity = paths.velocity[rows]
+        self.angle = paths.angle[rows]
+        self.wbid = paths.wbid[rows]
+        self.path_wbid = paths.path_wbid[rows]
+        self.first_x = paths.first_x[rows]
+        self.first_y = paths.first_y[rows]
+        self.last_x = paths.last_x[rows]
+        self.last_y = paths.last_y[rows]
+
+    def __len__(self):
+        return len(self.tot_dist)
+
+
+class SpatialTile:
+    """
+    Locations of a square tile of the transport domain and of its halo, see Transport.spatial_tiles
+
+    window, the tile in grid indices (col_start, row_start, col_stop, row_stop) of the water body grid. locations,
+    the sorted OSTDS_IDs of the tile and its halo, own, the OSTDS_IDs in the tile.
+    """
+    def __init__(self, name, window, locations, own):
+        self.name = name
+        self.window = window
+        self.locations = locations
+        self.own = own
+
+
+class RunCheckpoint:
+    """
+    Manifest of the finished chunks of a chunked transport run, see Transport.main
+
+    The manifest is a JSON file with the hash of the inputs (Transport.input_hash) and the finished chunks. A
+    manifest of other inputs is ignored, and the manifest is written after every chunk so an interrupted run
+    resumes with the first unfinished chunk.
+    """
+    def __init__(self, path, inputs):
+        self.path = path
+        self.inputs = inputs
+        self.chunks = []
+        try:
+            with open(path) as file:
+                manifest = json.load(file)
+            if manifest.get("inputs") == inputs:
+                self.chunks = list(manifest.get("chunks", []))
+        except (OSError, ValueError):
+            pass
+
+    def done(self, chunk):
+        return chunk in self.chunks
+
+    def complete(self, chunk):
+        if chunk not in self.chunks:
+            self.chunks.append(chunk)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"inputs": self.inputs, "chunks": self.chunks}, file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SourceCache:
+    """
+    Plume tiles and plume statistics of every source of a chunk, kept across runs, see Transport.calculate_plumes
+
+    The folder of a chunk holds an index (model hash, grid, source keys and canvas generation), the summed canvases
+    of the last run and one file per source and key with the tiles it added to the canvases and its plume statistics.
+    A source with the key of the last run reuses its tiles, a changed or removed source is subtracted from the sums.
+    The cache of another model or grid is cleared.
+
+    The files referenced by the index are never overwritten: the new canvases are written under the next generation,
+    the new sources under their new keys, and the superseded files are deleted once the new index replaced the old
+    one. A run interrupted before save leaves the cache of the last run intact.
+    """
+    def __init__(self, directory, chunk, model, grid):
+        self.directory = os.path.join(directory, "chunk_{}".format(chunk))
+        self.model = model
+        self.grid = tuple(float(value) for value in grid)
+        self.keys = {}  # source FID: key
+        self.bounds = {}  # (slot, species): canvas bounds
+        self.generation = 0
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, "index.pkl"), "rb") as file:
+                index = pickle.load(file)
+            if index["model"] == model and index["grid"] == self.grid:
+                self.keys = index["keys"]
+                self.bounds = index["bounds"]
+                self.generation = index["generation"]
+            else:
+                self.clear()
+        except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+            self.clear()
+
+    def canvas_path(self, slot, species, generation=None):
+        if generation is None:
+            generation = self.generation
+        return os.path.join(self.directory, "canvas_{}_{}_{}.npy".format(generation, slot, species))
+
+    def source_path(self, fid, key):
+        return os.path.join(self.directory, "source_{}_{}.pkl".format(fid, key))
+
+    def restore(self, slots):
+        """Load the summed canvases of the last run, the cache is cleared if one of them is missing"""
+        try:
+            for (slot, species), bounds in self.bounds.items():
+                if slots[slot][species] is None:
+                    raise ValueError("The species {} is not calculated".format(species))
+                slots[slot][species].restore(np.load(self.canvas_path(slot, species)), bounds)
+        except (OSError, ValueError, IndexError):
+            for canvases in slots:
+                for canvas in canvases:
+                    if canvas is not None:
+                        canvas.close()
+            self.clear()
+
+    def get(self, fid, key):
+        """Tiles and plume statistics of an unchanged source, None if the source changed"""
+        if self.keys.get(fid) != key:
+            return None
+        try:
+            return self.load(fid, key)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def load(self, fid, key):
+        with open(self.source_path(fid, key), "rb") as file:
+            return pickle.load(file)
+
+    def subtract(self, fid, slots):
+        """
+        Subtract the tiles of a source from the canvases and forget the source
+
+        Returns False if the tiles of the source cannot be read, the canvases are then no longer consistent with the
+        cache, the caller clears the cache and recalculates the chunk.
+        """
+        if fid not in self.keys:
+            return True
+        try:
+            tiles, _ = self.load(fid, self.keys[fid])
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        for canvases, slot_tiles in zip(slots, tiles):
+            for canvas, tile in zip(canvases, slot_tiles):
+                if canvas is not None and tile is not None:
+                    canvas.subtract(*self.unpack(tile))
+        # the file is still referenced by the index on disk, it is deleted by save
+        del self.keys[fid]
+        return True
+
+    def put(self, fid, key, tiles, statistics):
+        """Keep the tiles and the plume statistics (Transport.plume_statistics) of a source"""
+        tiles = [[self.pack(tile) if tile is not None else None for tile in slot_tiles] for slot_tiles in tiles]
+        with open(self.source_path(fid, key), "wb") as file:
+            pickle.dump((tiles, statistics), file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.keys[fid] = key
+
+    @staticmethod
+    def pack(tile):
+        """
+        Sparse form of a tile, (shape, flat indices, values, x lower left, y lower left) of the nonzero cells
+
+        The warped plume fills a small part of its bounding box, only the cells above the threshold are written.
+        """
+        array, x_lower_left, y_lower_left = tile
+        array = np.nan_to_num(array)
+        indices = np.flatnonzero(array)
+        if array.size <= np.iinfo(np.int32).max:
+            indices = indices.astype(np.int32)
+        return array.shape, indices, array.ravel()[indices], x_lower_left, y_lower_left
+
+    @staticmethod
+    def unpack(tile):
+        """Tile (array, x lower left, y lower left) of the sparse form written by pack"""
+        shape, indices, values, x_lower_left, y_lower_left = tile
+        array = np.zeros(shape, dtype=values.dtype)
+        array.ravel()[indices] = values
+        return array, x_lower_left, y_lower_left
+
+    def save(self, slots):
+        """Write the summed canvases and the index, the files of the last run are deleted after the index"""
+        generation = self.generation + 1
+        bounds = {}
+        for slot, canvases in enumerate(slots):
+            for species, canvas in enumerate(canvases):
+                if canvas is not None and canvas.array is not None:
+                    np.save(self.canvas_path(slot, species, generation), canvas.array)
+                    bounds[(slot, species)] = canvas.bounds
+        temp_path = os.path.join(self.directory, "index.tmp")
+        with open(temp_path, "wb") as file:
+            pickle.dump({"model": self.model, "grid": self.grid, "keys": self.keys, "bounds": bounds,
+                         "generation": generation}, file)
+        os.replace(temp_path, os.path.join(self.directory, "index.pkl"))
+        self.bounds = bounds
+        self.generation = generation
+
+        # superseded canvases and sources and the files of interrupted runs
+        current = set(self.source_path(fid, key) for fid, key in self.keys.items())
+        current.update(self.canvas_path(slot, species) for slot, species in bounds)
+        current.add(os.path.join(self.directory, "index.pkl"))
+        for filename in glob.glob(os.path.join(self.directory, "*")):
+            if filename not in current:
+                os.remove(filename)
+
+    def clear(self):
+        self.keys = {}
+        self.bounds = {}
+        self.generation = 0
+        for filename in glob.glob(os.path.join(self.directory, "*")):
+            os.remove(filename)
+
+
+# Transport instance of a worker process, see Transport.create_pool
+_worker_transport = None
+
+
+def _init_worker(transport):
+    global _worker_transport
+    _worker_transport = transport
+    set_erf_backend(transport.erf_backend)
+    set_plume_dtype(transport.plume_dtype)
+    set_kernel_cache(transport.kernel_cache)
+
+
+def _process_batch(jobs):
+    return list(_worker_transport.process_batch(jobs))
+
+
+def chunk_name(start_num, end_num, tile=None):
+    """Name of a chunk in the names of its outputs, the tile name or the OSTDS_ID range, e.g. 0_1000"""
+    if tile is not None:
+        return tile.name
+    return "{}_{}".format(start_num, end_num)
+
+
+def band_raster_name(name, band):
+    """Name of the single band raster of an output time or depth, e.g. no3plumes_b0"""
+    root, extension = os.path.splitext(name)
+    return "{}_b{}{}".format(root, band, extension)
+
+
+def multiband_raster_name(name, suffix):
+    """Name of a multi-band raster, e.g. no3plumes_t for the output times and no3plumes_z for the depths"""
+    root, extension = os.path.splitext(name)
+    return "{}_{}{}".format(root, suffix, extension)
+
+
+# largest number of locations whose reference plumes are sized together, see Transport.size_plumes
+BATCH_SOURCES = 64
+
+# Fields of the info shapefiles, see create_shapefile and Transport.calculate_info
+INFO_FIELDS = [("OSTDS_ID", np.int32), ("is2D", np.int32), ("domBdy", np.int32), ("decayCoeff", np.float64),
+               ("avgVel", np.float64), ("avgPrsity", np.float64), ("DispL", np.float64), ("DispTH", np.float64),
+               ("DispTV", np.float64), ("SourceY", np.float64), ("SourceZ", np.float64), ("MeshDX", np.float64),
+               ("MeshDY", np.float64), ("MeshDZ", np.float64), ("plumeTime", np.float64), ("pathTime", np.float64),
+               ("plumeLen", np.float64), ("pathLen", np.float64), ("plumeArea", np.float64),
+               ("mslnRtNmr", np.float64), ("massInRate", np.float64), ("massRMRate", np.float64),
+               ("avgAngle", np.float64), ("warp", np.int32), ("PostP", np.int32), ("Init_conc", np.float64),
+               ("volFac", np.float64), ("nextConc", np.float64), ("threshConc", np.float64),
+               ("WBId_plume", np.int32), ("WBId_path", np.int32), ("load", np.float64), ("wb_conc", np.float64)]
+
+
 def create_shapefile(save_path, name, crs):
     arcpy.management.CreateFeatureclass(
         out_path=save_path,
@@ -1757,39 +2519,9 @@ def create_shapefile(save_path, name, crs):
         geometry_type="POINT",
         spatial_reference=crs)
 
-    arcpy.management.AddField(os.path.join(save_path, name), "OSTDS_ID", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "is2D", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "domBdy", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "decayCoeff", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "avgVel", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "avgPrsity", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "DispL", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "DispTH", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "DispTV", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "SourceY", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "SourceZ", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "MeshDX", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "MeshDY", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "MeshDZ", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "plumeTime", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "pathTime", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "plumeLen", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "pathLen", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "plumeArea", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "mslnRtNmr", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "massInRate", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "massRMRate", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "avgAngle", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "warp", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "PostP", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "Init_conc", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "volFac", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "nextConc", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "threshConc", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "WBId_plume", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "WBId_path", "LONG")
-    arcpy.management.AddField(os.path.join(save_path, name), "load", "DOUBLE")
-    arcpy.management.AddField(os.path.join(save_path, name), "wb_conc", "DOUBLE")
+    for field, field_type in INFO_FIELDS:
+        arcpy.management.AddField(os.path.join(save_path, name), field,
+                                  "LONG" if field_type == np.int32 else "DOUBLE")
 
 
 def find_perpendicular_point(x1, y1, x2, y2, distance, x0, y0):